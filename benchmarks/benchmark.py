@@ -0,0 +1,145 @@
+"""Registry, timing and baseline comparison of the benchmarks.
+
+A benchmark is a setup function registered with `@benchmark(name)`. It builds its inputs and
+returns (function, operations), where function runs `operations` operations of the measured hot
+path, e.g. one call per grid position. Times are reported per operation. A setup that raises
+ImportError, e.g. without roboticstoolbox, is reported as skipped.
+"""
+import json
+import platform
+import statistics
+import subprocess
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable, Optional
+
+# Time in seconds every benchmark is measured for, split into REPEATS repeats
+MEASURE_TIME = 1.0
+REPEATS = 5
+# Relative slowdown above which a benchmark is a regression. Compared are the fastest repeats,
+# which are the least disturbed by other load on the machine
+REGRESSION_TOLERANCE = 0.2
+
+REGISTRY = {}  # name -> setup function
+
+
+def benchmark(name):
+    """Register a benchmark setup function under name"""
+    def register(setup: Callable):
+        REGISTRY[name] = setup
+        return setup
+    return register
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    status: str  # "ok", "skipped" or "failed"
+    reason: Optional[str] = None
+    operations: int = 0  # operations per measured call
+    loops: int = 0  # calls per repeat
+    median: Optional[float] = None  # s per operation over the repeats
+    minimum: Optional[float] = None
+    mean: Optional[float] = None
+    stdev: Optional[float] = None
+    ops_per_second: Optional[float] = None
+
+
+def measure(function, operations=1, measure_time=MEASURE_TIME, repeats=REPEATS):
+    """Time function per operation: the number of calls per repeat is calibrated so every
+    repeat lasts about measure_time / repeats, after one warm-up call
+    :return: (calls per repeat, seconds per operation of every repeat)"""
+    start = time.perf_counter()
+    function()
+    single = max(time.perf_counter() - start, 1e-9)
+    loops = max(1, int(measure_time / repeats / single))
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        times.append((time.perf_counter() - start) / (loops * operations))
+    return loops, times
+
+
+def run(names=None, measure_time=MEASURE_TIME, repeats=REPEATS):
+    """Run the registered benchmarks, all if names is None
+    :return: list of BenchmarkResult"""
+    results = []
+    for name, setup in REGISTRY.items():
+        if names is not None and not any(name.startswith(prefix) for prefix in names):
+            continue
+        try:
+            function, operations = setup()
+        except ImportError as exc:
+            results.append(BenchmarkResult(name, "skipped", reason=f"missing dependency: {exc.name or exc}"))
+            continue
+        try:
+            loops, times = measure(function, operations, measure_time, repeats)
+        except Exception as exc:
+            results.append(BenchmarkResult(name, "failed", reason=repr(exc)))
+            continue
+        median = statistics.median(times)
+        results.append(BenchmarkResult(
+            name, "ok",
+            operations=operations,
+            loops=loops,
+            median=median,
+            minimum=min(times),
+            mean=statistics.fmean(times),
+            stdev=statistics.stdev(times) if len(times) > 1 else 0.0,
+            ops_per_second=1.0 / median if median > 0 else None,
+        ))
+    return results
+
+
+def environment():
+    """Machine and revision the results were measured on"""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                  timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "system": platform.platform(),
+    }
+
+
+def to_report(results):
+    return {"environment": environment(), "results": {result.name: asdict(result) for result in results}}
+
+
+def load_report(path):
+    with open(path) as report_file:
+        return json.load(report_file)
+
+
+def compare(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Compare the fastest repeats of a report with a baseline report
+    :return: {name: {"status", "ratio", "minimum", "baseline"}}, status is "regression", "improvement",
+    "ok", "new" (not in the baseline) or "not_run" (skipped or failed in one of the reports)"""
+    comparison = {}
+    baseline_results = baseline["results"]
+    for name, result in report["results"].items():
+        reference = baseline_results.get(name)
+        entry = {"minimum": result["minimum"], "baseline": reference["minimum"] if reference else None, "ratio": None}
+        if reference is None:
+            entry["status"] = "new"
+        elif result["status"] != "ok" or reference["status"] != "ok":
+            entry["status"] = "not_run"
+        else:
+            entry["ratio"] = result["minimum"] / reference["minimum"]
+            if entry["ratio"] > 1 + tolerance:
+                entry["status"] = "regression"
+            elif entry["ratio"] < 1 - tolerance:
+                entry["status"] = "improvement"
+            else:
+                entry["status"] = "ok"
+        comparison[name] = entry
+    return comparison
@@ -0,0 +1,177 @@
+"""Benchmarks of the hot paths of the controller and the DT.
+
+Inputs are the grid positions of the valid regions of the spatial model and the states of the
+recorded PT log PT_LOG, so every run measures the same work. The benchmarks needing the kinematic
+model (roboticstoolbox, spatialmath) are skipped without it.
+"""
+import contextlib
+import os
+
+import numpy as np
+
+from benchmarks.benchmark import benchmark
+import communication.protocol as protocol
+
+PT_LOG = "data/pt_data/E2_pt.csv"
+# Bounding box of sm_config.VALID_REGIONS in grid points
+GRID_X = range(-6, 17)
+GRID_Y = range(-10, 6)
+# Number of joint position pairs of the timing model benchmark
+TIMING_PAIRS = 1000
+# Operations of every operation type executed per measured call of the controller benchmarks
+CONTROLLER_OPERATIONS = 100
+
+
+def valid_grid_positions():
+    """Grid positions within the valid regions of the spatial model"""
+    from models.spatial_model.spatial_model import SpatialModel
+    spatial_model = SpatialModel()
+    positions = []
+    for x in GRID_X:
+        for y in GRID_Y:
+            try:
+                spatial_model.compute_spatial_pose(x, y, perform_safety_check=True)
+            except ValueError:
+                continue
+            positions.append((x, y))
+    return positions
+
+
+def pt_states():
+    from physical_twin_mockup.log_replay.log_replay import load_states
+    _, states = load_states(PT_LOG)
+    return states
+
+
+def grid_joint_positions(kinematic_model, spatial_model, positions):
+    return [kinematic_model.compute_inverse_kinematics(spatial_model.compute_spatial_pose(x, y))
+            for x, y in positions]
+
+
+@benchmark("spatial_model.compute_spatial_pose")
+def spatial_pose():
+    from models.spatial_model.spatial_model import SpatialModel
+    spatial_model = SpatialModel()
+    positions = valid_grid_positions()
+
+    def run():
+        for x, y in positions:
+            spatial_model.compute_spatial_pose(x, y, perform_safety_check=True)
+    return run, len(positions)
+
+
+@benchmark("kinematic_model.compute_inverse_kinematics")
+def inverse_kinematics():
+    from models.kinematic_model.kinematic_model import KinematicModel
+    from models.spatial_model.spatial_model import SpatialModel
+    kinematic_model = KinematicModel()
+    spatial_model = SpatialModel()
+    poses = [spatial_model.compute_spatial_pose(x, y) for x, y in valid_grid_positions()]
+
+    def run():
+        for pose in poses:
+            kinematic_model.compute_inverse_kinematics(pose)
+    return run, len(poses)
+
+
+@benchmark("kinematic_model.compute_trajectory")
+def trajectory():
+    from models.kinematic_model.kinematic_model import KinematicModel
+    from models.spatial_model.spatial_model import SpatialModel
+    from models.timing_model.timing_model import TimingModel
+    kinematic_model = KinematicModel()
+    timing_model = TimingModel()
+    jps = grid_joint_positions(kinematic_model, SpatialModel(), valid_grid_positions())
+    # Moves between consecutive grid positions with the durations of the timing model
+    moves = [(start, end, timing_model.compute_duration_between_jps(start, end)) for start, end in zip(jps, jps[1:])]
+
+    def run():
+        for start, end, duration in moves:
+            kinematic_model.compute_trajectory(start, end, duration)
+    return run, len(moves)
+
+
+@benchmark("kinematic_model.compute_forward_kinematics")
+def forward_kinematics():
+    from models.kinematic_model.kinematic_model import KinematicModel
+    from models.spatial_model.spatial_model import SpatialModel
+    kinematic_model = KinematicModel()
+    jps = grid_joint_positions(kinematic_model, SpatialModel(), valid_grid_positions())
+
+    def run():
+        for q in jps:
+            kinematic_model.compute_forward_kinematics(q)
+    return run, len(jps)
+
+
+@benchmark("timing_model.compute_duration_between_jps")
+def duration_between_jps():
+    from models.timing_model.timing_model import TimingModel
+    timing_model = TimingModel()
+    q = np.array([state[protocol.RobotArmStateKeys.ACTUAL_Q] for state in pt_states()])
+    rng = np.random.default_rng(0)
+    pairs = [(q[i], q[j]) for i, j in rng.integers(len(q), size=(TIMING_PAIRS, 2))]
+
+    def run():
+        for start, end in pairs:
+            timing_model.compute_duration_between_jps(start, end)
+    return run, len(pairs)
+
+
+@benchmark("protocol.encode_json")
+def encode_json():
+    states = pt_states()
+
+    def run():
+        for state in states:
+            protocol.encode_json(state)
+    return run, len(states)
+
+
+@benchmark("protocol.decode_json")
+def decode_json():
+    bodies = [protocol.encode_json(state) for state in pt_states()]
+
+    def run():
+        for body in bodies:
+            protocol.decode_json(body)
+    return run, len(bodies)
+
+
+def execute_next_operation(operation):
+    """CONTROLLER_OPERATIONS executions of one operation type, sent over the in-process broker"""
+    from physical_twin_mockup.controller.controller import Controller
+    rmq_config = {
+        "ip": "localhost", "port": 5672, "username": "", "password": "", "vhost": "/",
+        "exchange": "BENCHMARK", "type": "topic", "backend": "inprocess",
+    }
+    controller = Controller(rmq_config, "one_block")
+    controller.rmq.connect_to_server()
+    execute = controller._Controller__execute_next_operation
+    operations = [operation] * CONTROLLER_OPERATIONS
+
+    def run():
+        controller.task_stack = list(operations)
+        # The controller prints every control message it sends
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for _ in range(CONTROLLER_OPERATIONS):
+                execute()
+    return run, CONTROLLER_OPERATIONS
+
+
+@benchmark("controller.execute_next_operation.move")
+def controller_move():
+    from task_specifications.utils.operation_types import Move
+    return execute_next_operation(Move(2, 2, table_distance=0.05))
+
+
+@benchmark("controller.execute_next_operation.grip")
+def controller_grip():
+    from task_specifications.utils.operation_types import Grip
+    return execute_next_operation(Grip())
+
+
+@benchmark("controller.execute_next_operation.move_gripper")
+def controller_move_gripper():
+    from task_specifications.utils.operation_types import MoveGripper
+    return execute_next_operation(MoveGripper(0.5))
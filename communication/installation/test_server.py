@@ -1,5 +1,4 @@
 import logging
-import time
 
 from communication.rabbitmq import Rabbitmq
 
@@ -39,14 +38,9 @@ if __name__ == '__main__':
         connection.send_message(routing_key="test", message={"text": "321"})
         print("Message sent.")
 
-        msg = None
-        print("Retrieving message.", end="")
-        while msg is None:
-            msg = connection.get_message(queue_name=qname)
-            if msg is not None:
-                print(" Received message is", msg)
-            else:
-                print(".", end="")
-                time.sleep(0.1)  # in case too fast that the message has not been delivered.
+        print("Retrieving message.")
+        # Blocks until the message is delivered instead of polling.
+        msg = connection.get_message(queue_name=qname, timeout=5.0)
+        print(" Received message is", msg)
 
 
@@ -0,0 +1,383 @@
+"""In-memory stand-in for the RabbitMQ broker.
+
+`LocalRabbitmq` exposes the same methods as `communication.rabbitmq.Rabbitmq` but routes
+messages through a `LocalBroker` topic exchange instead of an AMQP server. The broker either
+lives in the current process (backend "inprocess") or is served to several processes over a
+local socket by `serve_local_broker` (backend "local_socket").
+"""
+import collections
+import itertools
+import logging
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+import pika
+
+from communication.protocol import *
+from communication.rabbitmq import CONFLATE_MAX_LENGTH, CONFLATE_PREFETCH_COUNT
+from communication.tracing import Tracer
+
+BACKEND_INPROCESS = "inprocess"
+BACKEND_LOCAL_SOCKET = "local_socket"
+
+# How long start_consuming blocks on the broker before checking whether it has been closed
+CONSUME_POLL_TIMEOUT = 0.1
+# Exchange of the queues waking start_consuming for callbacks added with add_callback_threadsafe
+WAKE_EXCHANGE = "local.wake"
+
+
+def topic_matches(binding_key, routing_key):
+    """Check if a routing key matches an AMQP topic binding key.
+    '*' matches exactly one word and '#' matches zero or more words.
+    :param binding_key: the binding key, e.g. "robotarm.*.state" or "robotarm.#"
+    :type str
+    :param routing_key: the routing key of a published message
+    :type str
+    :return: True if the routing key matches the binding key
+    :rtype: bool"""
+    return _match_words(binding_key.split("."), routing_key.split("."))
+
+
+def _match_words(pattern, words):
+    if not pattern:
+        return not words
+    head, rest = pattern[0], pattern[1:]
+    if head == "#":
+        # '#' may swallow any number of words, including none
+        return any(_match_words(rest, words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return (head == "*" or head == words[0]) and _match_words(rest, words[1:])
+
+
+class LocalBroker:
+    """Thread-safe in-memory broker with topic exchanges and exclusive queues.
+    Queues hold (routing_key, body, headers) tuples, bodies are the encoded bytes as on the wire."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._exchanges = {}
+        self._queues = {}
+        self._max_lengths = {}
+        self._dropped = collections.Counter()  # queue name -> messages dropped by the bound
+        self._bindings = collections.defaultdict(list)
+        self._queue_ids = itertools.count()
+
+    def declare_exchange(self, exchange, exchange_type):
+        with self._condition:
+            self._exchanges.setdefault(exchange, exchange_type)
+
+    def declare_queue(self, max_length=None):
+        """Create a new server-named queue.
+        :param max_length: bound of the queue, the oldest message is dropped when exceeded
+        :return: the name of the queue"""
+        with self._condition:
+            queue_name = f"local.gen-{next(self._queue_ids)}"
+            self._queues[queue_name] = collections.deque()
+            self._max_lengths[queue_name] = max_length
+            return queue_name
+
+    def bind_queue(self, queue_name, exchange, routing_key):
+        with self._condition:
+            self._bindings[queue_name].append((exchange, routing_key))
+
+    def unbind_queue(self, queue_name, exchange):
+        with self._condition:
+            self._bindings[queue_name] = [
+                binding for binding in self._bindings[queue_name] if binding[0] != exchange
+            ]
+
+    def delete_queue(self, queue_name):
+        with self._condition:
+            self._queues.pop(queue_name, None)
+            self._max_lengths.pop(queue_name, None)
+            self._dropped.pop(queue_name, None)
+            self._bindings.pop(queue_name, None)
+            self._condition.notify_all()
+
+    def publish(self, exchange, routing_key, body, headers=None):
+        """Route a message to every queue bound with a matching key.
+        :return: the number of queues the message was delivered to"""
+        with self._condition:
+            exchange_type = self._exchanges.get(exchange, "topic")
+            delivered = 0
+            for queue_name, bindings in self._bindings.items():
+                if any(self.__matches(exchange_type, binding_key, routing_key)
+                       for bound_exchange, binding_key in bindings if bound_exchange == exchange):
+                    queue = self._queues[queue_name]
+                    queue.append((routing_key, body, headers))
+                    max_length = self._max_lengths[queue_name]
+                    if max_length is not None and len(queue) > max_length:
+                        queue.popleft()
+                        self._dropped[queue_name] += 1
+                    delivered += 1
+            if delivered:
+                self._condition.notify_all()
+            return delivered
+
+    def get(self, queue_name, timeout=0.0):
+        """Pop the oldest message of a queue.
+        :param timeout: time in seconds to wait for a message, 0 returns immediately
+        :return: (routing_key, body, headers) or None if the queue is empty"""
+        with self._condition:
+            if timeout:
+                self._condition.wait_for(lambda: self._queues.get(queue_name), timeout)
+            queue = self._queues.get(queue_name)
+            if not queue:
+                return None
+            return queue.popleft()
+
+    def dropped_count(self, queue_name):
+        """Number of messages dropped because the queue exceeded its max_length"""
+        with self._condition:
+            return self._dropped.get(queue_name, 0)
+
+    def queue_length(self, queue_name):
+        """Number of messages waiting in a queue, 0 for unknown queues"""
+        with self._condition:
+            return len(self._queues.get(queue_name, ()))
+
+    def get_batch(self, queue_names, timeout=None):
+        """Wait until any of the queues holds messages and drain them all.
+        :param queue_names: the queues to drain
+        :param timeout: maximum time to wait in seconds, None waits forever
+        :return: list of (queue_name, routing_key, body, headers), empty on timeout"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: any(self._queues.get(name) for name in queue_names), timeout
+            )
+            batch = []
+            for name in queue_names:
+                queue = self._queues.get(name)
+                while queue:
+                    batch.append((name, *queue.popleft()))
+            return batch
+
+    def __matches(self, exchange_type, binding_key, routing_key):
+        if exchange_type == "fanout":
+            return True
+        if exchange_type == "direct":
+            return binding_key == routing_key
+        return topic_matches(binding_key, routing_key)
+
+
+class LocalBrokerManager(BaseManager):
+    """Manager serving a single LocalBroker to other processes over a local socket."""
+
+
+_inprocess_broker = LocalBroker()
+
+
+def get_inprocess_broker():
+    """Return the broker shared by every LocalRabbitmq of this process"""
+    return _inprocess_broker
+
+
+def serve_local_broker(ip, port, password):
+    """Serve the in-process broker on (ip, port) until the process is killed.
+    :param password: used as the authentication key of the connecting clients"""
+    LocalBrokerManager.register("get_broker", callable=get_inprocess_broker)
+    manager = LocalBrokerManager(address=(ip, port), authkey=password.encode(ENCODING))
+    manager.get_server().serve_forever()
+
+
+class LocalRabbitmq:
+    """Drop-in replacement for communication.rabbitmq.Rabbitmq backed by a LocalBroker.
+    Takes the same configuration, ip, port and password are only used by the local_socket backend.
+    :param backend: either "inprocess" or "local_socket" """
+
+    def __init__(self, ip,
+                 port,
+                 username,
+                 password,
+                 vhost,
+                 exchange,
+                 type,
+                 ssl=None,
+                 backend=BACKEND_INPROCESS,
+                 ):
+        self._l = logging.getLogger("LocalRabbitmqClass")
+        self.ip = ip
+        self.port = port
+        self.password = password
+        self.vhost = vhost
+        self.exchange_name = exchange
+        self.exchange_type = type
+        self.backend = backend
+
+        self.broker = None
+        self.channel = self
+        self.queue_name = []
+        self.dropped_messages = {}
+        self.consumers = {}
+        self.conflated_queues = set()
+        self.delivery_tags = itertools.count(1)
+        self.tracer = None
+        self.closed = threading.Event()
+        # Callbacks added with add_callback_threadsafe, run by start_consuming
+        self.pending_callbacks = collections.deque()
+        self.wake_queue = None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __enter__(self):
+        self.connect_to_server()
+        return self
+
+    def connect_to_server(self):
+        if self.backend == BACKEND_LOCAL_SOCKET:
+            LocalBrokerManager.register("get_broker")
+            manager = LocalBrokerManager(address=(self.ip, self.port),
+                                         authkey=self.password.encode(ENCODING))
+            manager.connect()
+            self.broker = manager.get_broker()
+        else:
+            self.broker = get_inprocess_broker()
+        self._l.debug("Connected.")
+        self.closed.clear()
+        self.broker.declare_exchange(self.exchange_name, self.exchange_type)
+        self.wake_queue = self.broker.declare_queue()
+        self.broker.bind_queue(self.wake_queue, WAKE_EXCHANGE, self.wake_queue)
+        self.queue_name.append(self.wake_queue)
+
+    def enable_tracing(self, origin):
+        """See Rabbitmq.enable_tracing"""
+        self.tracer = Tracer(origin, publish=lambda records: self.send_message(ROUTING_KEY_TRACE, records))
+
+    def send_message(self, routing_key, message, properties=None):
+        if self.tracer is not None:
+            properties = self.tracer.stamp(routing_key, message, properties)
+        headers = getattr(properties, "headers", None)
+        self.broker.publish(self.exchange_name, routing_key, encode_json(message), headers)
+        self._l.debug(f"Message sent to {routing_key}.")
+
+    def get_message(self, queue_name, timeout=0.0):
+        message = self.broker.get(queue_name, timeout)
+        if message is not None:
+            return decode_json(message[1])
+        else:
+            return None
+
+    def consume(self, routing_key, timeout=None, max_batch=None, stop_event=None):
+        """Generator yielding the decoded messages published on a routing key, see Rabbitmq.consume"""
+        queue_name = self.declare_local_queue(routing_key=routing_key)
+        poll_timeout = CONSUME_POLL_TIMEOUT if stop_event is not None else timeout
+        last_message_time = time.monotonic()
+        try:
+            while not self.closed.is_set():
+                if stop_event is not None and stop_event.is_set():
+                    return
+                batch = [decode_json(body) for _, _, body, _ in
+                         self.broker.get_batch([queue_name], timeout=poll_timeout)]
+                if not batch:
+                    if timeout is not None and time.monotonic() - last_message_time >= timeout:
+                        return
+                    continue
+                last_message_time = time.monotonic()
+                if max_batch is None:
+                    yield from batch
+                else:
+                    for start in range(0, len(batch), max_batch):
+                        yield batch[start:start + max_batch]
+        finally:
+            # The queue is already deleted if the generator is stopped by close
+            if queue_name in self.queue_name:
+                self.broker.delete_queue(queue_name)
+                self.queue_name.remove(queue_name)
+
+    def declare_local_queue(self, routing_key, arguments=None):
+        max_length = (arguments or {}).get("x-max-length")
+        created_queue_name = self.broker.declare_queue(max_length)
+        self.broker.bind_queue(created_queue_name, self.exchange_name, routing_key)
+        self.queue_name.append(created_queue_name)
+        self._l.info(f"Bound {routing_key}--> {created_queue_name}")
+        return created_queue_name
+
+    def queues_delete(self):
+        self.queue_name = list(set(self.queue_name))
+        for name in self.queue_name:
+            self._l.debug(f"Deleting queue:{name}")
+            self.broker.unbind_queue(name, self.exchange_name)
+            self.broker.delete_queue(name)
+        self.queue_name = []
+
+    def close(self):
+        if self.tracer is not None and self.broker is not None:
+            self.tracer.flush()
+        self.closed.set()
+        if self.broker is not None:
+            self.queues_delete()
+        self.consumers.clear()
+
+    def subscribe(self, routing_key, on_message_callback, conflate=False,
+                  max_length=CONFLATE_MAX_LENGTH, prefetch_count=CONFLATE_PREFETCH_COUNT):
+        """Subscribe to a routing key, see Rabbitmq.subscribe.
+        There is no prefetch window in the local broker, prefetch_count is accepted for compatibility."""
+        if self.tracer is not None:
+            on_message_callback = self.tracer.wrap(on_message_callback)
+        arguments = {"x-max-length": max_length} if conflate else None
+        created_queue_name = self.declare_local_queue(routing_key=routing_key, arguments=arguments)
+        self.consumers[created_queue_name] = on_message_callback
+        if conflate:
+            self.conflated_queues.add(created_queue_name)
+            self.dropped_messages[created_queue_name] = 0
+        return created_queue_name
+
+    def get_dropped_count(self, queue_name):
+        """See Rabbitmq.get_dropped_count: the messages collapsed by the client and
+        the messages dropped by the bound of the queue in the broker"""
+        dropped = self.dropped_messages.get(queue_name, 0)
+        if queue_name in self.conflated_queues and self.broker is not None:
+            dropped += self.broker.dropped_count(queue_name)
+        return dropped
+
+    def get_queue_depth(self, queue_name):
+        """See Rabbitmq.get_queue_depth"""
+        return self.broker.queue_length(queue_name)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        """Messages are removed from the local queues on delivery, nothing to acknowledge"""
+
+    def add_callback_threadsafe(self, callback):
+        """Run a callback in the thread consuming this client, may be called from any thread.
+        Like the callbacks of pika, it never runs concurrently with the subscribed callbacks."""
+        self.pending_callbacks.append(callback)
+        if self.wake_queue is not None:
+            self.broker.publish(WAKE_EXCHANGE, self.wake_queue, b"")
+
+    def start_consuming(self):
+        """Dispatch messages to the subscribed callbacks, and the callbacks added with
+        add_callback_threadsafe, until the connection is closed"""
+        while self.consumers and not self.closed.is_set():
+            batch = self.broker.get_batch([*self.consumers, self.wake_queue], timeout=CONSUME_POLL_TIMEOUT)
+            self.__run_pending_callbacks()
+            for queue_name, routing_key, body, headers in self.__conflate(batch):
+                callback = self.consumers.get(queue_name)
+                if callback is None:
+                    continue
+                method = pika.spec.Basic.Deliver(delivery_tag=next(self.delivery_tags),
+                                                 exchange=self.exchange_name,
+                                                 routing_key=routing_key)
+                # Headers are shared between the queues of the in-process broker
+                properties = pika.BasicProperties(headers=dict(headers) if headers else None)
+                if self.tracer is not None:
+                    self.tracer.mark_received(properties)
+                callback(self, method, properties, decode_json(body))
+            if self.tracer is not None:
+                self.tracer.flush_if_due()
+
+    def __run_pending_callbacks(self):
+        while self.pending_callbacks:
+            self.pending_callbacks.popleft()()
+
+    def __conflate(self, batch):
+        """Keep only the newest message per (queue, routing key) for conflated queues"""
+        latest = {}
+        for index, (queue_name, routing_key, body, headers) in enumerate(batch):
+            key = (queue_name, routing_key) if queue_name in self.conflated_queues else index
+            if key in latest:
+                self.dropped_messages[queue_name] += 1
+            latest[key] = (queue_name, routing_key, body, headers)
+        return latest.values()
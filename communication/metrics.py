@@ -0,0 +1,238 @@
+"""Counters and histograms of the messages handled by a service, in the Prometheus text format.
+
+A process enables metrics once with `enable_metrics(service)`, e.g. from
+startup.utils.instrumentation. Every broker client created afterwards by `create_rabbitmq`
+is wrapped in a `MeteredRabbitmq`, which counts the sent and received messages per routing key,
+times the subscription handlers and samples the depth of the subscribed queues and the messages
+dropped on them by conflation (see get_dropped_count of the clients):
+    dt_messages_sent_total{service, client, routing_key}
+    dt_messages_received_total{service, client, routing_key}
+    dt_messages_dropped_total{service, client, routing_key}
+    dt_handler_seconds{service, client, routing_key}  (histogram)
+    dt_queue_depth{service, client, routing_key}
+`MetricsRegistry.render` returns the exposition text served or written by the instrumentation.
+"""
+import bisect
+import collections
+import logging
+import threading
+import time
+
+from communication.tracing import LATENCY_BUCKETS
+
+# Interval at which the depth and the dropped messages of a subscribed queue are sampled by its handler
+QUEUE_DEPTH_SAMPLE_INTERVAL = 1.0 # s
+
+_registry = None
+
+
+def enable_metrics(service):
+    """Create the metrics registry of this process, used by all broker clients created afterwards
+    :param service: name of the service, added as label to all metrics"""
+    global _registry
+    _registry = MetricsRegistry(service)
+    return _registry
+
+
+def get_metrics():
+    """Metrics registry of this process, None if metrics are not enabled"""
+    return _registry
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """Samples of one metric by label values. Label values are passed in the order of labels."""
+    kind = None
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def format_labels(self, constant_labels, values, extra=()):
+        pairs = [*constant_labels, *zip(self.labels, values), *extra]
+        return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in pairs) + "}"
+
+    def render(self, constant_labels):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            lines.extend(self.render_samples(constant_labels))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self.values = collections.defaultdict(float)
+
+    def inc(self, *label_values, amount=1.0):
+        with self.lock:
+            self.values[label_values] += amount
+
+    def render_samples(self, constant_labels):
+        return [f"{self.name}{self.format_labels(constant_labels, values)} {float(value)!r}"
+                for values, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self.values = {}
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def render_samples(self, constant_labels):
+        return [f"{self.name}{self.format_labels(constant_labels, values)} {float(value)!r}"
+                for values, value in self.values.items()]
+
+
+class Histogram(Metric):
+    """Histogram with fixed buckets, the last bound must be infinite"""
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.bounds = [float(bound) for bound in buckets]
+        self.counts = {}  # label values -> [bucket counts, sum]
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            entry = self.counts.get(label_values)
+            if entry is None:
+                entry = self.counts[label_values] = [[0] * len(self.bounds), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render_samples(self, constant_labels):
+        lines = []
+        for values, (counts, total) in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds, counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{self.format_labels(constant_labels, values, [('le', le)])} {cumulative}")
+            labels = self.format_labels(constant_labels, values)
+            lines.append(f"{self.name}_sum{labels} {total!r}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics of one service process
+    :param service: value of the service label of all metrics"""
+
+    def __init__(self, service):
+        self.service = service
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def __get_or_create(self, metric_type, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_type(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, description, labels=()) -> Counter:
+        return self.__get_or_create(Counter, name, description, labels)
+
+    def gauge(self, name, description, labels=()) -> Gauge:
+        return self.__get_or_create(Gauge, name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.__get_or_create(Histogram, name, description, labels, buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        constant_labels = [("service", self.service)]
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(constant_labels))
+        return "\n".join(lines) + "\n"
+
+
+class MeteredRabbitmq:
+    """Broker client counting the messages and timing the handlers of the wrapped client.
+    All other methods are handled by the wrapped client.
+    :param client: the wrapped Rabbitmq, LocalRabbitmq or SharedMemoryRabbitmq client
+    :param registry: MetricsRegistry the metrics are recorded in
+    :param origin: name of the client, e.g. "digital_shadow" """
+
+    def __init__(self, client, registry, origin=None):
+        self._l = logging.getLogger("MeteredRabbitmqClass")
+        self.client = client
+        self.origin = origin or ""
+        labels = ("client", "routing_key")
+        self.sent = registry.counter("dt_messages_sent_total", "Messages sent", labels)
+        self.received = registry.counter("dt_messages_received_total", "Messages received", labels)
+        self.dropped = registry.counter("dt_messages_dropped_total", "Messages dropped by conflation", labels)
+        self.handler_seconds = registry.histogram("dt_handler_seconds", "Duration of the subscription handlers",
+                                                  labels)
+        self.queue_depth = registry.gauge("dt_queue_depth", "Messages waiting in the subscribed queue", labels)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def __enter__(self):
+        self.connect_to_server()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def send_message(self, routing_key, message, properties=None):
+        self.client.send_message(routing_key, message, properties)
+        self.sent.inc(self.origin, routing_key)
+
+    def get_message(self, queue_name, timeout=0.0):
+        message = self.client.get_message(queue_name, timeout)
+        if message is not None:
+            self.received.inc(self.origin, queue_name)
+        return message
+
+    def consume(self, routing_key, timeout=None, max_batch=None, stop_event=None):
+        for messages in self.client.consume(routing_key, timeout, max_batch, stop_event):
+            self.received.inc(self.origin, routing_key, amount=len(messages) if max_batch is not None else 1)
+            yield messages
+
+    def subscribe(self, routing_key, on_message_callback, conflate=False, **kwargs):
+        subscription = {"queue_name": None, "next_depth_sample": 0.0, "dropped": 0}
+
+        def metered_callback(ch, method, properties, body_json):
+            start = time.perf_counter()
+            on_message_callback(ch, method, properties, body_json)
+            end = time.perf_counter()
+            self.received.inc(self.origin, routing_key)
+            self.handler_seconds.observe(end - start, self.origin, routing_key)
+            if end >= subscription["next_depth_sample"] and subscription["queue_name"] is not None:
+                subscription["next_depth_sample"] = end + QUEUE_DEPTH_SAMPLE_INTERVAL
+                self.__sample_queue(subscription, routing_key)
+
+        subscription["queue_name"] = self.client.subscribe(routing_key, metered_callback, conflate=conflate, **kwargs)
+        return subscription["queue_name"]
+
+    def __sample_queue(self, subscription, routing_key):
+        queue_name = subscription["queue_name"]
+        try:
+            depth = self.client.get_queue_depth(queue_name)
+            dropped = self.client.get_dropped_count(queue_name)
+        except Exception:
+            self._l.debug("Could not sample the depth of %s", queue_name, exc_info=True)
+            return
+        self.queue_depth.set(depth, self.origin, routing_key)
+        if dropped > subscription["dropped"]:
+            self.dropped.inc(self.origin, routing_key, amount=dropped - subscription["dropped"])
+            subscription["dropped"] = dropped
@@ -4,8 +4,10 @@ ENCODING = "ascii"
 
 ### ROUTING KEYS
 ROUTING_KEY_STATE = "robotarm.pt.state"
+ROUTING_KEY_DT_STATE = "robotarm.dt.state" # predicted state, same message as ROUTING_KEY_STATE
 ROUTING_KEY_DT_MSG = "robotarm.dt.msg"
 ROUTING_KEY_CTRL = "robotarm.ctrl"
+ROUTING_KEY_TRACE = "robotarm.trace"
 
 ### MESSAGES
 class CtrlMsgKeys():
@@ -37,6 +39,31 @@ class RobotArmStateKeys():
     OUTPUT_BIT_REGISTER_65 = "output_bit_register_65" # start bit
     OUTPUT_BIT_REGISTER_66 = "output_bit_register_66" # grip detected
 
+### DELIVERY
+class SequenceHeaderKeys():
+    PUBLISHER = "seq_publisher" # id of the publishing client
+    NUMBER = "seq_number" # consecutive number of the messages of the publisher per routing key
+
+### TRACING
+class TraceHeaderKeys():
+    ORIGIN = "trace_origin"
+    HOST = "trace_host"
+    OPERATION_ID = "trace_operation_id"
+    SEND_TIME = "trace_send_ns" # monotonic clock of the sender
+    RECEIVE_TIME = "trace_receive_ns" # monotonic clock of the receiver, stamped locally
+
+class TraceRecordKeys():
+    ORIGIN = "origin"
+    ORIGIN_HOST = "origin_host"
+    RECEIVER = "receiver"
+    RECEIVER_HOST = "receiver_host"
+    ROUTING_KEY = "routing_key"
+    OPERATION_ID = "operation_id"
+    SEND_TIME = "send_ns"
+    RECEIVE_TIME = "receive_ns"
+    HANDLE_START_TIME = "handle_start_ns"
+    HANDLE_END_TIME = "handle_end_ns"
+
 
 ### LEGACY
 ROUTING_KEY_UPDATE_CTRL_PARAMS = "incubator.update.open_loop_controller.parameters"
@@ -1,8 +1,63 @@
 import pika
 import logging
+import random
+import time
+import collections
 import ssl as ssl_package
+import uuid
 
 from communication.protocol import *
+from communication.tracing import Tracer, TRACE_FLUSH_INTERVAL
+from communication.metrics import get_metrics, MeteredRabbitmq
+
+# Defaults for conflating subscriptions (see Rabbitmq.subscribe)
+CONFLATE_MAX_LENGTH = 10
+CONFLATE_PREFETCH_COUNT = 10
+
+# Reconnection with exponential backoff and full jitter (see Rabbitmq.reconnect)
+RECONNECT_INITIAL_DELAY = 0.05 # s
+RECONNECT_MAX_DELAY = 5.0 # s
+# Messages buffered by send_message while the connection is down, the oldest are dropped first
+OUTBOX_MAX_LENGTH = 1000
+# Errors after which the connection is re-established
+RECOVERABLE_ERRORS = (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError)
+
+# Interval at which Rabbitmq.consume checks its stop_event
+CONSUME_POLL_INTERVAL = 0.1 # s
+
+# Values of the optional "backend" key of the rabbitmq config
+BACKEND_AMQP = "amqp"
+
+
+def create_rabbitmq(rmq_config, origin=None):
+    """Create the broker client selected by the "backend" key of the rabbitmq config.
+    "amqp" (default) connects to a RabbitMQ server, "inprocess" and "local_socket"
+    use the in-memory broker in communication.local_broker.
+    :param rmq_config: the rabbitmq section of startup.conf
+    :param origin: name of the service using the client, enables latency tracing
+    if the "tracing" key of the config is set
+    The routing keys listed in "shm_routing_keys" are carried over shared memory instead,
+    see communication.shm_state_bus. If metrics are enabled in this process, the client is
+    metered, see communication.metrics."""
+    config = dict(rmq_config)
+    backend = config.pop("backend", BACKEND_AMQP)
+    tracing = config.pop("tracing", False)
+    shm_routing_keys = config.pop("shm_routing_keys", [])
+    if backend == BACKEND_AMQP:
+        client = Rabbitmq(**config)
+    else:
+        from communication.local_broker import LocalRabbitmq
+        client = LocalRabbitmq(backend=backend, **config)
+
+    if tracing and origin is not None:
+        client.enable_tracing(origin)
+    if shm_routing_keys:
+        from communication.shm_state_bus import SharedMemoryRabbitmq
+        client = SharedMemoryRabbitmq(client, shm_routing_keys)
+    metrics = get_metrics()
+    if metrics is not None:
+        client = MeteredRabbitmq(client, metrics, origin)
+    return client
 
 
 class Rabbitmq:
@@ -38,7 +93,27 @@ class Rabbitmq:
         self.connection = None
         self.channel = None
         self.queue_name = []
-        
+        self.dropped_messages = {}
+        self.tracer = None
+
+        # -- Sequence numbers, gaps on a conflated queue are messages dropped by the server
+        self.publisher_id = uuid.uuid4().hex
+        self.sent_sequence_numbers = collections.defaultdict(int)  # routing key -> last number sent
+        self.received_sequence_numbers = {}  # queue name -> {(publisher, routing key): last number}
+
+        # -- Recovery
+        self.closing = False
+        self.local_queues = {}  # queue name given to the caller -> (routing_key, arguments)
+        self.queue_aliases = {}  # queue name given to the caller -> name on the current connection
+        self.consumers = {}  # queue name given to the caller -> (callback, conflate, prefetch_count)
+        self.outbox = collections.deque(maxlen=OUTBOX_MAX_LENGTH)
+        self.reconnect_attempts = 0
+        self.next_reconnect_time = 0.0
+        # While start_consuming runs, only the consuming loop reconnects, see send_message
+        self.consuming = False
+        self.reconnect_requested = False
+        # --
+
 
     def __del__(self):
         self._l.debug("Deleting queues, close channel and connection")
@@ -56,22 +131,79 @@ class Rabbitmq:
         return self
 
     def connect_to_server(self):
+        self.closing = False
         self.connection = pika.BlockingConnection(self.parameters)
         self._l.debug("Connected.")
         self.channel = self.connection.channel()
         self.channel.exchange_declare(exchange=self.exchange_name, exchange_type=self.exchange_type)
 
+    def reconnect(self, blocking=True):
+        """Re-establish the connection, replay the queue bindings and consumers and
+        send the messages buffered during the outage. In-memory state of the owner is untouched.
+        :param blocking: retry with exponential backoff and jitter until connected or closed.
+        If False, make at most one attempt and only once the current backoff delay has passed.
+        :return: True if the connection was re-established
+        :rtype: bool"""
+        while not self.closing:
+            if not blocking and time.monotonic() < self.next_reconnect_time:
+                return False
+            self.__close_connection()
+            try:
+                self.connect_to_server()
+                self.__replay_topology()
+                self.__flush_outbox()
+                self._l.info("Reconnected after %d attempt(s)", self.reconnect_attempts + 1)
+                self.reconnect_attempts = 0
+                self.next_reconnect_time = 0.0
+                return True
+            except RECOVERABLE_ERRORS as exc:
+                delay = random.uniform(0, min(RECONNECT_MAX_DELAY,
+                                              RECONNECT_INITIAL_DELAY * 2 ** self.reconnect_attempts))
+                self.reconnect_attempts += 1
+                self.next_reconnect_time = time.monotonic() + delay
+                self._l.warning("Reconnect attempt %d failed (%s), retrying in %.2f s",
+                                self.reconnect_attempts, exc, delay)
+                if blocking:
+                    time.sleep(delay)
+        return False
+
+    def enable_tracing(self, origin):
+        """Stamp trace headers on sent messages and record the handling of received ones.
+        :param origin: name of the service owning this client"""
+        self.tracer = Tracer(origin, publish=lambda records: self.send_message(ROUTING_KEY_TRACE, records))
+
     def send_message(self, routing_key, message, properties=None):
-        self.channel.basic_publish(exchange=self.exchange_name,
-                                   routing_key=routing_key,
-                                   body=encode_json(message),
-                                   properties=properties
-                                   )
+        if self.tracer is not None:
+            properties = self.tracer.stamp(routing_key, message, properties)
+        properties = self.__stamp_sequence_number(routing_key, properties)
+        body = encode_json(message)
+        if self.outbox and (self.consuming or not self.reconnect(blocking=False)):
+            # Still disconnected, keep the order of the buffered messages
+            self.outbox.append((routing_key, body, properties))
+            return
+        try:
+            self.__publish(routing_key, body, properties)
+        except RECOVERABLE_ERRORS:
+            self._l.warning("Connection lost while sending to %s, buffering message", routing_key)
+            self.outbox.append((routing_key, body, properties))
+            self.__request_reconnect()
+            return
         self._l.debug(f"Message sent to {routing_key}.")
         self._l.debug(message)
 
-    def get_message(self, queue_name):
-        (method, properties, body) = self.channel.basic_get(queue=queue_name, auto_ack=True)
+    def get_message(self, queue_name, timeout=0.0):
+        """Get the oldest message of a queue.
+        :param timeout: time in seconds to wait for a message, 0 returns immediately
+        :return: the decoded message or None if no message arrived in time"""
+        if timeout:
+            return self.__wait_for_message(queue_name, timeout)
+        try:
+            (method, properties, body) = self.channel.basic_get(
+                queue=self.queue_aliases.get(queue_name, queue_name), auto_ack=True)
+        except RECOVERABLE_ERRORS:
+            self._l.warning("Connection lost while getting from %s", queue_name)
+            self.reconnect(blocking=False)
+            return None
 
         self._l.debug(f"Received message is {body} {method} {properties}")
         if body is not None:
@@ -79,10 +211,80 @@ class Rabbitmq:
         else:
             return None
 
-    def declare_local_queue(self, routing_key):
+    def consume(self, routing_key, timeout=None, max_batch=None, stop_event=None):
+        """Generator yielding the decoded messages published on a routing key as they arrive.
+        Messages are pushed by the broker and dispatched by the connection's event processing, no polling.
+        Cancel by leaving the loop (closing the generator), by setting stop_event or through timeout.
+        Do not combine with start_consuming on the same connection.
+        :param routing_key: the routing key to bind to, wildcards are allowed
+        :param timeout: stop after this many seconds without a message, None waits forever
+        :param max_batch: if set, yield lists of up to max_batch messages that have already arrived
+        :param stop_event: optional threading.Event that stops the generator when set"""
+        queue_name = self.declare_local_queue(routing_key=routing_key)
+        inactivity_timeout = CONSUME_POLL_INTERVAL if stop_event is not None else timeout
+        last_message_time = time.monotonic()
+        try:
+            deliveries = self.channel.consume(self.queue_aliases[queue_name], auto_ack=True,
+                                              inactivity_timeout=inactivity_timeout)
+            for method, properties, body in deliveries:
+                if stop_event is not None and stop_event.is_set():
+                    return
+                if method is None:
+                    if timeout is not None and time.monotonic() - last_message_time >= timeout:
+                        return
+                    continue
+                last_message_time = time.monotonic()
+                if max_batch is None:
+                    yield decode_json(body)
+                    continue
+
+                # Drain what is already buffered on the connection without blocking
+                batch = [decode_json(body)]
+                while len(batch) < max_batch and self.channel.get_waiting_message_count():
+                    _, _, body = next(deliveries)
+                    batch.append(decode_json(body))
+                yield batch
+        finally:
+            self.__cancel_consume(queue_name)
+
+    def __wait_for_message(self, queue_name, timeout):
+        """Block until a message is delivered on the queue or the timeout expires"""
+        deliveries = self.channel.consume(self.queue_aliases.get(queue_name, queue_name),
+                                          auto_ack=False, inactivity_timeout=timeout)
+        try:
+            method, properties, body = next(deliveries)
+            if method is None:
+                return None
+            self.channel.basic_ack(delivery_tag=method.delivery_tag)
+            self._l.debug(f"Received message is {body} {method} {properties}")
+            return decode_json(body)
+        finally:
+            # Messages prefetched beyond the first are requeued
+            self.channel.cancel()
+
+    def __cancel_consume(self, queue_name):
+        """Stop a consume generator and delete its queue"""
+        try:
+            self.channel.cancel()
+            self.channel.queue_delete(queue=self.queue_aliases[queue_name])
+        except RECOVERABLE_ERRORS:
+            self._l.debug("Connection was lost before cancelling %s", queue_name)
+        self.local_queues.pop(queue_name, None)
+        current_queue_name = self.queue_aliases.pop(queue_name, queue_name)
+        if current_queue_name in self.queue_name:
+            self.queue_name.remove(current_queue_name)
+
+    def declare_local_queue(self, routing_key, arguments=None):
+        created_queue_name = self.__declare_and_bind(routing_key, arguments)
+        # Remembered to be declared again after a reconnect
+        self.local_queues[created_queue_name] = (routing_key, arguments)
+        self.queue_aliases[created_queue_name] = created_queue_name
+        return created_queue_name
+
+    def __declare_and_bind(self, routing_key, arguments):
         # Creates a local queue.
         # Rabbitmq server will clean it if the connection drops.
-        result = self.channel.queue_declare(queue="", exclusive=True, auto_delete=True)
+        result = self.channel.queue_declare(queue="", exclusive=True, auto_delete=True, arguments=arguments)
         created_queue_name = result.method.queue
         self.channel.queue_bind(
             exchange=self.exchange_name,
@@ -101,26 +303,207 @@ class Rabbitmq:
             self.channel.queue_delete(queue=name)
 
     def close(self):
-        self._l.debug("Deleting created queues by Rabbitmq class")
-        self.queues_delete()
-        self._l.debug("Closing channel in rabbitmq")
-        self.channel.close()
-        self._l.debug("Closing connection in rabbitmq")
-        self.connection.close()
+        if self.tracer is not None:
+            self.tracer.flush()
+        self.closing = True
+        try:
+            self._l.debug("Deleting created queues by Rabbitmq class")
+            self.queues_delete()
+            self._l.debug("Closing channel in rabbitmq")
+            self.channel.close()
+            self._l.debug("Closing connection in rabbitmq")
+            self.connection.close()
+        except RECOVERABLE_ERRORS:
+            self._l.debug("Connection was already closed")
 
-    def subscribe(self, routing_key, on_message_callback):
-        created_queue_name = self.declare_local_queue(routing_key=routing_key)
+    def subscribe(self, routing_key, on_message_callback, conflate=False,
+                  max_length=CONFLATE_MAX_LENGTH, prefetch_count=CONFLATE_PREFETCH_COUNT):
+        """Subscribe to a routing key with a callback taking (ch, method, properties, body_json).
+        :param conflate: only deliver the newest queued message per routing key (last-value semantics)
+        :param max_length: bound of the server side queue when conflating, oldest messages are dropped
+        :param prefetch_count: maximum number of unacknowledged messages in flight when conflating
+        """
+        if self.tracer is not None:
+            on_message_callback = self.tracer.wrap(on_message_callback)
+        arguments = {"x-max-length": max_length, "x-overflow": "drop-head"} if conflate else None
+        created_queue_name = self.declare_local_queue(routing_key=routing_key, arguments=arguments)
+        if conflate:
+            self.dropped_messages[created_queue_name] = 0
+            self.received_sequence_numbers[created_queue_name] = {}
+        self.consumers[created_queue_name] = (on_message_callback, conflate, prefetch_count)
+        self.__consume(created_queue_name, on_message_callback, conflate, prefetch_count)
+        return created_queue_name
+
+    def __consume(self, queue_name, on_message_callback, conflate, prefetch_count):
+        """Register the consumer of a subscription on the current channel"""
+        if conflate:
+            self.__consume_conflated(queue_name, on_message_callback, prefetch_count)
+            return
 
         # Register an intermediate function to decode the msg.
         def decode_msg(ch, method, properties, body):
+            if self.tracer is not None:
+                self.tracer.mark_received(properties)
             body_json = decode_json(body)
             on_message_callback(ch, method, properties, body_json)
 
-        self.channel.basic_consume(queue=created_queue_name,
+        self.channel.basic_consume(queue=self.queue_aliases[queue_name],
                                    on_message_callback=decode_msg,
                                    auto_ack=True)
-        return created_queue_name
+
+    def get_dropped_count(self, queue_name):
+        """Number of messages skipped by conflation on a queue created with subscribe(conflate=True):
+        the messages collapsed by the client, and the messages dropped by the x-max-length bound of
+        the server, detected from gaps in the sequence numbers of the publishers. Messages of
+        publishers not using this class, and the last messages before a publisher restarts, are not seen."""
+        return self.dropped_messages.get(queue_name, 0)
+
+    def __stamp_sequence_number(self, routing_key, properties):
+        """Return properties with the publisher id and the next sequence number of the routing key"""
+        if properties is None:
+            properties = pika.BasicProperties()
+        self.sent_sequence_numbers[routing_key] += 1
+        headers = dict(properties.headers or {})
+        headers[SequenceHeaderKeys.PUBLISHER] = self.publisher_id
+        headers[SequenceHeaderKeys.NUMBER] = self.sent_sequence_numbers[routing_key]
+        properties.headers = headers
+        return properties
+
+    def __count_sequence_gap(self, queue_name, method, properties):
+        """Count the messages of a publisher missing before a delivery as dropped"""
+        headers = properties.headers
+        if not headers or SequenceHeaderKeys.NUMBER not in headers:
+            return
+        received = self.received_sequence_numbers[queue_name]
+        key = (headers[SequenceHeaderKeys.PUBLISHER], method.routing_key)
+        number = headers[SequenceHeaderKeys.NUMBER]
+        last = received.get(key)
+        if last is not None and number > last + 1:
+            self.dropped_messages[queue_name] += number - last - 1
+        if last is None or number > last:
+            received[key] = number
+
+    def get_queue_depth(self, queue_name):
+        """Number of messages waiting on the server in a queue created by this client, 0 for unknown queues.
+        Messages already delivered to the client, e.g. within the prefetch window, are not counted."""
+        if queue_name not in self.queue_aliases:
+            return 0
+        result = self.channel.queue_declare(queue=self.queue_aliases[queue_name], passive=True)
+        return result.method.message_count
+
+    def __consume_conflated(self, created_queue_name, on_message_callback, prefetch_count):
+        """Consume a bounded queue and collapse the queued messages to the newest one per routing key.
+        Messages delivered in the same I/O batch are stashed and only the latest per routing key
+        is passed to the callback once the batch has been dispatched."""
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+        pending = {}
+
+        def flush_pending():
+            latest = sorted(pending.values(), key=lambda msg: msg[1].delivery_tag)
+            pending.clear()
+            if not latest or latest[-1][0] is not self.channel:
+                return  # Nothing to deliver or stale deliveries of a lost connection
+            # Acknowledge the whole batch at once so the broker can refill the prefetch window
+            ch = latest[-1][0]
+            ch.basic_ack(delivery_tag=latest[-1][1].delivery_tag, multiple=True)
+            for ch, method, properties, body in latest:
+                on_message_callback(ch, method, properties, decode_json(body))
+
+        def stash_msg(ch, method, properties, body):
+            if self.tracer is not None:
+                self.tracer.mark_received(properties)
+            if pending and next(iter(pending.values()))[0] is not ch:
+                pending.clear()  # Stale deliveries of a lost connection
+            self.__count_sequence_gap(created_queue_name, method, properties)
+            if not pending:
+                # Fires once the deliveries already buffered on the connection are dispatched
+                self.connection.call_later(0, flush_pending)
+            if method.routing_key in pending:
+                self.dropped_messages[created_queue_name] += 1
+                if self.dropped_messages[created_queue_name] % 100 == 1:
+                    self._l.warning("Conflation dropped %d stale messages on %s",
+                                    self.dropped_messages[created_queue_name], created_queue_name)
+            pending[method.routing_key] = (ch, method, properties, body)
+
+        self.channel.basic_consume(queue=self.queue_aliases[created_queue_name],
+                                   on_message_callback=stash_msg,
+                                   auto_ack=False)
+
+    def add_callback_threadsafe(self, callback):
+        """Run a callback in the thread consuming this connection, may be called from any thread"""
+        self.connection.add_callback_threadsafe(callback)
 
     def start_consuming(self):
-        self.channel.start_consuming()
+        """Consume until all consumers are cancelled or the connection is closed.
+        A lost connection is re-established and consuming resumes on the replayed subscriptions.
+        Connection losses noticed by send_message while consuming are recovered here as well."""
+        while not self.closing:
+            self.consuming = True
+            try:
+                if self.tracer is not None:
+                    self.connection.call_later(TRACE_FLUSH_INTERVAL, self.__flush_traces)
+                self.channel.start_consuming()
+                if not self.reconnect_requested:
+                    return
+            except RECOVERABLE_ERRORS:
+                if self.closing:
+                    return
+                self._l.warning("Connection lost while consuming, reconnecting")
+            finally:
+                self.consuming = False
+            self.reconnect_requested = False
+            self.reconnect()
+
+    def __flush_traces(self):
+        """Publish the trace records of an idle subscription, runs in the consuming thread"""
+        self.tracer.flush_if_due()
+        if self.consuming and not self.closing:
+            self.connection.call_later(TRACE_FLUSH_INTERVAL, self.__flush_traces)
+
+    def __request_reconnect(self):
+        """Reconnect after a failed send. While consuming, e.g. when sending from a consumer callback,
+        the connection must not be replaced under start_consuming: the consuming loop is stopped
+        and reconnects, the message stays in the outbox until then."""
+        if not self.consuming:
+            self.reconnect(blocking=False)
+            return
+        self.reconnect_requested = True
+        try:
+            self.channel.stop_consuming()
+        except Exception:
+            self._l.debug("Consuming already stopped by the lost connection")
+
+    def __close_connection(self):
+        """Close the current connection before it is replaced, so its socket and consumers are released"""
+        if self.connection is None or self.connection.is_closed:
+            return
+        try:
+            self.connection.close()
+        except Exception:
+            self._l.debug("Connection could not be closed cleanly")
+
+    def __publish(self, routing_key, body, properties):
+        self.channel.basic_publish(exchange=self.exchange_name,
+                                   routing_key=routing_key,
+                                   body=body,
+                                   properties=properties
+                                   )
+
+    def __replay_topology(self):
+        """Declare the local queues and consumers again on a new connection.
+        Queue names change, callers keep using the names returned before the reconnect."""
+        self.queue_name = []
+        for queue_name, (routing_key, arguments) in self.local_queues.items():
+            self.queue_aliases[queue_name] = self.__declare_and_bind(routing_key, arguments)
+        for queue_name, (on_message_callback, conflate, prefetch_count) in self.consumers.items():
+            self.__consume(queue_name, on_message_callback, conflate, prefetch_count)
+
+    def __flush_outbox(self):
+        """Send the messages buffered while the connection was down"""
+        self._l.info("Sending %d buffered messages", len(self.outbox))
+        while self.outbox:
+            routing_key, body, properties = self.outbox[0]
+            self.__publish(routing_key, body, properties)
+            self.outbox.popleft()
 
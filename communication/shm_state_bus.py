@@ -0,0 +1,299 @@
+"""Shared-memory transport for the robot state stream of co-located services.
+
+The state messages of a routing key are written by a single writer into a ring buffer of
+fixed-layout records in shared memory (`StateRingBuffer`). Every reader keeps its own cursor,
+so any number of readers can follow the stream without copying through the broker. Each slot
+is protected by a sequence number (seqlock), which lets readers detect records that were
+overwritten while being read.
+
+`SharedMemoryRabbitmq` wraps a broker client and moves the routing keys listed in the
+"shm_routing_keys" key of the rabbitmq config onto shared memory, behind the same
+send_message/subscribe/start_consuming API. Python has no portable futex or eventfd that
+unrelated processes can share, so readers wait by spinning briefly and then sleeping in
+short intervals (see SPIN_TIME and POLL_INTERVAL).
+"""
+import logging
+import re
+import socket
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pika
+
+from communication.protocol import *
+
+# Default number of records in a ring buffer
+RING_CAPACITY = 1024
+
+# Readers spin for SPIN_TIME before sleeping POLL_INTERVAL between checks for new records
+SPIN_TIME = 200e-6 # s
+POLL_INTERVAL = 50e-6 # s
+# Interval between attempts to attach to a ring buffer that has not been created yet
+ATTACH_RETRY_INTERVAL = 0.1 # s
+
+STATE_RECORD_DTYPE = np.dtype([
+    ("seq", np.uint64),
+    (RobotArmStateKeys.TIMESTAMP, np.float64),
+    (RobotArmStateKeys.ACTUAL_Q, np.float64, 6),
+    (RobotArmStateKeys.ACTUAL_QD, np.float64, 6),
+    (RobotArmStateKeys.OPERATION_ID, np.int64),
+    (RobotArmStateKeys.READY, np.bool_),
+    (RobotArmStateKeys.OUTPUT_BIT_REGISTER_65, np.bool_),
+    (RobotArmStateKeys.OUTPUT_BIT_REGISTER_66, np.bool_),
+    # Trace headers (see communication.tracing), send_ns is 0 if the writer does not trace
+    ("send_ns", np.int64),
+    ("origin", "S32"),
+])
+STATE_FIELDS = [name for name in STATE_RECORD_DTYPE.names if name not in ("seq", "send_ns", "origin")]
+
+# Header: write sequence, capacity
+HEADER_DTYPE = np.dtype([("write_seq", np.uint64), ("capacity", np.uint64)])
+HEADER_SIZE = 64 # bytes, keeps the records cache line aligned
+
+# Segments created by this process. The resource tracker is shared by the process, so readers
+# in the process of the writer must not unregister them, the writer does when it unlinks.
+_created_segments = set()
+
+
+def segment_name(exchange, routing_key):
+    """Name of the shared memory segment holding the stream of a routing key"""
+    return re.sub(r"[^A-Za-z0-9_]", "_", f"{exchange}_{routing_key}")
+
+
+class StateRingBuffer:
+    """Single-writer, multi-reader ring buffer of state records in shared memory.
+    :param name: name of the shared memory segment
+    :param capacity: number of records, only used when the segment is created
+    :param create: create the segment (writer) or attach to an existing one (reader)"""
+
+    def __init__(self, name, capacity=RING_CAPACITY, create=False):
+        self.name = name
+        self.owner = False
+        size = HEADER_SIZE + capacity * STATE_RECORD_DTYPE.itemsize
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                self.owner = True
+                _created_segments.add(name)
+            except FileExistsError:
+                # Left by a previous writer, continue its sequence so readers keep their cursors
+                self.shm = shared_memory.SharedMemory(name=name)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            if name not in _created_segments:
+                # Readers must not unlink the segment of the writer when they exit
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        self.header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=self.shm.buf)[0]
+        if self.owner:
+            self.header["write_seq"] = 0
+            self.header["capacity"] = capacity
+        self.capacity = int(self.header["capacity"])
+        self.records = np.ndarray((self.capacity,), dtype=STATE_RECORD_DTYPE,
+                                  buffer=self.shm.buf, offset=HEADER_SIZE)
+
+    def write(self, state, send_ns=0, origin=""):
+        """Append a state message (dict with RobotArmStateKeys), only called by the writer
+        :param send_ns: trace send time, 0 if not traced
+        :param origin: trace origin of the message"""
+        seq = int(self.header["write_seq"])
+        slot = self.records[seq % self.capacity]
+        slot["seq"] = 2 * seq + 1  # odd: write in progress
+        for key in STATE_FIELDS:
+            if key in state:
+                slot[key] = state[key]
+        slot["send_ns"] = send_ns
+        slot["origin"] = origin.encode(ENCODING)[:32]
+        slot["seq"] = 2 * seq + 2
+        self.header["write_seq"] = seq + 1
+
+    def write_seq(self):
+        return int(self.header["write_seq"])
+
+    def read(self, cursor):
+        """Read the records from cursor up to the latest one.
+        :return: (records, new cursor, number of records lost because they were overwritten)"""
+        write_seq = self.write_seq()
+        lost = 0
+        if write_seq - cursor > self.capacity:
+            lost = write_seq - self.capacity - cursor
+            cursor = write_seq - self.capacity
+        records = []
+        while cursor < write_seq:
+            index = cursor % self.capacity
+            record = self.records[index].copy()
+            if record["seq"] == 2 * cursor + 2 and self.records[index]["seq"] == record["seq"]:
+                records.append(record)
+            else:
+                lost += 1  # Overwritten by the writer while reading
+            cursor += 1
+        return records, cursor, lost
+
+    def wait(self, cursor, timeout):
+        """Wait until a record after cursor is written.
+        :return: True if new records are available"""
+        start = time.perf_counter()
+        while self.write_seq() <= cursor:
+            elapsed = time.perf_counter() - start
+            if elapsed >= timeout:
+                return False
+            if elapsed > SPIN_TIME:
+                time.sleep(POLL_INTERVAL)
+        return True
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            _created_segments.discard(self.name)
+
+
+def record_to_state(record):
+    """Convert a state record back to the message dict sent on the broker"""
+    return {
+        RobotArmStateKeys.TIMESTAMP: float(record[RobotArmStateKeys.TIMESTAMP]),
+        RobotArmStateKeys.ACTUAL_Q: record[RobotArmStateKeys.ACTUAL_Q].tolist(),
+        RobotArmStateKeys.ACTUAL_QD: record[RobotArmStateKeys.ACTUAL_QD].tolist(),
+        RobotArmStateKeys.OPERATION_ID: int(record[RobotArmStateKeys.OPERATION_ID]),
+        RobotArmStateKeys.READY: bool(record[RobotArmStateKeys.READY]),
+        RobotArmStateKeys.OUTPUT_BIT_REGISTER_65: bool(record[RobotArmStateKeys.OUTPUT_BIT_REGISTER_65]),
+        RobotArmStateKeys.OUTPUT_BIT_REGISTER_66: bool(record[RobotArmStateKeys.OUTPUT_BIT_REGISTER_66]),
+    }
+
+
+class SharedMemoryRabbitmq:
+    """Broker client moving selected routing keys onto shared memory ring buffers.
+    Other routing keys and all other methods are handled by the wrapped client.
+    Routing keys are matched exactly, wildcards are not supported on shared memory.
+    :param client: the wrapped Rabbitmq or LocalRabbitmq client
+    :param shm_routing_keys: routing keys carried over shared memory
+    :param capacity: number of records of the ring buffers created by this client"""
+
+    def __init__(self, client, shm_routing_keys, capacity=RING_CAPACITY):
+        self._l = logging.getLogger("SharedMemoryRabbitmqClass")
+        self.client = client
+        self.shm_routing_keys = set(shm_routing_keys)
+        self.capacity = capacity
+        self.writers = {}
+        self.subscriptions = []  # (routing_key, callback, conflate)
+        self.broker_subscriptions = 0
+        self.stop_event = threading.Event()
+        self.reader_threads = []
+
+    def __getattr__(self, name):
+        # Everything not related to the shared memory routing keys is done by the wrapped client
+        return getattr(self.client, name)
+
+    def __enter__(self):
+        self.connect_to_server()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def send_message(self, routing_key, message, properties=None):
+        if routing_key not in self.shm_routing_keys:
+            self.client.send_message(routing_key, message, properties)
+            return
+        writer = self.writers.get(routing_key)
+        if writer is None:
+            writer = StateRingBuffer(segment_name(self.client.exchange_name, routing_key),
+                                     self.capacity, create=True)
+            self.writers[routing_key] = writer
+        tracer = self.client.tracer
+        if tracer is None:
+            writer.write(message)
+            return
+        headers = tracer.stamp(routing_key, message).headers
+        writer.write(message, send_ns=headers[TraceHeaderKeys.SEND_TIME], origin=headers[TraceHeaderKeys.ORIGIN])
+
+    def subscribe(self, routing_key, on_message_callback, conflate=False, **kwargs):
+        if routing_key not in self.shm_routing_keys:
+            self.broker_subscriptions += 1
+            return self.client.subscribe(routing_key, on_message_callback, conflate=conflate, **kwargs)
+        if self.client.tracer is not None:
+            on_message_callback = self.client.tracer.wrap(on_message_callback)
+        self.subscriptions.append((routing_key, on_message_callback, conflate))
+        self.client.dropped_messages[segment_name(self.client.exchange_name, routing_key)] = 0
+        return segment_name(self.client.exchange_name, routing_key)
+
+    def start_consuming(self):
+        """Dispatch the shared memory streams and the broker subscriptions.
+        Without broker subscriptions the streams are read in the calling thread, otherwise
+        reader threads hand the messages over to the connection thread."""
+        self.stop_event.clear()
+        if not self.broker_subscriptions and len(self.subscriptions) == 1:
+            self.__read_loop(*self.subscriptions[0], dispatch=lambda callback: callback())
+            return
+
+        dispatch = self.client.add_callback_threadsafe if self.broker_subscriptions else (
+            lambda callback: callback())
+        for subscription in self.subscriptions:
+            thread = threading.Thread(target=self.__read_loop, args=(*subscription, dispatch), daemon=True)
+            thread.start()
+            self.reader_threads.append(thread)
+        if self.broker_subscriptions:
+            self.client.start_consuming()
+        else:
+            for thread in self.reader_threads:
+                thread.join()
+
+    def close(self):
+        self.stop_event.set()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        self.client.close()
+
+    def __read_loop(self, routing_key, on_message_callback, conflate, dispatch):
+        """Follow a ring buffer and pass its records to the callback"""
+        name = segment_name(self.client.exchange_name, routing_key)
+        reader = self.__attach(name)
+        if reader is None:
+            return
+        cursor = reader.write_seq()  # Like a new queue, only messages sent from now on
+        delivery_tag = 0
+        while not self.stop_event.is_set():
+            if not reader.wait(cursor, timeout=ATTACH_RETRY_INTERVAL):
+                continue
+            records, cursor, lost = reader.read(cursor)
+            if conflate and len(records) > 1:
+                lost += len(records) - 1
+                records = records[-1:]
+            if lost:
+                self.client.dropped_messages[name] += lost
+            for record in records:
+                delivery_tag += 1
+                method = pika.spec.Basic.Deliver(delivery_tag=delivery_tag,
+                                                 exchange=self.client.exchange_name,
+                                                 routing_key=routing_key)
+                state = record_to_state(record)
+                properties = self.__trace_properties(record, state)
+                dispatch(lambda method=method, properties=properties, state=state:
+                         on_message_callback(self, method, properties, state))
+        reader.close()
+
+    def __trace_properties(self, record, state):
+        """Properties carrying the trace headers of a record, like a message received from the broker"""
+        properties = pika.BasicProperties()
+        if not record["send_ns"] or self.client.tracer is None:
+            return properties
+        properties.headers = {
+            TraceHeaderKeys.ORIGIN: record["origin"].decode(ENCODING),
+            TraceHeaderKeys.HOST: socket.gethostname(),  # Shared memory is local to the host
+            TraceHeaderKeys.OPERATION_ID: state[RobotArmStateKeys.OPERATION_ID],
+            TraceHeaderKeys.SEND_TIME: int(record["send_ns"]),
+        }
+        self.client.tracer.mark_received(properties)
+        return properties
+
+    def __attach(self, name):
+        """Attach to a ring buffer, waiting until the writer has created it"""
+        while not self.stop_event.is_set():
+            try:
+                return StateRingBuffer(name)
+            except FileNotFoundError:
+                time.sleep(ATTACH_RETRY_INTERVAL)
+        return None
@@ -0,0 +1,196 @@
+"""Latency tracing of the messages exchanged between the services.
+
+A `Tracer` attached to a Rabbitmq client (see `create_rabbitmq`) stamps the origin service, host,
+causal operation id and a monotonic send time into the AMQP headers of every sent message.
+On the receiving side it stamps the receive time and the start and end of the handler, and
+publishes the completed trace records on `ROUTING_KEY_TRACE`. The `TraceCollector` turns the
+records into per-hop latency histograms and estimates the clock offset between hosts.
+"""
+import collections
+import socket
+import time
+
+import numpy as np
+import pika
+
+from communication.protocol import *
+
+# Number of trace records buffered by a service before they are published
+TRACE_FLUSH_SIZE = 100
+# Maximum age of a buffered trace record in seconds, checked on every traced message and
+# periodically while consuming, so the records of low-rate traffic are published as well
+TRACE_FLUSH_INTERVAL = 1.0
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket is unbounded
+LATENCY_BUCKETS = [
+    50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3, 250e-3, 500e-3, 1.0, np.inf
+]
+
+# Hops of a traced message
+HOP_TRANSIT = "transit"  # send -> receive, includes the broker
+HOP_QUEUEING = "queueing"  # receive -> handler start
+HOP_HANDLER = "handler"  # handler start -> handler end
+
+
+class Tracer:
+    """Stamps trace headers on sent messages and records the timing of handled messages.
+    :param origin: name of the service, e.g. "controller"
+    :param publish: function publishing a list of trace records"""
+
+    def __init__(self, origin, publish):
+        self.origin = origin
+        self.host = socket.gethostname()
+        self.publish = publish
+        self.records = []
+        self.oldest_record_time = None  # Monotonic time in s the oldest buffered record was added
+
+    def stamp(self, routing_key, message, properties=None):
+        """Return properties with the trace headers of a message about to be sent"""
+        if routing_key == ROUTING_KEY_TRACE:
+            return properties
+        self.flush_if_due()
+        if properties is None:
+            properties = pika.BasicProperties()
+        headers = dict(properties.headers or {})
+        headers[TraceHeaderKeys.ORIGIN] = self.origin
+        headers[TraceHeaderKeys.HOST] = self.host
+        if isinstance(message, dict):
+            headers[TraceHeaderKeys.OPERATION_ID] = message.get(RobotArmStateKeys.OPERATION_ID)
+        headers[TraceHeaderKeys.SEND_TIME] = time.monotonic_ns()
+        properties.headers = headers
+        return properties
+
+    def mark_received(self, properties):
+        """Stamp the time a message was received from the connection"""
+        if properties.headers is not None and TraceHeaderKeys.SEND_TIME in properties.headers:
+            properties.headers[TraceHeaderKeys.RECEIVE_TIME] = time.monotonic_ns()
+
+    def wrap(self, on_message_callback):
+        """Wrap a subscription callback so the handler start and end times are recorded"""
+
+        def traced_callback(ch, method, properties, body_json):
+            start = time.monotonic_ns()
+            on_message_callback(ch, method, properties, body_json)
+            end = time.monotonic_ns()
+
+            headers = properties.headers
+            if headers is None or TraceHeaderKeys.SEND_TIME not in headers:
+                return  # Sender does not trace
+            self.records.append({
+                TraceRecordKeys.ORIGIN: headers[TraceHeaderKeys.ORIGIN],
+                TraceRecordKeys.ORIGIN_HOST: headers[TraceHeaderKeys.HOST],
+                TraceRecordKeys.RECEIVER: self.origin,
+                TraceRecordKeys.RECEIVER_HOST: self.host,
+                TraceRecordKeys.ROUTING_KEY: method.routing_key,
+                TraceRecordKeys.OPERATION_ID: headers.get(TraceHeaderKeys.OPERATION_ID),
+                TraceRecordKeys.SEND_TIME: headers[TraceHeaderKeys.SEND_TIME],
+                TraceRecordKeys.RECEIVE_TIME: headers.get(TraceHeaderKeys.RECEIVE_TIME, start),
+                TraceRecordKeys.HANDLE_START_TIME: start,
+                TraceRecordKeys.HANDLE_END_TIME: end,
+            })
+            if self.oldest_record_time is None:
+                self.oldest_record_time = time.monotonic()
+            if len(self.records) >= TRACE_FLUSH_SIZE:
+                self.flush()
+            else:
+                self.flush_if_due()
+
+        return traced_callback
+
+    def flush_if_due(self):
+        """Publish the buffered trace records if the oldest is older than TRACE_FLUSH_INTERVAL"""
+        if self.oldest_record_time is not None and time.monotonic() - self.oldest_record_time >= TRACE_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Publish the buffered trace records"""
+        if self.records:
+            records, self.records = self.records, []
+            self.oldest_record_time = None
+            self.publish(records)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram, see LATENCY_BUCKETS"""
+
+    def __init__(self):
+        self.counts = np.zeros(len(LATENCY_BUCKETS), dtype=np.int64)
+        self.total = 0.0
+
+    def add(self, latencies):
+        """Add latencies given in seconds"""
+        latencies = np.asarray(latencies, dtype=float)
+        self.counts += np.bincount(np.searchsorted(LATENCY_BUCKETS, latencies),
+                                   minlength=len(LATENCY_BUCKETS))[:len(LATENCY_BUCKETS)]
+        self.total += latencies.sum()
+
+    def count(self):
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        if not self.count():
+            return None
+        index = np.searchsorted(np.cumsum(self.counts), q * self.count())
+        return LATENCY_BUCKETS[min(index, len(LATENCY_BUCKETS) - 1)]
+
+    def summary(self):
+        count = self.count()
+        return {
+            "count": count,
+            "mean": self.total / count if count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS], self.counts.tolist())),
+        }
+
+
+class TraceCollector:
+    """Aggregates trace records into per-hop latency histograms.
+    Hops are keyed by (origin, receiver, routing_key). Monotonic clocks of different hosts
+    are not comparable, so the transit time between hosts is corrected with an offset estimated
+    from the minimum one-way delay observed in both directions (as in NTP)."""
+
+    def __init__(self):
+        self.histograms = collections.defaultdict(lambda: collections.defaultdict(LatencyHistogram))
+        # (origin_host, receiver_host) -> minimum of receive - send in ns
+        self.min_delays = {}
+
+    def on_trace_records(self, ch, method, properties, body_json):
+        """Subscription callback for ROUTING_KEY_TRACE"""
+        self.add_records(body_json)
+
+    def add_records(self, records):
+        for record in records:
+            hosts = (record[TraceRecordKeys.ORIGIN_HOST], record[TraceRecordKeys.RECEIVER_HOST])
+            delay = record[TraceRecordKeys.RECEIVE_TIME] - record[TraceRecordKeys.SEND_TIME]
+            self.min_delays[hosts] = min(delay, self.min_delays.get(hosts, delay))
+
+            hop = (record[TraceRecordKeys.ORIGIN], record[TraceRecordKeys.RECEIVER],
+                   record[TraceRecordKeys.ROUTING_KEY])
+            transit = delay - self.clock_offset(*hosts)
+            queueing = record[TraceRecordKeys.HANDLE_START_TIME] - record[TraceRecordKeys.RECEIVE_TIME]
+            handler = record[TraceRecordKeys.HANDLE_END_TIME] - record[TraceRecordKeys.HANDLE_START_TIME]
+            self.histograms[hop][HOP_TRANSIT].add([from_ns_to_s(transit)])
+            self.histograms[hop][HOP_QUEUEING].add([from_ns_to_s(queueing)])
+            self.histograms[hop][HOP_HANDLER].add([from_ns_to_s(handler)])
+
+    def clock_offset(self, origin_host, receiver_host):
+        """Estimated offset in ns of the receiver clock relative to the origin clock.
+        0 on the same host or until messages have been seen in both directions."""
+        if origin_host == receiver_host:
+            return 0
+        forward = self.min_delays.get((origin_host, receiver_host))
+        backward = self.min_delays.get((receiver_host, origin_host))
+        if forward is None or backward is None:
+            return 0
+        return (forward - backward) // 2
+
+    def report(self):
+        """Summary of every hop: {"origin->receiver [routing_key]": {hop: summary}}"""
+        return {
+            f"{origin}->{receiver} [{routing_key}]": {
+                hop: histogram.summary() for hop, histogram in hops.items()
+            }
+            for (origin, receiver, routing_key), hops in self.histograms.items()
+        }
@@ -0,0 +1,203 @@
+import collections
+import logging
+import threading
+import time
+from queue import Queue, Empty
+
+import numpy as np
+
+from communication.rabbitmq import create_rabbitmq
+import communication.protocol as protocol
+from models.timing_model.timing_model import TimingModel
+from models.kinematic_model.kinematic_model import KinematicModel
+import models.kinematic_model.km_config as km_config
+
+# Number of predicted trajectories kept in the cache
+TRAJECTORY_CACHE_SIZE = 256
+# Decimals of the joint positions in the cache keys
+TRAJECTORY_KEY_DECIMALS = 6
+
+
+class TrajectoryCache:
+    """Predicted trajectories of the moves, computed once per (start, target) pair.
+    :param speedup: Speedup factor of the robot arm (mockup), 1 for the real robot
+    :param max_size: Number of trajectories kept, the least recently used are evicted"""
+
+    def __init__(self, timing_model, kinematic_model, speedup=1.0, max_size=TRAJECTORY_CACHE_SIZE):
+        self.timing_model = timing_model
+        self.kinematic_model = kinematic_model
+        self.speedup = speedup
+        self.max_size = max_size
+        self.trajectories = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, start_q, target_q):
+        """Trajectory of a move as (q, qd) arrays sampled every km_config.dt, like RobotArmMockup"""
+        key = (tuple(np.round(start_q, TRAJECTORY_KEY_DECIMALS)), tuple(np.round(target_q, TRAJECTORY_KEY_DECIMALS)))
+        trajectory = self.trajectories.get(key)
+        if trajectory is not None:
+            self.hits += 1
+            self.trajectories.move_to_end(key)
+            return trajectory
+
+        self.misses += 1
+        duration = self.timing_model.compute_duration_between_jps(start_q, target_q) / self.speedup
+        rtb_trajectory = self.kinematic_model.compute_trajectory(start_q, target_q, duration)
+        trajectory = (np.asarray(rtb_trajectory.q), np.asarray(rtb_trajectory.qd))
+        self.trajectories[key] = trajectory
+        if len(self.trajectories) > self.max_size:
+            self.trajectories.popitem(last=False)
+        return trajectory
+
+
+class DigitalShadow:
+    """Predicts the state stream of the robot arm from the commands of the controller
+    and publishes it on ROUTING_KEY_DT_STATE at the rate of the PT state stream.
+    The operations are predicted with the semantics of RobotArmMockup, assuming every grip finds a block.
+    :param rmq_config: Rabbitmq configuration
+    :param initial_q: Initial joint positions of the robot arm
+    :param speedup: Speedup factor of the robot arm (mockup), 1 for the real robot
+    :param publish_freq: Frequency at which the predicted state is published
+    :param timing_correction_config: Learned correction of the move durations
+    (digital_twin.timing_correction), no correction if None or without a model"""
+
+    def __init__(
+        self,
+        rmq_config,
+        initial_q,
+        speedup=1.0,
+        publish_freq=20,
+        timing_correction_config=None,
+    ):
+        self.logger = logging.getLogger("DigitalShadow")
+
+        # need two rmqs as pika is not thread safe
+        self.rmq_out = create_rabbitmq(rmq_config, origin="digital_shadow")
+        self.rmq_in = create_rabbitmq(rmq_config, origin="digital_shadow")
+
+        self.timing_model = TimingModel()
+        if timing_correction_config and timing_correction_config["model"]:
+            # Imported on demand, the learned correction requires torch
+            from dt.utils.timing_correction import create_corrected_timing_model
+            self.timing_model = create_corrected_timing_model(timing_correction_config)
+        self.kinematic_model = KinematicModel()
+        self.trajectory_cache = TrajectoryCache(self.timing_model, self.kinematic_model, speedup)
+
+        self.speedup = speedup
+        self.publish_interval = 1.0 / (publish_freq * speedup)
+        self.predicted_q = list(initial_q)  # Joint positions at the end of the last predicted operation
+        self.state = {
+            protocol.RobotArmStateKeys.READY: True,
+            protocol.RobotArmStateKeys.ACTUAL_Q: list(initial_q),
+            protocol.RobotArmStateKeys.ACTUAL_QD: [0] * 6,
+            protocol.RobotArmStateKeys.TIMESTAMP: 0.0,
+            protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_65: False,
+            protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66: False,
+            protocol.RobotArmStateKeys.OPERATION_ID: 0,
+        }
+
+        self.operation_queue = Queue()
+        self.state_pub_thread = threading.Thread(
+            target=self.__publish_state_loop, daemon=True
+        )
+        self.stop_pub_event = threading.Event()
+
+    def setup(self):
+        """Setup rmq subscriptions and start the state publishing thread"""
+        self.rmq_out.connect_to_server()
+        self.rmq_in.connect_to_server()
+
+        self.rmq_in.subscribe(
+            routing_key=protocol.ROUTING_KEY_CTRL,  # For control messages
+            on_message_callback=self.__predict_operation,
+        )
+        self.state_pub_thread.start()
+
+    def start(self):
+        """Start consuming messages from the rmq"""
+        try:
+            self.rmq_in.start_consuming()
+        except Exception:
+            self.logger.exception("Error while consuming messages")
+            self.cleanup()
+
+    def cleanup(self):
+        """Stop the state publishing thread and rmq"""
+        self.stop_pub_event.set()
+        self.state_pub_thread.join()
+        if self.timing_model.correction is not None:
+            self.timing_model.correction.stop()
+        self.rmq_in.close()
+        self.rmq_out.close()
+
+    def __predict_operation(self, ch, method, properties, body_json):
+        """Compute the prediction of a control message and queue it for publishing.
+        Predictions are (operation_id, type, duration, q, qd), q and qd are None without a move"""
+        operation_id = body_json[protocol.CtrlMsgKeys.OPERATION_ID]
+        operation_type = body_json[protocol.CtrlMsgKeys.TYPE]
+        q = qd = None
+        duration = 0.0
+        if operation_type == protocol.CtrlMsgFields.MOVEJ:
+            target_q = body_json[protocol.CtrlMsgKeys.JOINT_POSITIONS]
+            q, qd = self.trajectory_cache.get(self.predicted_q, target_q)
+            duration = len(q) * km_config.dt
+            self.predicted_q = list(target_q)
+        elif operation_type == protocol.CtrlMsgFields.GRIP:
+            duration = self.timing_model.grip_duration / self.speedup
+        elif operation_type == protocol.CtrlMsgFields.MOVE_GRIPPER:
+            duration = (self.timing_model.gripper_full_move_duration
+                        * body_json[protocol.CtrlMsgKeys.GRIPPER_POSITION] / self.speedup)
+
+        self.operation_queue.put((operation_id, operation_type, duration, q, qd))
+
+    def __publish_state_loop(self):
+        """Publish the predicted state at a fixed interval"""
+        pending = collections.deque()
+        operation = None
+        start_time = 0.0
+        while not self.stop_pub_event.is_set():
+            while True:
+                try:
+                    prediction = self.operation_queue.get_nowait()
+                except Empty:
+                    break
+                if prediction[1] == protocol.CtrlMsgFields.ABORT_OPERATION:
+                    pending.clear()
+                    operation = None
+                    self.state[protocol.RobotArmStateKeys.READY] = True
+                    self.state[protocol.RobotArmStateKeys.OPERATION_ID] = prediction[0]
+                else:
+                    pending.append(prediction)
+
+            now = time.monotonic()
+            if operation is None and pending:
+                operation = pending.popleft()
+                start_time = now
+                self.state[protocol.RobotArmStateKeys.READY] = False
+            if operation is not None:
+                operation = self.__advance(operation, now - start_time)
+
+            self.state[protocol.RobotArmStateKeys.TIMESTAMP] += self.publish_interval
+            self.rmq_out.send_message(protocol.ROUTING_KEY_DT_STATE, self.state)
+            time.sleep(self.publish_interval)
+
+    def __advance(self, operation, elapsed):
+        """Update the state with the prediction of the active operation.
+        :return: the operation, None once it is finished"""
+        operation_id, operation_type, duration, q, qd = operation
+        if q is not None and len(q):
+            # O(1) lookup in the precomputed trajectory
+            step = min(int(elapsed / km_config.dt), len(q) - 1)
+            self.state[protocol.RobotArmStateKeys.ACTUAL_Q] = q[step].tolist()
+            self.state[protocol.RobotArmStateKeys.ACTUAL_QD] = qd[step].tolist()
+        if elapsed < duration:
+            return operation
+
+        if operation_type == protocol.CtrlMsgFields.GRIP:
+            self.state[protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66] = True
+        elif operation_type == protocol.CtrlMsgFields.MOVE_GRIPPER:
+            self.state[protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66] = False
+        self.state[protocol.RobotArmStateKeys.READY] = True
+        self.state[protocol.RobotArmStateKeys.OPERATION_ID] = operation_id
+        return None
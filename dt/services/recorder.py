@@ -0,0 +1,334 @@
+"""Recorder persisting the message streams of the broker for offline analysis.
+
+Each routing key is recorded as a stream of chunks. A chunk holds up to `flush_size` messages as
+compressed columns (an .npz archive, without pickled objects), and chunks are appended to segment
+files that are rotated every `rotation_interval` seconds. Every chunk is listed in `index.jsonl`
+with its segment, byte range, row count and time range, so reads only decompress the chunks
+overlapping the requested time range. `load_recording` returns the same interface as the CSV
+logs of `dt.utils.log_loader`.
+
+The consumer only copies each message into a preallocated buffer. Full buffers, and every
+`flush_interval` all buffers, also while the streams are quiet, are handed to a writer thread
+through a bounded queue. If the disk cannot keep up, whole chunks are dropped and
+counted instead of slowing down the consumer.
+"""
+import io
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import numpy as np
+
+from communication.rabbitmq import create_rabbitmq
+import communication.protocol as protocol
+from dt.utils.log_loader import RobotLog
+
+INDEX_FILE = "index.jsonl"
+SEGMENT_SUFFIX = ".seg"
+
+# Number of chunks waiting for the writer before new chunks are dropped
+WRITE_QUEUE_SIZE = 16
+
+# Column layouts of the recorded messages, "received" is the wall time of reception
+STATE_RECORD_DTYPE = np.dtype([
+    ("received", np.float64),
+    (protocol.RobotArmStateKeys.TIMESTAMP, np.float64),
+    (protocol.RobotArmStateKeys.ACTUAL_Q, np.float64, 6),
+    (protocol.RobotArmStateKeys.ACTUAL_QD, np.float64, 6),
+    (protocol.RobotArmStateKeys.OPERATION_ID, np.int64),
+    (protocol.RobotArmStateKeys.READY, np.bool_),
+    (protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_65, np.bool_),
+    (protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66, np.bool_),
+])
+
+CTRL_RECORD_DTYPE = np.dtype([
+    ("received", np.float64),
+    (protocol.RobotArmStateKeys.TIMESTAMP, np.float64),  # Time of reception, control messages have no timestamp
+    (protocol.CtrlMsgKeys.OPERATION_ID, np.int64),
+    (protocol.CtrlMsgKeys.TYPE, "U16"),
+    (protocol.CtrlMsgKeys.JOINT_POSITIONS, np.float64, 6),  # NaN without a move
+    (protocol.CtrlMsgKeys.GRIPPER_POSITION, np.float64),  # NaN without a gripper move
+])
+
+# Messages without a fixed layout, e.g. DT messages, are recorded as JSON text
+MESSAGE_COLUMN = "message"
+
+
+def stream_name(routing_key):
+    return re.sub(r"[^A-Za-z0-9_]", "_", routing_key)
+
+
+def state_row(received, body):
+    return (
+        received,
+        body[protocol.RobotArmStateKeys.TIMESTAMP],
+        body[protocol.RobotArmStateKeys.ACTUAL_Q],
+        body[protocol.RobotArmStateKeys.ACTUAL_QD],
+        body[protocol.RobotArmStateKeys.OPERATION_ID],
+        body[protocol.RobotArmStateKeys.READY],
+        body[protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_65],
+        body[protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66],
+    )
+
+
+def ctrl_row(received, body):
+    return (
+        received,
+        received,
+        body[protocol.CtrlMsgKeys.OPERATION_ID],
+        body[protocol.CtrlMsgKeys.TYPE],
+        body.get(protocol.CtrlMsgKeys.JOINT_POSITIONS, [np.nan] * 6),
+        body.get(protocol.CtrlMsgKeys.GRIPPER_POSITION, np.nan),
+    )
+
+
+# Routing key -> (record dtype, row function), other routing keys are recorded as JSON text
+RECORD_LAYOUTS = {
+    protocol.ROUTING_KEY_STATE: (STATE_RECORD_DTYPE, state_row),
+    protocol.ROUTING_KEY_DT_STATE: (STATE_RECORD_DTYPE, state_row),
+    protocol.ROUTING_KEY_CTRL: (CTRL_RECORD_DTYPE, ctrl_row),
+}
+
+
+class StreamBuffer:
+    """In-memory chunk of one routing key.
+    :param routing_key: the recorded routing key
+    :param flush_size: maximum number of messages in a chunk"""
+
+    def __init__(self, routing_key, flush_size):
+        self.routing_key = routing_key
+        self.stream = stream_name(routing_key)
+        self.flush_size = flush_size
+        self.layout = RECORD_LAYOUTS.get(routing_key)
+        self.rows = None
+        self.count = 0
+        self.reset()
+
+    def reset(self):
+        if self.layout is None:
+            self.rows = []
+        else:
+            self.rows = np.zeros(self.flush_size, dtype=self.layout[0])
+        self.count = 0
+
+    def append(self, received, body):
+        """Add a message, return True once the chunk is full"""
+        if self.layout is None:
+            timestamp = body.get(protocol.RobotArmStateKeys.TIMESTAMP, received) if isinstance(body, dict) else received
+            self.rows.append((received, timestamp, json.dumps(body)))
+        else:
+            self.rows[self.count] = self.layout[1](received, body)
+        self.count += 1
+        return self.count >= self.flush_size
+
+    def take(self):
+        """Columns of the buffered messages, the buffer is emptied"""
+        if self.layout is None:
+            received, timestamps, messages = zip(*self.rows)
+            columns = {
+                "received": np.array(received, dtype=np.float64),
+                protocol.RobotArmStateKeys.TIMESTAMP: np.array(timestamps, dtype=np.float64),
+                MESSAGE_COLUMN: np.array(messages, dtype=np.str_),
+            }
+        else:
+            rows = self.rows[:self.count]
+            columns = {name: rows[name] for name in rows.dtype.names}
+        self.reset()
+        return columns
+
+
+class Recorder:
+    """Records routing keys of the broker into chunked, compressed, append-only files.
+    :param rmq_config: Rabbitmq configuration
+    :param directory: directory of the segments and the index
+    :param routing_keys: recorded routing keys, may contain wildcards. Every delivered routing key
+    is recorded as its own stream
+    :param flush_size: maximum number of messages of a routing key in one chunk
+    :param flush_interval: maximum time in seconds messages are kept in memory
+    :param rotation_interval: time in seconds after which a new segment file is started"""
+
+    def __init__(self, rmq_config, directory, routing_keys, flush_size=5000, flush_interval=5.0,
+                 rotation_interval=3600.0):
+        self.logger = logging.getLogger("Recorder")
+        self.rmq = create_rabbitmq(rmq_config, origin="recorder")
+        self.directory = directory
+        self.routing_keys = list(routing_keys)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.rotation_interval = rotation_interval
+
+        self.buffers = {}  # Delivered routing key -> StreamBuffer, created with the first message
+        self.last_flush_time = time.monotonic()
+        self.dropped_chunks = 0
+
+        self.write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.writer_thread = threading.Thread(target=self.__write_loop, daemon=True)
+        # Triggers the flush of quiet streams in the consuming thread, the buffers are not thread safe
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self.__flush_timer_loop, daemon=True)
+        self.segments = {}  # stream -> (segment start, file)
+
+    def setup(self):
+        """Setup rmq subscriptions and start the writer and flush threads"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.rmq.connect_to_server()
+        for routing_key in self.routing_keys:
+            self.rmq.subscribe(
+                routing_key=routing_key,
+                on_message_callback=self.__record,
+            )
+        self.writer_thread.start()
+        self.flush_thread.start()
+
+    def start(self):
+        """Start consuming messages from the rmq"""
+        try:
+            self.rmq.start_consuming()
+        except Exception:
+            self.logger.exception("Error while consuming messages")
+            self.cleanup()
+
+    def cleanup(self):
+        """Write the buffered messages and close the files and the rmq connection.
+        Must be called from the consuming thread, or after consuming has stopped."""
+        self.stop_event.set()
+        if self.flush_thread.is_alive():
+            self.flush_thread.join()
+        if self.writer_thread.is_alive():
+            for buffer in self.buffers.values():
+                self.__flush(buffer, block=True)
+            self.write_queue.put(None)
+            self.writer_thread.join()
+        self.rmq.close()
+
+    def __record(self, ch, method, properties, body_json):
+        """Copy a message into the buffer of its routing key"""
+        buffer = self.buffers.get(method.routing_key)
+        if buffer is None:
+            buffer = self.buffers[method.routing_key] = StreamBuffer(method.routing_key, self.flush_size)
+        if buffer.append(time.time(), body_json):
+            self.__flush(buffer)
+        self.__flush_if_due()
+
+    def __flush_if_due(self):
+        """Flush all buffers if the last periodic flush is flush_interval ago"""
+        now = time.monotonic()
+        if now - self.last_flush_time >= self.flush_interval:
+            self.last_flush_time = now
+            for buffer in self.buffers.values():
+                self.__flush(buffer)
+
+    def __flush_timer_loop(self):
+        """Schedule the periodic flush in the consuming thread, so quiet streams are written as well"""
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.rmq.add_callback_threadsafe(self.__flush_if_due)
+            except Exception:
+                self.logger.debug("Could not schedule the periodic flush", exc_info=True)
+
+    def __flush(self, buffer, block=False):
+        """Hand the chunk of a buffer over to the writer thread"""
+        if not buffer.count:
+            return
+        chunk = (buffer.stream, buffer.take())
+        try:
+            self.write_queue.put(chunk, block=block)
+        except queue.Full:
+            self.dropped_chunks += 1
+            self.logger.warning("Writer is behind, dropped a chunk of %s (%d dropped)",
+                                buffer.routing_key, self.dropped_chunks)
+
+    def __write_loop(self):
+        """Compress the chunks and append them to the segments"""
+        with open(os.path.join(self.directory, INDEX_FILE), "a") as index:
+            while True:
+                chunk = self.write_queue.get()
+                if chunk is None:
+                    break
+                stream, columns = chunk
+                self.__write_chunk(index, stream, columns)
+        for _, segment in self.segments.values():
+            segment.close()
+
+    def __write_chunk(self, index, stream, columns):
+        data = io.BytesIO()
+        np.savez_compressed(data, **columns)
+        segment_name, segment = self.__segment(stream)
+        offset = segment.tell()
+        segment.write(data.getbuffer())
+        segment.flush()
+
+        timestamps = columns[protocol.RobotArmStateKeys.TIMESTAMP]
+        index.write(json.dumps({
+            "stream": stream,
+            "segment": segment_name,
+            "offset": offset,
+            "length": data.getbuffer().nbytes,
+            "rows": len(timestamps),
+            "start": float(timestamps.min()),
+            "end": float(timestamps.max()),
+        }) + "\n")
+        index.flush()
+
+    def __segment(self, stream):
+        """Segment file of a stream, a new one is started every rotation_interval"""
+        now = time.time()
+        start, segment = self.segments.get(stream, (None, None))
+        if segment is None or now - start >= self.rotation_interval:
+            if segment is not None:
+                segment.close()
+            start = now
+            name = f"{stream}-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}{SEGMENT_SUFFIX}"
+            segment = open(os.path.join(self.directory, name), "ab")
+            self.segments[stream] = (start, segment)
+        return os.path.basename(segment.name), segment
+
+
+class RecordedLog(RobotLog):
+    """Columns of a recorded stream, with the interface of the CSV logs (see `RobotLog`)
+    :param columns: name -> array, all with the same number of rows"""
+
+    def __init__(self, columns):
+        self.cache_dir = None
+        self.columns = columns
+        self.rows = len(next(iter(columns.values()))) if columns else 0
+        timestamps = columns.get(protocol.RobotArmStateKeys.TIMESTAMP)
+        self.meta = {"rows": self.rows,
+                     "sorted": timestamps is None or bool(np.all(np.diff(timestamps) >= 0))}
+
+
+def load_recording(directory, routing_key, start=None, end=None):
+    """Load the messages of a routing key with start <= timestamp < end
+    Only the chunks overlapping the time range are read and decompressed.
+    :return: RecordedLog"""
+    stream = stream_name(routing_key)
+    chunks = []
+    with open(os.path.join(directory, INDEX_FILE)) as index:
+        for line in index:
+            entry = json.loads(line)
+            if entry["stream"] != stream:
+                continue
+            if (start is not None and entry["end"] < start) or (end is not None and entry["start"] >= end):
+                continue
+            with open(os.path.join(directory, entry["segment"]), "rb") as segment:
+                segment.seek(entry["offset"])
+                data = segment.read(entry["length"])
+            with np.load(io.BytesIO(data)) as archive:
+                chunks.append({name: archive[name] for name in archive.files})
+
+    if not chunks:
+        return RecordedLog({})
+    columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+    timestamps = columns[protocol.RobotArmStateKeys.TIMESTAMP]
+    selected = np.ones(len(timestamps), dtype=bool)
+    if start is not None:
+        selected &= timestamps >= start
+    if end is not None:
+        selected &= timestamps < end
+    if not selected.all():
+        columns = {name: column[selected] for name, column in columns.items()}
+    return RecordedLog(columns)
@@ -1,4 +1,4 @@
-from communication.rabbitmq import Rabbitmq
+from communication.rabbitmq import create_rabbitmq
 import communication.protocol as protocol
 import models.robot_visualizer.robot_visualizer as rv
 
@@ -8,7 +8,7 @@ class RobotVisualization:
     :param rmq_config: Rabbitmq configuration"""
 
     def __init__(self, rmq_config):
-        self.rmq = Rabbitmq(**rmq_config)
+        self.rmq = create_rabbitmq(rmq_config, origin="robot_visualization")
         self.visualizer = rv.RobotVisualizer()
 
     def setup(self):
@@ -17,6 +17,7 @@ class RobotVisualization:
         self.rmq.subscribe(
             routing_key=protocol.ROUTING_KEY_STATE,
             on_message_callback=self.__update_robot_position,
+            conflate=True,  # Only the latest position is displayed
         )
         self.visualizer.start_application()
 
@@ -36,4 +37,4 @@ class RobotVisualization:
     def __update_robot_position(self, ch, method, properties, body):
         """Callback function for updating the robot position in the robot visualizer."""
         joint_position = body[protocol.RobotArmStateKeys.ACTUAL_Q]
-        self.visualizer.publish_joint_positions(joint_position)
+        self.visualizer.publish_joint_positions(joint_position, body[protocol.RobotArmStateKeys.TIMESTAMP])
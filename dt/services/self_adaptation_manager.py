@@ -1,31 +1,66 @@
+import logging
+import time
 from typing import Any
 
-from communication.rabbitmq import Rabbitmq
+from communication.rabbitmq import create_rabbitmq
 import communication.protocol as protocol
 from models.timing_model.timing_model import TimingModel
 from models.kinematic_model.kinematic_model import KinematicModel
 from models.spatial_model.spatial_model import SpatialModel
+from dt.utils.residual_monitor import ResidualMonitor, ResidualFault
+from dt.utils.operation_watchdog import OperationWatchdog, WatchdogFault
+from dt.utils.replanner import MissingBlockReplanner
+from dt.utils.what_if import WhatIfEvaluator
+
+# Id of the watched robot arm
+ARM_ID = "robot_arm"
 
 
 class SelfAdaptationManager():
-    """description.
-    :param name: description
+    """Compares the PT state stream with the DT prediction of the active operation
+    and adapts the task when a fault is detected.
+    :param rmq_config: Rabbitmq configuration
+    :param task_spec_name: Name of the task specification executed by the controller
+    :param speedup: Speedup factor of the robot arm (mockup), 1 for the real robot
+    :param what_if_config: Configuration of the what-if evaluation of the recovery plans
+    (deadline, workers), the next stock block is used if None
+    :param timing_correction_config: Learned correction of the move durations
+    (digital_twin.timing_correction), no correction if None or without a model
     """
 
     def __init__(
         self,
         rmq_config,
+        task_spec_name,
+        speedup=1.0,
+        what_if_config=None,
+        timing_correction_config=None,
     ):
+        self.logger = logging.getLogger("SelfAdaptationManager")
+
         # need two rmqs as pika is not thread safe
-        self.rmq = Rabbitmq(**rmq_config)
+        self.rmq = create_rabbitmq(rmq_config, origin="self_adaptation_manager")
 
         # -- Models
         self.timing_model = TimingModel()
+        if timing_correction_config and timing_correction_config["model"]:
+            # Imported on demand, the learned correction requires torch
+            from dt.utils.timing_correction import create_corrected_timing_model
+            self.timing_model = create_corrected_timing_model(timing_correction_config)
         self.kinematic_model = KinematicModel()
         self.spatial_model = SpatialModel()
         # --
 
         self.monitor_data = None
+        self.residual_monitor = ResidualMonitor(self.timing_model, speedup=speedup)
+        self.watchdog = OperationWatchdog(self.timing_model, self.__on_watchdog_fault, speedup=speedup)
+        self.evaluator = None
+        if what_if_config is not None:
+            self.evaluator = WhatIfEvaluator(speedup, what_if_config["deadline"], what_if_config["workers"],
+                                             timing_model=self.timing_model)
+        self.replanner = MissingBlockReplanner(task_spec_name, self.kinematic_model, self.spatial_model,
+                                               self.evaluator)
+        self.replan_detected_at = None  # Detection time of the fault of the pending replan
 
     def setup(self):
         """Setup rmq subscriptions and start the state publishing thread"""
@@ -34,28 +69,73 @@ class SelfAdaptationManager():
         self.rmq.subscribe(
             routing_key=protocol.ROUTING_KEY_STATE,  # For PT messages
             on_message_callback=self.__analyse_data,
+            conflate=False,  # The residual monitor compares every PT sample with the prediction
+        )
+        self.rmq.subscribe(
+            routing_key=protocol.ROUTING_KEY_CTRL,  # For the commands of the controller
+            on_message_callback=self.__predict_operation,
         )
 
     def start(self):
         """Start consuming messages from the rmq"""
+        self.watchdog.start()
         try:
-            self.rmq_in.start_consuming()
-        except Exception as e:
-            print(e)
+            self.rmq.start_consuming()
+        except Exception:
+            self.logger.exception("Error while consuming messages")
             self.cleanup()
 
     def cleanup(self):
-        """Stop the state publishing thread and rmq"""
-        self.stop_pub_event.set()
-        self.state_pub_thread.join()
-        self.rmq_in.close()
-        self.rmq_out.close()
+        """Stop the watchdog, the what-if workers and the timing correction, and close the rmq connection"""
+        if self.watchdog.thread.is_alive():
+            self.watchdog.stop()
+        if self.evaluator is not None:
+            self.evaluator.close()
+        if self.timing_model.correction is not None:
+            self.timing_model.correction.stop()
+        self.rmq.close()
+
+    def __predict_operation(self, ch, method, properties, body_json):
+        """Start the prediction of the operation sent by the controller"""
+        operation_id = body_json[protocol.CtrlMsgKeys.OPERATION_ID]
+        self.replanner.on_ctrl_msg(body_json)
+        if (
+            self.replan_detected_at is not None
+            and body_json[protocol.CtrlMsgKeys.TYPE] != protocol.CtrlMsgFields.ABORT_OPERATION
+        ):
+            self.logger.info("Fault to new command latency: %.3f s", time.monotonic() - self.replan_detected_at)
+            self.replan_detected_at = None
+        start_q = None if self.monitor_data is None else self.monitor_data[protocol.RobotArmStateKeys.ACTUAL_Q]
+        self.watchdog.start_operation(ARM_ID, body_json, start_q)
+        if (
+            body_json[protocol.CtrlMsgKeys.TYPE] == protocol.CtrlMsgFields.MOVEJ
+            and self.monitor_data is not None
+        ):
+            self.residual_monitor.start_move(
+                operation_id,
+                self.monitor_data[protocol.RobotArmStateKeys.ACTUAL_Q],
+                body_json[protocol.CtrlMsgKeys.JOINT_POSITIONS],
+            )
+        else:
+            self.residual_monitor.start_operation(operation_id)
 
     def __analyse_data(self, ch, method, properties, body_json):
-        """Handle dt messages"""
-        print("DT received pt message:", body_json)  # TODO: Implement logging
-        fault_type = None
-        if (fault_type): self.__plan(fault_type)
+        """Compare the PT state with the prediction of the active operation"""
+        self.monitor_data = body_json
+        if body_json[protocol.RobotArmStateKeys.READY]:
+            self.watchdog.complete_operation(ARM_ID, body_json[protocol.RobotArmStateKeys.OPERATION_ID])
+        fault = self.residual_monitor.update(
+            body_json[protocol.RobotArmStateKeys.TIMESTAMP],
+            body_json[protocol.RobotArmStateKeys.ACTUAL_Q],
+            body_json[protocol.RobotArmStateKeys.READY],
+        )
+        if fault is not None:
+            self.logger.warning("Fault detected: %s", fault)
+            self.__plan(fault)
+
+    def __on_watchdog_fault(self, fault):
+        """Hand an overdue operation over to the connection thread, pika is not thread safe"""
+        self.rmq.add_callback_threadsafe(lambda: self.__plan(fault))
 
     
     def __plan (self, analysis_result: Any) -> None:
@@ -63,7 +143,19 @@ class SelfAdaptationManager():
         :param analysis_result: the analysis result
         """
         plan = None
-        # Do planning ->
+        if isinstance(analysis_result, WatchdogFault) and analysis_result.operation_type == protocol.CtrlMsgFields.GRIP:
+            # A grip that does not finish in time found no block
+            plan = self.replanner.replan(analysis_result.operation_id, analysis_result.detected_at)
+            if plan is not None:
+                self.replan_detected_at = analysis_result.detected_at
+        elif isinstance(analysis_result, ResidualFault):
+            # A deviating or late move cannot be corrected by changing the task, it is reported.
+            # A move that does not finish at all is also reported by the watchdog
+            self.logger.warning(
+                "No recovery plan for %s of operation %s (joint %s, residual %s), residuals of the move: %s",
+                analysis_result.type, analysis_result.operation_id, analysis_result.joint,
+                analysis_result.residual, self.residual_monitor.operation_statistics.summary(),
+            )
 
         # execute
         self.__execute(plan)
@@ -73,4 +165,7 @@ class SelfAdaptationManager():
         """Executes a task
         :param plan: the plan to be executed  
         """
+        if plan is None:
+            self.logger.info("No plan to execute")
+            return
         self.rmq.send_message(protocol.ROUTING_KEY_DT_MSG, message=plan)
\ No newline at end of file
@@ -1,27 +1,85 @@
+import copy
 import logging
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Any
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from dt.utils.knowledge_store import KnowledgeStore
+
+# Stage names used in the timing statistics
+MONITOR_STAGE = "monitor"
+ANALYSE_STAGE = "analyse"
+PLAN_STAGE = "plan"
+EXECUTE_STAGE = "execute"
+LOOP = "loop"
+
+
+@dataclass
+class StageTiming:
+    """Wall and CPU time of one stage in seconds"""
+    wall: float = 0.0
+    cpu: float = 0.0
+
+
+@dataclass
+class StageStatistics:
+    """Accumulated timings of a stage over all loops"""
+    count: int = 0
+    total_wall: float = 0.0
+    max_wall: float = 0.0
+    total_cpu: float = 0.0
+
+    def add(self, timing: StageTiming) -> None:
+        self.count += 1
+        self.total_wall += timing.wall
+        self.max_wall = max(self.max_wall, timing.wall)
+        self.total_cpu += timing.cpu
+
+    def mean_wall(self) -> float:
+        return self.total_wall / self.count if self.count else 0.0
+
 
 class MAPEK(ABC):
     """
     Abstract base class for MAPEK architecture with integrated logging.
     Defines the MAPEK loop and knowledge structure.
     This class should be extended by specific autonomic managers.
+    :param loop_budget: maximum wall time of one loop in seconds, longer loops are
+    reported as overruns through `on_overrun`. No overrun detection if None.
+    :param log_level: level of the manager's logger. The monitor data of every loop
+    is only formatted at DEBUG level.
     """
     
-    def __init__(self) -> None:
+    def __init__(self, loop_budget: Optional[float] = None, log_level: int = logging.INFO) -> None:
         super().__init__()
         
         # Configure logging
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(log_level)
         
         # Can be modified to output to a file
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
+        # Loggers are global, only add the handler once per manager class
+        if not self.logger.handlers:
+            console_handler = logging.StreamHandler()
+            console_handler.setLevel(logging.DEBUG)
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            console_handler.setFormatter(formatter)
+            self.logger.addHandler(console_handler)
+
+        # Stage timing
+        self.loop_budget = loop_budget
+        self.overruns = 0
+        self.stage_timings = {}  # Timings of the last loop
+        self.stage_statistics = {}
+        self.__timing_lock = threading.Lock()
+
+        # Guards the knowledge base when stages run in different threads
+        self.knowledge_lock = threading.RLock()
+        # Knowledge snapshot of the Analyse and Plan steps running in the current thread
+        self.__stage_knowledge = threading.local()
 
         # Stages knowledge keys
         self.MONITOR_DATA_KEY = "MONITOR_DATA"
@@ -51,55 +109,173 @@ class MAPEK(ABC):
         """
         Executes the MAPEK loop: Monitor, Analyse, Plan, and Execute.
         Updates the knowledge base at each stage with new data, results, 
-        and plans.
+        and plans. The wall and CPU time of every stage is recorded in
+        `stage_timings` and accumulated in `stage_statistics`.
         """
-        self.logger.info("Starting MAPEK loop.")
-        
-        # Monitor step
-        monitor_data = self.monitor()
-        self.knowledge.update({self.MONITOR_DATA_KEY: monitor_data})
-        self.logger.debug(f"Monitor: Data collected - {monitor_data}")
-        
+        self.logger.debug("Starting MAPEK loop.")
+        self.stage_timings = {}
+
+        with self.__timed(LOOP):
+            monitor_data = self.do_monitor()
+            analyse_result, plan_result = self.do_analyse_and_plan(monitor_data)
+            self.do_execute(analyse_result, plan_result)
+
+        self.check_overrun()
+
+    def check_overrun(self, timings: Optional[dict] = None) -> None:
+        """
+        Reports the last loop through `on_overrun` if it took longer than `loop_budget`.
+        Called at the end of every loop, also by runtimes that run the stages themselves.
+        :param timings: stage timings of the loop, `stage_timings` if None.
+        """
+        timings = self.stage_timings if timings is None else timings
+        loop_timing = timings.get(LOOP)
+        if self.loop_budget is not None and loop_timing is not None and loop_timing.wall > self.loop_budget:
+            self.overruns += 1
+            self.on_overrun(timings)
+
+    def do_monitor(self, timings: Optional[dict] = None) -> Any:
+        """
+        Monitor step of the loop, stores the monitored data in the knowledge base.
+        :param timings: dict the stage timing is stored in, `stage_timings` if None.
+        Runtimes running several loops at once pass a dict per loop.
+        :return: The monitored data.
+        """
+        with self.__timed(MONITOR_STAGE, timings):
+            monitor_data = self.monitor()
+        with self.knowledge_lock:
+            self.knowledge.update({self.MONITOR_DATA_KEY: monitor_data})
+            if isinstance(self.knowledge, KnowledgeStore):
+                self.knowledge.record(monitor_data)
+        self.logger.debug("Monitor: Data collected - %s", monitor_data)
+        return monitor_data
+
+    def do_analyse_and_plan(self, monitor_data: Any, knowledge: Optional[dict] = None,
+                            timings: Optional[dict] = None) -> tuple:
+        """
+        Analyse and Plan steps of the loop. Does not change the knowledge base
+        apart from the analyse and plan results, so it can run concurrently with monitoring.
+        :param monitor_data: The data collected from the Monitor step.
+        :param knowledge: snapshot of the knowledge base (see `snapshot_knowledge`) returned by
+        `get_knowledge` in this thread while analysing and planning, the live knowledge base if None.
+        :param timings: dict the stage timings are stored in, `stage_timings` if None.
+        :return: (analyse result, plan result), the plan result is None if there is no fault.
+        """
+        if knowledge is None:
+            return self.__analyse_and_plan(monitor_data, timings)
+        self.__stage_knowledge.value = knowledge
+        try:
+            return self.__analyse_and_plan(monitor_data, timings)
+        finally:
+            del self.__stage_knowledge.value
+
+    def __analyse_and_plan(self, monitor_data: Any, timings: Optional[dict]) -> tuple:
         # Analyse step
-        analyse_result = self.analyse(monitor_data)
-        self.knowledge.update({self.ANALYSE_RESULT_KEY: analyse_result})
-        self.logger.debug(f"Analyse - {analyse_result}")
-
-        # Plan and Execute steps
-        if analyse_result != self.NO_FAULT:
-            self.logger.info(f"Fault detected - {analyse_result}")
-            self.on_fault(analyse_result)
-            
-            # Plan
+        with self.__timed(ANALYSE_STAGE, timings):
+            analyse_result = self.analyse(monitor_data)
+        with self.knowledge_lock:
+            self.knowledge.update({self.ANALYSE_RESULT_KEY: analyse_result})
+        self.logger.debug("Analyse - %s", analyse_result)
+
+        if analyse_result == self.NO_FAULT:
+            return analyse_result, None
+
+        self.logger.info("Fault detected - %s", analyse_result)
+        self.on_fault(analyse_result)
+
+        # Plan
+        with self.__timed(PLAN_STAGE, timings):
             plan_result = self.plan(analyse_result)
+        with self.knowledge_lock:
             self.knowledge.update({self.PLAN_RESULT_KEY: plan_result})
-            self.logger.info(f"Plan: Generated plan - {plan_result}")
-            
-            if plan_result != self.UNRESOLVABLE:
+        self.logger.info("Plan: Generated plan - %s", plan_result)
+        return analyse_result, plan_result
+
+    def do_execute(self, analyse_result: Any, plan_result: Any, timings: Optional[dict] = None) -> None:
+        """
+        Execute step of the loop. The knowledge update of the plan is applied
+        atomically with respect to `snapshot_knowledge`.
+        :param analyse_result: The result of the Analyse step.
+        :param plan_result: The result of the Plan step, None if there was no fault.
+        :param timings: dict the stage timing is stored in, `stage_timings` if None.
+        """
+        if analyse_result == self.NO_FAULT:
+            self.logger.debug("No fault detected.")
+
+        elif plan_result != self.UNRESOLVABLE:
+            with self.knowledge_lock:
                 self.knowledge = self.update_knowledge_on_plan(plan_result)
-                self.logger.debug(f"Updated knowledge")
-                # Execute
+            self.logger.debug("Updated knowledge")
+            # Execute
+            with self.__timed(EXECUTE_STAGE, timings):
                 self.execute(plan_result)
-                self.logger.info(f"Execute: Plan {plan_result} executed.")
-            else:
-                self.on_unresolvable_fault(analyse_result)
-                self.logger.info("Fault was unresolvable.")
-
+            self.logger.info("Execute: Plan %s executed.", plan_result)
         else:
-            self.logger.info("No fault detected.")
+            self.on_unresolvable_fault(analyse_result)
+            self.logger.info("Fault was unresolvable.")
+
+    def snapshot_knowledge(self) -> dict:
+        """
+        Returns a shallow copy of the knowledge base that is consistent with
+        respect to plan updates, for use by concurrently running stages.
+        The signals of a `KnowledgeStore` are snapshots, so they do not see later samples.
+        :return: dict representing the knowledge state.
+        """
+        with self.knowledge_lock:
+            if isinstance(self.knowledge, KnowledgeStore):
+                return self.knowledge.snapshot()
+            return copy.copy(self.knowledge)
+
+    def on_overrun(self, stage_timings: dict) -> None:
+        """
+        Called when a loop took longer than `loop_budget`.
+        Logs the slowest stage by default, can be overridden by subclasses.
+        :param stage_timings: StageTiming of each stage run in the loop, and of the whole loop.
+        """
+        stages = {stage: timing for stage, timing in stage_timings.items() if stage != LOOP}
+        if not stages:
+            self.logger.warning("Loop overrun: %.3f ms > budget %.3f ms",
+                                stage_timings[LOOP].wall * 1e3, self.loop_budget * 1e3)
+            return
+        slowest = max(stages, key=lambda stage: stages[stage].wall)
+        self.logger.warning(
+            "Loop overrun: %.3f ms > budget %.3f ms (slowest stage %s: %.3f ms wall, %.3f ms CPU)",
+            stage_timings[LOOP].wall * 1e3, self.loop_budget * 1e3,
+            slowest, stages[slowest].wall * 1e3, stages[slowest].cpu * 1e3,
+        )
+
+    @contextmanager
+    def __timed(self, stage: str, timings: Optional[dict] = None):
+        """Record the wall and CPU time of the enclosed stage"""
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.record_timing(stage, StageTiming(time.perf_counter() - wall_start, time.thread_time() - cpu_start),
+                               timings)
+
+    def record_timing(self, stage: str, timing: StageTiming, timings: Optional[dict] = None) -> None:
+        """Store the timing of a stage of the current loop and add it to the statistics
+        :param timings: dict of the loop the stage belongs to, `stage_timings` if None."""
+        with self.__timing_lock:
+            (self.stage_timings if timings is None else timings)[stage] = timing
+            self.stage_statistics.setdefault(stage, StageStatistics()).add(timing)
     
     def get_knowledge(self) -> dict:
         """
-        Returns the current knowledge base.
+        Returns the current knowledge base, or the snapshot the Analyse and Plan
+        steps run on when called from them (see `do_analyse_and_plan`).
         :return: dict representing current knowledge state.
         """
-        return self.knowledge
+        return getattr(self.__stage_knowledge, "value", self.knowledge)
 
     @abstractmethod
     def initialise_knowledge(self) -> dict:
         """
         Abstract method to initialise the knowledge base.
         Must be implemented by subclasses.
+        Return a `KnowledgeStore` with declared signals to keep a bounded
+        history of the monitored samples.
         :return: Initial knowledge as a dictionary.
         """
         return {}
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from dt.utils.MAPEK import MAPEK, LOOP, StageTiming
+
+
+class MAPEKRuntime:
+    """
+    Schedules the loops of a MAPEK manager in a background thread.
+    Loops are either triggered periodically (`start_periodic`) or whenever new
+    monitor data is signalled with `notify` (`start_event_driven`).
+    :param manager: the MAPEK manager whose `do_loop` is run.
+    """
+
+    def __init__(self, manager: MAPEK) -> None:
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.manager = manager
+
+        self.stop_event = threading.Event()
+        self.data_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+        self.loops = 0
+        self.missed_periods = 0
+
+    def start_periodic(self, period: float) -> None:
+        """
+        Run a loop every `period` seconds.
+        Ticks are scheduled on a fixed grid so the rate does not drift. Ticks missed
+        because a loop took longer than the period are skipped and counted in `missed_periods`.
+        :param period: time between the start of two loops in seconds.
+        """
+        self.__start(self.__run_periodic, period)
+
+    def start_event_driven(self, timeout: Optional[float] = None) -> None:
+        """
+        Run a loop each time `notify` is called. Notifications arriving while a loop
+        runs are coalesced into a single following loop.
+        :param timeout: if set, also run a loop after `timeout` seconds without notification.
+        """
+        self.__start(self.__run_event_driven, timeout)
+
+    def notify(self) -> None:
+        """Signal that new monitor data is available, safe to call from any thread (e.g. a rmq callback)"""
+        self.data_event.set()
+
+    def stop(self) -> None:
+        """Stop scheduling loops and wait for the running loop to finish"""
+        self.stop_event.set()
+        self.data_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __start(self, target, arg) -> None:
+        if self.thread is not None:
+            raise RuntimeError("MAPEK runtime is already running")
+        self.stop_event.clear()
+        self.data_event.clear()
+        self.thread = threading.Thread(target=target, args=(arg,), daemon=True)
+        self.thread.start()
+
+    def __run_periodic(self, period: float) -> None:
+        next_tick = time.perf_counter()
+        while not self.stop_event.is_set():
+            self.__do_loop()
+            next_tick += period
+            now = time.perf_counter()
+            if now > next_tick:
+                missed = int((now - next_tick) // period) + 1
+                self.missed_periods += missed
+                self.logger.warning("Loop overran its period of %.3f ms, skipping %d tick(s)",
+                                    period * 1e3, missed)
+                next_tick += missed * period
+            self.stop_event.wait(next_tick - time.perf_counter())
+
+    def __run_event_driven(self, timeout: Optional[float]) -> None:
+        while not self.stop_event.is_set():
+            self.data_event.wait(timeout)
+            if self.stop_event.is_set():
+                break
+            self.data_event.clear()
+            self.__do_loop()
+
+    def __do_loop(self) -> None:
+        try:
+            self.run_once()
+        except Exception:
+            self.logger.exception("MAPEK loop failed")
+        self.loops += 1
+
+    def run_once(self) -> None:
+        """Run one loop of the manager, called on every trigger"""
+        self.manager.do_loop()
+
+
+class ConcurrentMAPEKRuntime(MAPEKRuntime):
+    """
+    MAPEK runtime where the Monitor step runs on every trigger while the Analyse and Plan
+    steps run in an executor on a snapshot of the knowledge taken after monitoring, so a slow
+    plan does not block monitoring. Analyses still waiting for a worker are cancelled when newer
+    data arrives, and a plan is discarded if an analysis of newer data has completed in the meantime.
+    Plans are executed one at a time and their knowledge updates are applied atomically.
+    The loop of a sample lasts from its monitoring to the end of its execution and is checked
+    against the manager's `loop_budget`.
+    :param manager: the MAPEK manager.
+    :param executor: thread-based executor running the Analyse and Plan steps, a thread pool if None.
+    Process pools are not supported: the stages share the manager's knowledge base, locks and
+    broker connections.
+    :param max_workers: number of workers of the default thread pool.
+    """
+
+    def __init__(self, manager: MAPEK, executor: Optional[Executor] = None, max_workers: int = 2) -> None:
+        super().__init__(manager)
+        if isinstance(executor, ProcessPoolExecutor):
+            raise TypeError("ConcurrentMAPEKRuntime requires a thread-based executor")
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers)
+
+        self.lock = threading.Lock()
+        self.execute_lock = threading.Lock()
+        self.generation = 0  # Increases with every monitored sample
+        self.applied_generation = 0  # Generation of the newest analysis acted upon
+        self.pending = []
+
+        self.cancelled_analyses = 0
+        self.stale_plans = 0
+
+    def stop(self) -> None:
+        super().stop()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def run_once(self) -> None:
+        loop_start = time.perf_counter()
+        timings = {}  # Stage timings of this sample, the workers of older samples still record theirs
+        monitor_data = self.manager.do_monitor(timings)
+        knowledge = self.manager.snapshot_knowledge()
+        with self.lock:
+            self.generation += 1
+            # Analyses of older data that have not started yet are superseded
+            for future in self.pending:
+                if future.cancel():
+                    self.cancelled_analyses += 1
+            self.pending = [future for future in self.pending if not future.done()]
+            self.pending.append(
+                self.executor.submit(analyse_plan_and_execute, self, monitor_data, knowledge,
+                                     self.generation, loop_start, timings)
+            )
+
+
+def analyse_plan_and_execute(runtime: ConcurrentMAPEKRuntime, monitor_data, knowledge: dict,
+                             generation: int, loop_start: float, timings: dict) -> None:
+    """Analyse and Plan steps of one sample in a worker of the runtime, followed by the
+    Execute step unless an analysis of newer data has been acted upon already.
+    The stage timings of the sample are recorded in timings, which become the manager's
+    `stage_timings` once the sample is executed."""
+    manager = runtime.manager
+    try:
+        analyse_result, plan_result = manager.do_analyse_and_plan(monitor_data, knowledge, timings)
+        with runtime.execute_lock:
+            if generation < runtime.applied_generation:
+                runtime.stale_plans += plan_result is not None
+                runtime.logger.debug("Discarding result of superseded analysis %d", generation)
+                return
+            runtime.applied_generation = generation
+            manager.do_execute(analyse_result, plan_result, timings)
+            manager.record_timing(LOOP, StageTiming(time.perf_counter() - loop_start,
+                                                    sum(timing.cpu for timing in timings.values())), timings)
+            manager.stage_timings = timings
+            manager.check_overrun(timings)
+    except Exception:
+        runtime.logger.exception("MAPEK analyse/plan failed")
@@ -0,0 +1,218 @@
+from typing import Optional
+
+import numpy as np
+
+# Default number of samples kept per signal, e.g. 10 minutes of a 500 Hz stream
+DEFAULT_CAPACITY = 300_000
+
+
+class SignalView:
+    """Statistics shared by a signal ring buffer and its snapshots, computed from
+    the incremental sums and from `window`"""
+
+    def mean(self) -> np.ndarray:
+        """Mean of the buffered samples, O(1)"""
+        return self.sum / max(len(self), 1)
+
+    def std(self) -> np.ndarray:
+        """Standard deviation of the buffered samples, O(1)"""
+        n = max(len(self), 1)
+        variance = self.sum_sq / n - (self.sum / n) ** 2
+        return np.sqrt(np.maximum(variance, 0.0))
+
+    def window_statistics(self, count: Optional[int] = None, since: Optional[float] = None) -> dict:
+        """Vectorized mean, std, min and max over a window, see `window`"""
+        _, values = self.window(count=count, since=since)
+        if not len(values):
+            return {"count": 0}
+        return {
+            "count": len(values),
+            "mean": values.mean(axis=0),
+            "std": values.std(axis=0),
+            "min": values.min(axis=0),
+            "max": values.max(axis=0),
+        }
+
+
+class SignalRingBuffer(SignalView):
+    """
+    Preallocated, time-indexed ring buffer of one signal (e.g. actual_q).
+    Every sample is written twice, at i and i + capacity, so the last n samples are always
+    contiguous and windows are returned as views without copying. Appending is O(1), and the
+    sum and sum of squares of the buffered samples are updated incrementally.
+    :param capacity: maximum number of samples kept, older samples are overwritten.
+    :param shape: shape of one sample, () for scalars, (6,) for joint vectors.
+    :param dtype: numpy dtype of the samples.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, shape: tuple = (), dtype=np.float64) -> None:
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.values = np.zeros((2 * capacity, *self.shape), dtype=dtype)
+        self.timestamps = np.zeros(2 * capacity, dtype=np.float64)
+        self.head = 0  # Index of the next write in [0, capacity)
+        self.count = 0  # Total number of samples appended
+
+        self.sum = np.zeros(self.shape, dtype=np.float64)
+        self.sum_sq = np.zeros(self.shape, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp: float, value) -> None:
+        """Append a sample, timestamps are expected to be non-decreasing"""
+        value = np.asarray(value, dtype=np.float64)
+        if self.count >= self.capacity:
+            evicted = self.values[self.head].astype(np.float64)
+            self.sum -= evicted
+            self.sum_sq -= evicted * evicted
+        self.sum += value
+        self.sum_sq += value * value
+
+        self.values[self.head] = value
+        self.values[self.head + self.capacity] = value
+        self.timestamps[self.head] = timestamp
+        self.timestamps[self.head + self.capacity] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.count += 1
+
+        # Bound the floating point drift of the incremental sums
+        if self.count % self.capacity == 0:
+            self.__recompute_sums()
+
+    def window(self, count: Optional[int] = None, since: Optional[float] = None,
+               until: Optional[float] = None) -> tuple:
+        """
+        View of the newest samples, selected by count and/or by time.
+        The views are only valid until the buffer wraps around, copy them to keep them longer.
+        Stages running concurrently with monitoring read a `snapshot` instead.
+        :param count: maximum number of newest samples.
+        :param since: only samples with timestamp >= since.
+        :param until: only samples with timestamp <= until.
+        :return: (timestamps, values) views in chronological order.
+        """
+        n = len(self)
+        if count is not None:
+            n = min(n, count)
+        end = self.head + self.capacity
+        start = end - n
+        timestamps = self.timestamps[start:end]
+        if since is not None:
+            start += int(np.searchsorted(timestamps, since, side="left"))
+        if until is not None:
+            end = start + int(np.searchsorted(self.timestamps[start:end], until, side="right"))
+        return self.timestamps[start:end], self.values[start:end]
+
+    def latest(self):
+        """Newest sample as (timestamp, value), None if empty"""
+        if not self.count:
+            return None
+        index = self.head - 1 + self.capacity
+        return self.timestamps[index], self.values[index]
+
+    def snapshot(self) -> "SignalSnapshot":
+        """Read-only view of the samples appended so far, see `SignalSnapshot`"""
+        return SignalSnapshot(self)
+
+    def __recompute_sums(self) -> None:
+        _, values = self.window()
+        values = values.astype(np.float64)
+        self.sum = values.sum(axis=0)
+        self.sum_sq = (values * values).sum(axis=0)
+
+
+class SignalSnapshot(SignalView):
+    """
+    Signal as of the time the snapshot was taken, for stages running concurrently with monitoring.
+    Only the end index, the count and the sums of the buffer are recorded, so taking a snapshot is O(1).
+    Windows are copied when read and never contain samples appended after the snapshot. Samples of
+    the window overwritten in the meantime by the wrapping buffer are dropped from its start.
+    :param buffer: the live ring buffer.
+    """
+
+    def __init__(self, buffer: SignalRingBuffer) -> None:
+        self.buffer = buffer
+        self.capacity = buffer.capacity
+        self.shape = buffer.shape
+        self.count = buffer.count
+        self.end = buffer.head + buffer.capacity
+        self.sum = buffer.sum.copy()
+        self.sum_sq = buffer.sum_sq.copy()
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def window(self, count: Optional[int] = None, since: Optional[float] = None,
+               until: Optional[float] = None) -> tuple:
+        """
+        Copy of the newest samples of the snapshot, see `SignalRingBuffer.window`.
+        :return: (timestamps, values) arrays in chronological order.
+        """
+        n = len(self)
+        if count is not None:
+            n = min(n, count)
+        start = self.end - n
+        timestamps = self.buffer.timestamps[start:self.end].copy()
+        values = self.buffer.values[start:self.end].copy()
+        # Sample i is overwritten by sample i + capacity, which may be being written right now
+        overwritten = self.buffer.count + 1 - self.capacity - (self.count - n)
+        if overwritten > 0:
+            timestamps, values = timestamps[overwritten:], values[overwritten:]
+        first, last = 0, len(timestamps)
+        if since is not None:
+            first = int(np.searchsorted(timestamps, since, side="left"))
+        if until is not None:
+            last = int(np.searchsorted(timestamps, until, side="right"))
+        return timestamps[first:max(first, last)], values[first:max(first, last)]
+
+    def latest(self):
+        """Newest sample of the snapshot as (timestamp, value), None if empty or overwritten"""
+        timestamps, values = self.window(count=1)
+        if not len(timestamps):
+            return None
+        return timestamps[0], values[0]
+
+
+class KnowledgeStore(dict):
+    """
+    Knowledge base of a MAPEK manager with ring-buffered signals.
+    Behaves like the plain knowledge dict, and additionally keeps the history of the
+    declared signals. Return it from `initialise_knowledge` to have the monitored
+    samples recorded automatically, e.g.
+        store = KnowledgeStore()
+        store.declare_signal(protocol.RobotArmStateKeys.ACTUAL_Q, shape=(6,), capacity=30_000)
+    :param timestamp_key: key of the timestamp in the monitored samples.
+    """
+
+    def __init__(self, *args, timestamp_key: str = "timestamp", **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.timestamp_key = timestamp_key
+        self.signals = {}
+
+    def declare_signal(self, name: str, shape: tuple = (), capacity: int = DEFAULT_CAPACITY,
+                       dtype=np.float64) -> SignalRingBuffer:
+        """Declare a signal recorded from the monitored samples under the key `name`"""
+        self.signals[name] = SignalRingBuffer(capacity, shape, dtype)
+        return self.signals[name]
+
+    def signal(self, name: str) -> SignalRingBuffer:
+        return self.signals[name]
+
+    def snapshot(self) -> "KnowledgeStore":
+        """
+        Copy of the knowledge whose signals are `SignalSnapshot`s of the current samples.
+        Must not be taken while a sample is recorded, `MAPEK.snapshot_knowledge` holds the knowledge lock.
+        The snapshot is read-only with respect to the signals.
+        """
+        snapshot = KnowledgeStore(self, timestamp_key=self.timestamp_key)
+        snapshot.signals = {name: buffer.snapshot() for name, buffer in self.signals.items()}
+        return snapshot
+
+    def record(self, sample) -> None:
+        """Append the declared signals present in a monitored sample (dict with a timestamp)"""
+        if not isinstance(sample, dict) or self.timestamp_key not in sample:
+            return
+        timestamp = sample[self.timestamp_key]
+        for name, buffer in self.signals.items():
+            if name in sample:
+                buffer.append(timestamp, sample[name])
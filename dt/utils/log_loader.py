@@ -0,0 +1,190 @@
+"""Columnar, memory-mapped cache of the PT and DT CSV logs (data/pt_data, data/dt_data).
+
+The logs are space separated text with a header row. PT logs have a blank line between the rows
+and more columns than DT logs, in a different order. `load_log` parses a log once, in chunks,
+into one raw binary file per column next to the CSV (`<log>.csv.cache/`), and memory maps the
+columns on every later load. Joint vectors are stored as (n, 6) columns named like the state
+message keys, e.g. "actual_q". Timestamps are sorted, so time ranges are found by binary search
+on the memory-mapped timestamp column and only the pages of the selected rows are read.
+"""
+import json
+import os
+import re
+import warnings
+
+import numpy as np
+
+import communication.protocol as protocol
+
+# Format version of the cache, caches of other versions are rebuilt
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".cache"
+META_FILE = "meta.json"
+
+# Bytes of CSV text parsed at once during the conversion
+PARSE_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Types of the known scalar columns, other scalar columns are stored as float64
+COLUMN_DTYPES = {
+    protocol.RobotArmStateKeys.TIMESTAMP: np.float64,
+    "safety_status": np.int8,
+    protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_65: np.bool_,
+    protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66: np.bool_,
+}
+
+# Per-joint columns such as actual_q_0 ... actual_q_5 are stored as one (n, 6) column
+JOINT_COLUMN = re.compile(r"^(.*)_(\d+)$")
+JOINT_COLUMNS = (protocol.RobotArmStateKeys.ACTUAL_Q, protocol.RobotArmStateKeys.ACTUAL_QD)
+
+
+def cache_directory(csv_path):
+    return str(csv_path) + CACHE_SUFFIX
+
+
+def parse_header(header):
+    """Columns of a log header as {name: (csv column indices, dtype)}"""
+    names = header.split()
+    columns = {}
+    for index, name in enumerate(names):
+        match = JOINT_COLUMN.match(name)
+        if match and match.group(1) in JOINT_COLUMNS:
+            indices, dtype = columns.setdefault(match.group(1), ([None] * 6, np.float64))
+            indices[int(match.group(2))] = index
+        else:
+            columns[name] = ([index], COLUMN_DTYPES.get(name, np.float64))
+    return names, columns
+
+
+def convert_log(csv_path, cache_dir=None):
+    """Parse a CSV log into the columnar cache, reading PARSE_CHUNK_SIZE bytes at a time"""
+    cache_dir = cache_directory(csv_path) if cache_dir is None else cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(os.path.join(cache_dir, META_FILE)):
+        os.remove(os.path.join(cache_dir, META_FILE))
+    with open(csv_path, "rb") as csv_file:
+        names, columns = parse_header(csv_file.readline().decode(protocol.ENCODING))
+        outputs = {name: open(os.path.join(cache_dir, name + ".bin"), "wb") for name in columns}
+        rows = 0
+        last_timestamp = -np.inf
+        is_sorted = True
+        try:
+            remainder = b""
+            while True:
+                chunk = csv_file.read(PARSE_CHUNK_SIZE)
+                text = remainder + chunk
+                if chunk:
+                    # Only parse complete lines
+                    end = text.rfind(b"\n") + 1
+                    text, remainder = text[:end], text[end:]
+                if text.strip():
+                    table = parse_rows(text, len(names))
+                    for name, (indices, dtype) in columns.items():
+                        table[:, indices].astype(dtype).tofile(outputs[name])
+                    if protocol.RobotArmStateKeys.TIMESTAMP in columns:
+                        timestamps = table[:, columns[protocol.RobotArmStateKeys.TIMESTAMP][0][0]]
+                        is_sorted = is_sorted and timestamps[0] >= last_timestamp and bool(
+                            np.all(np.diff(timestamps) >= 0))
+                        last_timestamp = timestamps[-1]
+                    rows += len(table)
+                if not chunk:
+                    break
+        finally:
+            for output in outputs.values():
+                output.close()
+
+    stat = os.stat(csv_path)
+    meta = {
+        "version": CACHE_VERSION,
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime,
+        "rows": rows,
+        "sorted": is_sorted,
+        "columns": {name: {"dtype": np.dtype(dtype).str, "width": len(indices)}
+                    for name, (indices, dtype) in columns.items()},
+    }
+    # Written last, an interrupted conversion leaves no valid cache
+    with open(os.path.join(cache_dir, META_FILE), "w") as meta_file:
+        json.dump(meta, meta_file)
+    return meta
+
+
+def parse_rows(text, column_count):
+    """Parse complete lines of a log into a float64 table, blank lines are skipped"""
+    text = text.replace(b"True", b"1").replace(b"False", b"0")
+    with warnings.catch_warnings():
+        # numpy only warns when it stops at a token that is not a number
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            values = np.fromstring(text.decode(protocol.ENCODING), dtype=np.float64, sep=" ")
+        except DeprecationWarning:
+            values = None
+    if values is None or len(values) % column_count:
+        raise ValueError(f"Malformed log rows, expected {column_count} numeric columns per row")
+    return values.reshape(-1, column_count)
+
+
+class RobotLog:
+    """Memory-mapped columns of a converted log.
+    :param cache_dir: directory written by `convert_log`"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        self.rows = self.meta["rows"]
+        self.columns = {}
+        for name, column in self.meta["columns"].items():
+            shape = (self.rows,) if column["width"] == 1 else (self.rows, column["width"])
+            if self.rows == 0:
+                self.columns[name] = np.zeros(shape, dtype=column["dtype"])
+                continue
+            self.columns[name] = np.memmap(os.path.join(cache_dir, name + ".bin"),
+                                           dtype=column["dtype"], mode="r", shape=shape)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def row_range(self, start=None, end=None):
+        """Rows with start <= timestamp < end as (first, last + 1), by binary search on the timestamps"""
+        timestamps = self.columns[protocol.RobotArmStateKeys.TIMESTAMP]
+        if not self.meta["sorted"]:
+            raise ValueError(f"Timestamps of {self.cache_dir} are not sorted, use the columns directly")
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side="left"))
+        last = self.rows if end is None else int(np.searchsorted(timestamps, end, side="left"))
+        return first, last
+
+    def time_slice(self, start=None, end=None, columns=None):
+        """Views of the columns for start <= timestamp < end, nothing is read until the views are used
+        :param columns: names of the columns, all columns if None"""
+        first, last = self.row_range(start, end)
+        names = self.columns if columns is None else columns
+        return {name: self.columns[name][first:last] for name in names}
+
+
+def is_cache_valid(csv_path, cache_dir):
+    try:
+        with open(os.path.join(cache_dir, META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(csv_path)
+    return (meta.get("version") == CACHE_VERSION and meta["source_size"] == stat.st_size
+            and meta["source_mtime"] == stat.st_mtime)
+
+
+def load_log(csv_path, cache_dir=None, rebuild=False):
+    """Load a PT or DT log, converting it to the columnar cache if the cache is missing or outdated
+    :param csv_path: path of the CSV log
+    :param cache_dir: cache directory, `<csv_path>.cache` by default
+    :param rebuild: convert even if the cache is valid
+    :return: RobotLog"""
+    cache_dir = cache_directory(csv_path) if cache_dir is None else cache_dir
+    if rebuild or not is_cache_valid(csv_path, cache_dir):
+        convert_log(csv_path, cache_dir)
+    return RobotLog(cache_dir)
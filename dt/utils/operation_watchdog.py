@@ -0,0 +1,132 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import communication.protocol as protocol
+from models.timing_model.timing_model import TimingModel
+
+# An operation is overdue after expected duration * (1 + DEADLINE_TOLERANCE) + DEADLINE_MARGIN
+DEADLINE_TOLERANCE = 0.2
+DEADLINE_MARGIN = 0.3 # s
+
+DEADLINE_FAULT = "deadline_fault"
+
+
+@dataclass
+class WatchdogFault:
+    """Fault raised when an operation has not completed before its deadline"""
+    arm_id: str
+    operation_id: int
+    operation_type: str
+    expected_duration: float
+    overdue: float
+    detected_at: float  # time.monotonic()
+    type: str = DEADLINE_FAULT
+
+
+class OperationWatchdog:
+    """
+    Fires a fault as soon as an operation misses its predicted completion deadline.
+    Moves, grips and gripper moves are predicted with the timing model.
+    Deadlines of all arms are kept in a heap with lazy deletion, so starting and completing
+    an operation cost O(log n) for n watched arms, and a single thread sleeps until the
+    earliest deadline.
+    :param timing_model: model predicting the duration of the operations.
+    :param on_fault: called with a WatchdogFault from the watchdog thread.
+    :param speedup: speedup factor of the robot (mockup), 1 for the real robot.
+    """
+
+    def __init__(self, timing_model: TimingModel, on_fault: Callable[[WatchdogFault], None],
+                 speedup: float = 1.0) -> None:
+        self.logger = logging.getLogger("OperationWatchdog")
+        self.timing_model = timing_model
+        self.on_fault = on_fault
+        self.speedup = speedup
+
+        self.condition = threading.Condition()
+        self.deadlines = []  # heap of (deadline, sequence number, arm_id, operation_id)
+        self.active = {}  # arm_id -> (operation_id, operation_type, expected_duration, deadline)
+        self.sequence = itertools.count()
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+        self.thread.join()
+
+    def expected_duration(self, ctrl_msg: dict, start_q=None) -> Optional[float]:
+        """Expected duration in seconds of a control message, None if it is not watched"""
+        operation_type = ctrl_msg[protocol.CtrlMsgKeys.TYPE]
+        if operation_type == protocol.CtrlMsgFields.MOVEJ:
+            if start_q is None:
+                return None
+            duration = self.timing_model.compute_duration_between_jps(
+                start_q, ctrl_msg[protocol.CtrlMsgKeys.JOINT_POSITIONS])
+        elif operation_type == protocol.CtrlMsgFields.GRIP:
+            duration = self.timing_model.grip_duration
+        elif operation_type == protocol.CtrlMsgFields.MOVE_GRIPPER:
+            duration = self.timing_model.gripper_full_move_duration * ctrl_msg[protocol.CtrlMsgKeys.GRIPPER_POSITION]
+        else:
+            return None
+        return duration / self.speedup
+
+    def start_operation(self, arm_id: str, ctrl_msg: dict, start_q=None, now: Optional[float] = None) -> None:
+        """Arm the watchdog for an operation that was just sent to the robot arm"""
+        duration = self.expected_duration(ctrl_msg, start_q)
+        operation_id = ctrl_msg[protocol.CtrlMsgKeys.OPERATION_ID]
+        with self.condition:
+            if duration is None:
+                self.active.pop(arm_id, None)
+                return
+            now = time.monotonic() if now is None else now
+            deadline = now + duration * (1 + DEADLINE_TOLERANCE) + DEADLINE_MARGIN
+            self.active[arm_id] = (operation_id, ctrl_msg[protocol.CtrlMsgKeys.TYPE], duration, deadline)
+            heapq.heappush(self.deadlines, (deadline, next(self.sequence), arm_id, operation_id))
+            self.__compact()
+            self.condition.notify()
+
+    def complete_operation(self, arm_id: str, operation_id: int) -> None:
+        """Disarm the watchdog of an arm that reported the operation as completed"""
+        with self.condition:
+            active = self.active.get(arm_id)
+            if active is not None and active[0] == operation_id:
+                del self.active[arm_id]
+
+    def __run(self) -> None:
+        while not self.stop_event.is_set():
+            with self.condition:
+                timeout = self.deadlines[0][0] - time.monotonic() if self.deadlines else None
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+                faults = self.__pop_expired(time.monotonic())
+            for fault in faults:
+                self.logger.warning("Operation overdue: %s", fault)
+                self.on_fault(fault)
+
+    def __pop_expired(self, now: float) -> list:
+        faults = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, arm_id, operation_id = heapq.heappop(self.deadlines)
+            active = self.active.get(arm_id)
+            if active is None or active[0] != operation_id or active[3] != deadline:
+                continue  # Completed or superseded operation
+            del self.active[arm_id]
+            faults.append(WatchdogFault(arm_id, operation_id, active[1], active[2], now - deadline, now))
+        return faults
+
+    def __compact(self) -> None:
+        """Drop the entries of completed operations once they dominate the heap"""
+        if len(self.deadlines) > 2 * len(self.active) + 64:
+            self.deadlines = [entry for entry in self.deadlines
+                              if self.active.get(entry[2], (None,))[0] == entry[3]]
+            heapq.heapify(self.deadlines)
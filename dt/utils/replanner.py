@@ -0,0 +1,178 @@
+import collections
+import logging
+import time
+from typing import Any, Optional
+
+import communication.protocol as protocol
+import models.spatial_model.sm_config as sm_config
+from models.kinematic_model.kinematic_model import KinematicModel
+from models.spatial_model.spatial_model import SpatialModel
+import task_specifications.tasks as tasks
+from task_specifications.utils.operation_sequences import move_and_grip, move_and_release
+import task_specifications.utils.operation_types as operation_types
+from dt.utils.what_if import WhatIfEvaluator
+
+# Time budget in seconds from the detection of a fault to the publication of the new task
+REPLAN_LATENCY_BUDGET = 0.01
+# Number of measured replanning latencies kept
+LATENCY_HISTORY = 100
+
+# Number of operations placing a gripped block
+RELEASE_SEQUENCE_LENGTH = len(move_and_release(0, 0))
+
+# Name of the candidate skipping the placement of the missing block
+SKIP_CANDIDATE = "skip"
+
+
+def stock_positions() -> list:
+    """Grid positions of the stock area, in the order the stock blocks are used"""
+    (x1, y1), (x2, y2), (x3, y3) = sm_config.STOCK_AREA.v1, sm_config.STOCK_AREA.v2, sm_config.STOCK_AREA.v3
+
+    def area(ax, ay, bx, by, cx, cy):
+        return abs(ax * (by - cy) + bx * (cy - ay) + cx * (ay - by)) / 2.0
+
+    positions = []
+    for x in range(min(x1, x2, x3), max(x1, x2, x3) + 1):
+        for y in range(min(y1, y2, y3), max(y1, y2, y3) + 1):
+            if area(x1, y1, x2, y2, x3, y3) == (area(x, y, x2, y2, x3, y3) + area(x1, y1, x, y, x3, y3)
+                                                + area(x1, y1, x2, y2, x, y)):
+                positions.append((x, y))
+    # Closest to the pick area first
+    positions.sort(key=lambda position: (-position[0], position[1]))
+    return positions
+
+
+class MissingBlockReplanner:
+    """
+    Builds the corrected remaining task when a grip finds no block, and resolves it to
+    control messages the controller can send without computing inverse kinematics.
+    The joint positions of every position of the task and of the stock area are resolved
+    once at construction, so a replan only rearranges cached control messages.
+    The replanner mirrors the task stack of the controller from the control messages it sends.
+    :param task_spec_name: name of the task specification executed by the controller.
+    :param evaluator: ranks the candidate tasks (every stock block, or skipping the placement),
+    without evaluator the next stock block is used.
+    """
+
+    def __init__(self, task_spec_name: str, kinematic_model: Optional[KinematicModel] = None,
+                 spatial_model: Optional[SpatialModel] = None,
+                 evaluator: Optional[WhatIfEvaluator] = None) -> None:
+        self.logger = logging.getLogger("MissingBlockReplanner")
+        self.kinematic_model = KinematicModel() if kinematic_model is None else kinematic_model
+        self.spatial_model = SpatialModel() if spatial_model is None else spatial_model
+        self.evaluator = evaluator
+
+        self.task = list(getattr(tasks, task_spec_name))  # Remaining operations, in execution order
+        self.next_index = 0
+        self.operation_indices = {}  # operation_id -> index in self.task
+
+        self.stock = collections.deque(stock_positions())
+        self.missing_block_keys = set()  # Joint position keys of the grips that found no block
+        self.joint_positions = {}  # (x, y, table_distance, rotation) -> joint positions
+        for operation in self.task:
+            self.__resolve(operation)
+        for x, y in self.stock:
+            for operation in move_and_grip(x, y):
+                self.__resolve(operation)
+
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+
+    def on_ctrl_msg(self, ctrl_msg: dict) -> None:
+        """Follow the controller, every control message except an abort executes the next operation"""
+        if ctrl_msg[protocol.CtrlMsgKeys.TYPE] == protocol.CtrlMsgFields.ABORT_OPERATION:
+            return
+        self.operation_indices[ctrl_msg[protocol.CtrlMsgKeys.OPERATION_ID]] = self.next_index
+        self.next_index += 1
+
+    def replan(self, operation_id: int, detected_at: Optional[float] = None) -> Optional[dict]:
+        """
+        Build the Replace message of a failed grip, substituting the block from the stock area,
+        or skipping its placement when the stock is empty or the evaluator ranks it first.
+        :param operation_id: operation id of the failed grip.
+        :param detected_at: time.monotonic() of the fault detection, now by default.
+        :return: the DT message, None if the operation is not a grip of the mirrored task.
+        """
+        detected_at = time.monotonic() if detected_at is None else detected_at
+        index = self.operation_indices.get(operation_id)
+        if index is None or not isinstance(self.task[index], operation_types.Grip):
+            return None
+
+        grip_position = self.task[index - 1]
+        grip_key = (grip_position.x, grip_position.y, grip_position.table_distance, grip_position.rotation)
+        self.missing_block_keys.add(grip_key)
+
+        candidates = self.__candidates(index)
+        name = self.__select(candidates, self.joint_positions[grip_key])
+        if name == SKIP_CANDIDATE:
+            self.logger.warning("Skipping the placement of the missing block")
+        else:
+            self.stock.remove(name)
+            self.logger.info("Substituting the missing block with the stock block at %s", name)
+        remaining = candidates[name]
+
+        self.task = remaining
+        self.next_index = 0
+        self.operation_indices = {}
+        # The controller pops the next operation from the end of its task stack
+        task_stack = [self.__to_ctrl_msg(operation) for operation in reversed(remaining)]
+        message = {
+            protocol.DTMsgKeys.TYPE: protocol.DTMsgFields.REPLACE,
+            protocol.DTMsgKeys.TASK_STACK: task_stack,
+        }
+
+        latency = time.monotonic() - detected_at
+        self.latencies.append(latency)
+        if latency > REPLAN_LATENCY_BUDGET:
+            self.logger.warning("Replanning took %.1f ms, budget is %.1f ms",
+                                latency * 1e3, REPLAN_LATENCY_BUDGET * 1e3)
+        return message
+
+    def __candidates(self, index: int) -> dict:
+        """Remaining tasks after the failed grip at index: stock position or SKIP_CANDIDATE -> operations"""
+        # Lift from the empty position and release the gripper closed on nothing
+        recovery = [self.task[index + 1], operation_types.MoveGripper(1.0)]
+        candidates = {position: [*recovery, *move_and_grip(*position), *self.task[index + 2:]]
+                      for position in self.stock}
+        candidates[SKIP_CANDIDATE] = [*recovery, *self.task[index + 2 + RELEASE_SEQUENCE_LENGTH:]]
+        return candidates
+
+    def __select(self, candidates: dict, start_q) -> Any:
+        """Name of the best candidate, the next stock block without evaluator"""
+        if self.evaluator is None:
+            return self.stock[0] if self.stock else SKIP_CANDIDATE
+        results = self.evaluator.evaluate(
+            {name: [self.__to_ctrl_msg(operation) for operation in task] for name, task in candidates.items()},
+            start_q,
+            [self.joint_positions[key] for key in self.missing_block_keys],
+        )
+        if not results:
+            return self.stock[0] if self.stock else SKIP_CANDIDATE
+        self.logger.debug("What-if ranking: %s", results)
+        return results[0].name
+
+    def __resolve(self, operation) -> None:
+        if not isinstance(operation, operation_types.Move):
+            return
+        key = (operation.x, operation.y, operation.table_distance, operation.rotation)
+        if key not in self.joint_positions:
+            spatial_position = self.spatial_model.compute_spatial_pose(
+                operation.x, operation.y, operation.table_distance
+            )
+            self.joint_positions[key] = self.kinematic_model.compute_inverse_kinematics(
+                spatial_position, operation.rotation
+            ).tolist()
+
+    def __to_ctrl_msg(self, operation) -> dict:
+        """Control message of an operation, without operation id"""
+        if isinstance(operation, operation_types.Move):
+            key = (operation.x, operation.y, operation.table_distance, operation.rotation)
+            return {
+                protocol.CtrlMsgKeys.TYPE: protocol.CtrlMsgFields.MOVEJ,
+                protocol.CtrlMsgKeys.JOINT_POSITIONS: self.joint_positions[key],
+            }
+        if isinstance(operation, operation_types.Grip):
+            return {protocol.CtrlMsgKeys.TYPE: protocol.CtrlMsgFields.GRIP}
+        return {
+            protocol.CtrlMsgKeys.TYPE: protocol.CtrlMsgFields.MOVE_GRIPPER,
+            protocol.CtrlMsgKeys.GRIPPER_POSITION: operation.position,
+        }
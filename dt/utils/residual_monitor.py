@@ -0,0 +1,146 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from models.timing_model.timing_model import TimingModel
+
+# Maximum residual between measured and predicted joint position in rad
+POSITION_THRESHOLD = 0.05
+# Number of consecutive samples above POSITION_THRESHOLD before a position fault is raised
+POSITION_DEBOUNCE_SAMPLES = 3
+# A move is late if it is still running after predicted duration * (1 + TIMING_TOLERANCE) + TIMING_MARGIN
+TIMING_TOLERANCE = 0.1
+TIMING_MARGIN = 0.2 # s
+
+# Fault types
+POSITION_FAULT = "position_fault"
+TIMING_FAULT = "timing_fault"
+
+
+@dataclass
+class ResidualFault:
+    """Fault raised by the residual monitor"""
+    type: str
+    operation_id: int
+    timestamp: float
+    joint: Optional[int] = None
+    residual: Optional[float] = None
+
+
+class JointResidualStatistics:
+    """Running per-joint residual statistics (Welford), O(1) per sample"""
+
+    def __init__(self, joints: int = 6) -> None:
+        self.count = 0
+        self.mean = np.zeros(joints)
+        self.m2 = np.zeros(joints)
+        self.max_abs = np.zeros(joints)
+
+    def add(self, residual: np.ndarray) -> None:
+        self.count += 1
+        delta = residual - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (residual - self.mean)
+        np.maximum(self.max_abs, np.abs(residual), out=self.max_abs)
+
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.m2 / self.count) if self.count else np.zeros_like(self.m2)
+
+    def summary(self) -> dict:
+        return {"count": self.count, "mean": self.mean.tolist(),
+                "std": self.std().tolist(), "max_abs": self.max_abs.tolist()}
+
+
+class ResidualMonitor:
+    """
+    Online comparison of the measured joint positions (PT) with the trajectory predicted
+    for the active move (DT). The prediction uses the timing model for the duration and the
+    quintic time scaling of `KinematicModel.compute_trajectory` (rtb.jtraj), evaluated in
+    closed form at each PT timestamp, so each sample costs O(1).
+    :param timing_model: model predicting the duration of the moves.
+    :param speedup: speedup factor of the robot (mockup), 1 for the real robot.
+    """
+
+    def __init__(self, timing_model: TimingModel, speedup: float = 1.0,
+                 position_threshold: float = POSITION_THRESHOLD,
+                 timing_tolerance: float = TIMING_TOLERANCE,
+                 timing_margin: float = TIMING_MARGIN) -> None:
+        self.timing_model = timing_model
+        self.speedup = speedup
+        self.position_threshold = position_threshold
+        self.timing_tolerance = timing_tolerance
+        self.timing_margin = timing_margin
+
+        self.operation_id = None
+        self.start_q = None
+        self.delta_q = None
+        self.duration = None
+        self.start_time = None
+        self.samples_above_threshold = 0
+        self.fault_raised = False
+
+        self.operation_statistics = JointResidualStatistics()
+        self.statistics = JointResidualStatistics()
+
+    def start_move(self, operation_id: int, start_q, target_q) -> None:
+        """Predict the trajectory of a MoveJ operation sent by the controller"""
+        self.__reset(operation_id)
+        self.start_q = np.asarray(start_q, dtype=float)
+        self.delta_q = np.asarray(target_q, dtype=float) - self.start_q
+        self.duration = self.timing_model.compute_duration_between_jps(start_q, target_q) / self.speedup
+
+    def start_operation(self, operation_id: int) -> None:
+        """Start an operation without a predicted trajectory (grip, gripper move, abort)"""
+        self.__reset(operation_id)
+
+    def predict(self, elapsed: float) -> np.ndarray:
+        """Predicted joint positions of the active move `elapsed` seconds after its start"""
+        s = min(max(elapsed / self.duration, 0.0), 1.0) if self.duration > 0 else 1.0
+        return self.start_q + self.delta_q * (s ** 3 * (10 - 15 * s + 6 * s * s))
+
+    def update(self, timestamp: float, actual_q, ready: bool) -> Optional[ResidualFault]:
+        """
+        Evaluate one PT sample against the prediction.
+        The robot reports the operation_id of an operation only once it is finished,
+        so the move is taken to start with the first not ready sample after `start_move`.
+        :return: a ResidualFault the first time a threshold is exceeded during the operation, else None
+        """
+        if self.delta_q is None or self.fault_raised:
+            return None
+        if self.start_time is None:
+            if ready:
+                return None  # The move has not started yet
+            self.start_time = timestamp
+        elapsed = timestamp - self.start_time
+
+        residual = np.asarray(actual_q, dtype=float) - self.predict(elapsed)
+        self.operation_statistics.add(residual)
+        self.statistics.add(residual)
+
+        joint = int(np.argmax(np.abs(residual)))
+        if abs(residual[joint]) > self.position_threshold:
+            self.samples_above_threshold += 1
+            if self.samples_above_threshold >= POSITION_DEBOUNCE_SAMPLES:
+                return self.__raise(POSITION_FAULT, timestamp, joint, float(residual[joint]))
+        else:
+            self.samples_above_threshold = 0
+
+        deadline = self.duration * (1 + self.timing_tolerance) + self.timing_margin
+        if not ready and elapsed > deadline:
+            return self.__raise(TIMING_FAULT, timestamp, residual=elapsed - self.duration)
+        return None
+
+    def __raise(self, fault_type, timestamp, joint=None, residual=None) -> ResidualFault:
+        self.fault_raised = True
+        return ResidualFault(fault_type, self.operation_id, timestamp, joint, residual)
+
+    def __reset(self, operation_id: int) -> None:
+        self.operation_id = operation_id
+        self.start_q = None
+        self.delta_q = None
+        self.duration = None
+        self.start_time = None
+        self.samples_above_threshold = 0
+        self.fault_raised = False
+        self.operation_statistics = JointResidualStatistics()
@@ -0,0 +1,215 @@
+"""Correction of predicted move durations with the trained timing-offset model.
+
+The model (models.timing_offset_model) maps a predicted joint trajectory to the trajectory with the
+timing offsets of the robot. A move of duration t is sampled like KinematicModel.compute_trajectory
+(quintic joint trajectory, int(t / dt) steps), corrected by the model, and the corrected duration
+is shifted by the delay until the corrected trajectory stays within SETTLE_TOLERANCE of the target.
+
+The model is loaded once, optionally quantized to dynamic int8, and traced to TorchScript, so
+production only needs the exported file and not the training code. Requests of all threads are
+collected into micro-batches of up to max_batch_size moves, e.g. the upcoming operations of all arms:
+    corrector = TimingCorrector("examples/timing_offset_model_unidirectional.pth", quantize=True)
+    corrector.start()
+    timing_model = TimingModel(correction=corrector)
+    corrector.correct_durations([(start_q, target_q, duration), ...])
+"""
+import collections
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+import models.kinematic_model.km_config as km_config
+import models.timing_offset_model.tom_config as tom_config
+from models.timing_model.timing_model import TimingModel
+from models.timing_offset_model.timing_offset_model import TimingOffsetModel
+
+# rad, the corrected trajectory has arrived once all joints stay this close to the target
+SETTLE_TOLERANCE = 0.01
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT = 0.002  # s, time the first request of a batch waits for more requests
+# Number of most recent requests kept for the latency statistics
+LATENCY_HISTORY = 10_000
+
+
+def quintic_trajectories(start_q, end_q, steps, length):
+    """Quintic joint trajectories like rtb.jtraj, padded to length with the target
+    :param start_q: (batch, 6) start joint positions
+    :param end_q: (batch, 6) target joint positions
+    :param steps: (batch,) number of steps of every trajectory
+    :return: (batch, length, 6) float32 array"""
+    index = np.arange(length)[None, :]
+    tau = np.clip(index / np.maximum(steps - 1, 1)[:, None], 0.0, 1.0)
+    s = tau**3 * (10 - 15 * tau + 6 * tau**2)
+    return (start_q[:, None, :] + s[:, :, None] * (end_q - start_q)[:, None, :]).astype(np.float32)
+
+
+def arrival_steps(trajectories, end_q, valid):
+    """Steps until the (batch, length, 6) trajectories stay within SETTLE_TOLERANCE of the targets
+    :param valid: (batch, length) mask of the steps of every trajectory"""
+    away = (np.abs(trajectories - end_q[:, None, :]).max(axis=2) > SETTLE_TOLERANCE) & valid
+    # One step after the last step away from the target
+    arrival = trajectories.shape[1] - np.argmax(away[:, ::-1], axis=1)
+    return np.where(away.any(axis=1), arrival, 0)
+
+
+class TimingCorrector:
+    """Micro-batched CPU inference of the timing-offset model.
+    :param model_path: state dict of TimingOffsetModel (.pth) or a TorchScript file written by `export`
+    :param bidirectional: architecture of a state dict. Batches are padded with the target, which
+    only leaves the outputs of unidirectional models unchanged
+    :param quantize: dynamic int8 quantization of the LSTM and linear layers of a state dict
+    :param max_batch_size: maximum number of moves corrected in one forward pass
+    :param max_wait: time in seconds the first request of a batch waits for more requests
+    :param num_threads: intra-op threads of the inference"""
+
+    def __init__(self, model_path, bidirectional=False, quantize=False, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_wait=DEFAULT_MAX_WAIT, num_threads=1):
+        self.logger = logging.getLogger("TimingCorrector")
+        torch.set_num_threads(num_threads)
+        self.module = self.__load(model_path, bidirectional, quantize)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pad_size = tom_config.pad_size
+
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.batch_sizes = collections.deque(maxlen=LATENCY_HISTORY)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    @staticmethod
+    def __load(model_path, bidirectional, quantize):
+        try:
+            return torch.jit.load(model_path, map_location="cpu")
+        except RuntimeError:
+            pass  # Not a TorchScript file, a state dict
+        model = TimingOffsetModel.load(model_path, bidirectional=bidirectional)
+        model.eval()
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+        with torch.inference_mode():
+            # The traced LSTM accepts any batch size and sequence length
+            return torch.jit.trace(model, torch.zeros(2, 8, tom_config.input_size), check_trace=False)
+
+    def export(self, path):
+        """Write the TorchScript module, loadable without the model code"""
+        self.module.save(path)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.requests.put(None)
+        self.thread.join()
+
+    def submit(self, start_q, end_q, duration) -> Future:
+        """Queue the correction of a move predicted to take duration seconds
+        :return: future of the corrected duration, the uncorrected duration once stopped"""
+        future = Future()
+        if self.stop_event.is_set():
+            future.set_result(duration)
+            return future
+        self.requests.put((time.perf_counter(), np.asarray(start_q, dtype=np.float64),
+                           np.asarray(end_q, dtype=np.float64), duration, future))
+        return future
+
+    def correct_duration(self, start_q, end_q, duration) -> float:
+        return self.submit(start_q, end_q, duration).result()
+
+    def correct_durations(self, moves) -> list:
+        """Correct many moves at once, e.g. the upcoming operations of all arms
+        :param moves: iterable of (start_q, end_q, duration)"""
+        futures = [self.submit(*move) for move in moves]
+        return [future.result() for future in futures]
+
+    def latency_stats(self) -> dict:
+        """Percentiles in seconds of the time from submit to result of the recent requests"""
+        latencies = np.asarray(self.latencies)
+        if not len(latencies):
+            return {"requests": 0, "p50": None, "p99": None, "mean_batch_size": None}
+        return {
+            "requests": len(latencies),
+            "p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)),
+            "mean_batch_size": float(np.mean(self.batch_sizes)),
+        }
+
+    def __run(self):
+        while not self.stop_event.is_set():
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0.0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.stop_event.set()
+                    break
+                batch.append(request)
+            self.__correct(batch)
+
+        # Requests left at shutdown are answered with the uncorrected duration
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request[4].set_result(request[3])
+
+    def __correct(self, batch):
+        _, start_q, end_q, durations, futures = zip(*batch)
+        try:
+            corrected = self.infer(np.stack(start_q), np.stack(end_q), np.asarray(durations, dtype=np.float64))
+        except Exception as exc:
+            self.logger.exception("Timing correction failed")
+            for future in futures:
+                future.set_exception(exc)
+            return
+        now = time.perf_counter()
+        for (submitted, _, _, _, future), duration in zip(batch, corrected.tolist()):
+            future.set_result(duration)
+            self.latencies.append(now - submitted)
+        self.batch_sizes.append(len(batch))
+
+    def infer(self, start_q, end_q, durations):
+        """Corrected durations of a batch of moves, in the calling thread
+        :param start_q: (batch, 6) start joint positions
+        :param end_q: (batch, 6) target joint positions
+        :param durations: (batch,) predicted durations in seconds
+        :return: (batch,) corrected durations in seconds"""
+        steps = np.maximum((durations / km_config.dt).astype(np.int64), 1)
+        length = int(steps.max()) + self.pad_size
+        trajectories = quintic_trajectories(start_q, end_q, steps, length)
+        with torch.inference_mode():
+            corrected = self.module(torch.from_numpy(trajectories)).numpy()
+
+        # The corrected duration is shifted by the delay of the corrected arrival at the target
+        valid = np.arange(length)[None, :] < (steps + self.pad_size)[:, None]
+        delay = arrival_steps(corrected, end_q, valid) - arrival_steps(trajectories, end_q, valid)
+        return durations + delay * km_config.dt
+
+
+def create_corrected_timing_model(timing_correction_config):
+    """TimingModel corrected by a started TimingCorrector
+    :param timing_correction_config: digital_twin.timing_correction of startup.conf"""
+    corrector = TimingCorrector(
+        model_path=timing_correction_config["model"],
+        bidirectional=timing_correction_config["bidirectional"],
+        quantize=timing_correction_config["quantize"],
+        max_batch_size=timing_correction_config["max_batch_size"],
+        max_wait=timing_correction_config["max_wait"],
+        num_threads=timing_correction_config["num_threads"],
+    )
+    corrector.start()
+    return TimingModel(correction=corrector)
@@ -0,0 +1,238 @@
+"""Alignment and comparison of DT and PT joint trajectories.
+
+The streams are resampled onto uniform grids, the time offset between them is estimated by
+FFT cross-correlation of the joint velocities, and both streams are compared on the common
+grid of their overlap. `banded_dtw` additionally matches local timing drift within a band.
+All steps are vectorized over samples and joints, e.g.
+    pt, dt = load_log("data/pt_data/E2_pt.csv"), load_log("data/dt_data/E2_dt.csv")
+    alignment = align(pt["timestamp"], pt["actual_q"], dt["timestamp"], dt["actual_q"])
+    joint_metrics(alignment.pt_q - alignment.dt_q)
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+import communication.protocol as protocol
+from dt.utils.log_loader import load_log
+
+# Joint speed in rad/s above which the PT is considered moving, used to find the moves
+MOVING_THRESHOLD = 1e-3
+
+
+@dataclass
+class Alignment:
+    """Both streams on the common time grid of their overlap (PT time)"""
+    offset: float  # s, DT time + offset = PT time
+    correlation: float  # normalized peak of the cross-correlation, 1 for identical motion
+    grid: np.ndarray
+    pt_q: np.ndarray
+    dt_q: np.ndarray
+
+
+def resample(timestamps, values, grid):
+    """Linear interpolation of (n, m) values onto a grid, all columns at once.
+    Grid points outside the timestamps take the first or last value."""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).reshape(len(timestamps), -1)
+    right = np.clip(np.searchsorted(timestamps, grid, side="right"), 1, len(timestamps) - 1)
+    left = right - 1
+    span = timestamps[right] - timestamps[left]
+    weight = np.clip(np.divide(grid - timestamps[left], span, out=np.zeros_like(grid), where=span > 0), 0.0, 1.0)
+    return values[left] + weight[:, None] * (values[right] - values[left])
+
+
+def uniform_grid(start, end, step):
+    return start + np.arange(int(np.floor((end - start) / step)) + 1) * step
+
+
+def sample_step(*timestamp_arrays):
+    """Finest median sample interval of the streams"""
+    return min(float(np.median(np.diff(timestamps))) for timestamps in timestamp_arrays)
+
+
+def estimate_offset(pt_timestamps, pt_q, dt_timestamps, dt_q, step=None, max_offset=None):
+    """Time offset of the DT stream relative to the PT stream by FFT cross-correlation
+    of the joint velocities, summed over the joints, refined to sub-sample precision.
+    :param step: resampling interval in seconds, the finest median sample interval if None
+    :param max_offset: only offsets with |offset - (PT start - DT start)| <= max_offset are considered
+    :return: (offset in s such that DT time + offset = PT time, normalized correlation peak)"""
+    step = sample_step(pt_timestamps, dt_timestamps) if step is None else step
+    pt_grid = uniform_grid(pt_timestamps[0], pt_timestamps[-1], step)
+    dt_grid = uniform_grid(dt_timestamps[0], dt_timestamps[-1], step)
+    a = np.gradient(resample(pt_timestamps, pt_q, pt_grid), axis=0)
+    b = np.gradient(resample(dt_timestamps, dt_q, dt_grid), axis=0)
+    a -= a.mean(axis=0)
+    b -= b.mean(axis=0)
+
+    size = len(a) + len(b) - 1
+    nfft = 1 << (size - 1).bit_length()
+    spectrum = (np.fft.rfft(a, nfft, axis=0) * np.conj(np.fft.rfft(b, nfft, axis=0))).sum(axis=1)
+    correlation = np.fft.irfft(spectrum, nfft)
+    # Lags -(len(b) - 1) ... len(a) - 1, lag k matches b[t] with a[t + k]
+    correlation = np.concatenate([correlation[nfft - len(b) + 1:], correlation[:len(a)]])
+    lags = np.arange(-(len(b) - 1), len(a))
+    if max_offset is not None:
+        correlation = np.where(np.abs(lags) * step <= max_offset, correlation, -np.inf)
+
+    peak = int(np.argmax(correlation))
+    shift = float(lags[peak])
+    if 0 < peak < len(correlation) - 1 and np.isfinite(correlation[peak - 1:peak + 2]).all():
+        # Parabolic interpolation of the peak
+        left, center, right = correlation[peak - 1:peak + 2]
+        denominator = left - 2 * center + right
+        if denominator < 0:
+            shift += 0.5 * (left - right) / denominator
+    norm = np.sqrt((a * a).sum() * (b * b).sum())
+    return pt_grid[0] - dt_grid[0] + shift * step, float(correlation[peak] / norm) if norm else 0.0
+
+
+def align(pt_timestamps, pt_q, dt_timestamps, dt_q, step=None, max_offset=None, offset=None):
+    """Estimate the offset and resample both streams onto the grid of their overlap
+    :param offset: known offset in s, estimated if None
+    :return: Alignment"""
+    pt_timestamps = np.asarray(pt_timestamps, dtype=np.float64)
+    dt_timestamps = np.asarray(dt_timestamps, dtype=np.float64)
+    step = sample_step(pt_timestamps, dt_timestamps) if step is None else step
+    correlation = 1.0
+    if offset is None:
+        offset, correlation = estimate_offset(pt_timestamps, pt_q, dt_timestamps, dt_q, step, max_offset)
+
+    start = max(pt_timestamps[0], dt_timestamps[0] + offset)
+    end = min(pt_timestamps[-1], dt_timestamps[-1] + offset)
+    grid = uniform_grid(start, end, step) if end > start else np.zeros(0)
+    return Alignment(
+        offset=offset,
+        correlation=correlation,
+        grid=grid,
+        pt_q=resample(pt_timestamps, pt_q, grid),
+        dt_q=resample(dt_timestamps + offset, dt_q, grid),
+    )
+
+
+def banded_dtw(a, b, band):
+    """Dynamic time warping of two (n, m) sequences of equal length with a Sakoe-Chiba band.
+    Each row of the cost matrix is computed at once: along a row the recurrence
+    D[j] = c[j] + min(v[j], D[j - 1]) is a cumulative minimum of v + c - C, shifted by C = cumsum(c).
+    :param band: maximum warp in samples
+    :return: (total cost, warping path as (i, j) index arrays)"""
+    a = np.asarray(a, dtype=np.float64).reshape(len(a), -1)
+    b = np.asarray(b, dtype=np.float64).reshape(len(b), -1)
+    if len(a) != len(b):
+        raise ValueError("banded_dtw expects sequences of equal length, resample them first")
+    n = len(a)
+    width = 2 * band + 1
+    # cost[i, d] is the cost of matching a[i] with b[i + d - band]
+    cost = np.full((n, width), np.inf)
+    for d in range(width):
+        shift = d - band
+        i = np.arange(max(0, -shift), min(n, n - shift))
+        cost[i, d] = np.linalg.norm(a[i] - b[i + shift], axis=1)
+
+    accumulated = np.full((n, width), np.inf)
+    row = np.full(width, np.inf)
+    row[band] = cost[0, band]
+    row[band + 1:] = np.cumsum(cost[0, band + 1:]) + cost[0, band]
+    accumulated[0] = row
+    for i in range(1, n):
+        previous = accumulated[i - 1]
+        # Vertical (i - 1, j) is d + 1 in the previous row, diagonal (i - 1, j - 1) is d
+        vertical = np.append(previous[1:], np.inf)
+        vertical_or_diagonal = np.minimum(vertical, previous)
+        c = cost[i]
+        finite = np.isfinite(c)
+        c_finite = np.where(finite, c, 0.0)
+        cumulative = np.cumsum(c_finite)
+        with np.errstate(invalid="ignore"):
+            row = cumulative + np.minimum.accumulate(vertical_or_diagonal + c_finite - cumulative)
+        accumulated[i] = np.where(finite, row, np.inf)
+
+    # Backtrack from the last cell (n - 1, n - 1)
+    path_i, path_j = [n - 1], [n - 1]
+    i, d = n - 1, band
+    while i > 0 or d != band:
+        candidates = (
+            (accumulated[i - 1, d] if i > 0 else np.inf, i - 1, d),  # diagonal
+            (accumulated[i - 1, d + 1] if i > 0 and d + 1 < width else np.inf, i - 1, d + 1),  # vertical
+            (accumulated[i, d - 1] if d > 0 else np.inf, i, d - 1),  # horizontal
+        )
+        _, i, d = min(candidates, key=lambda candidate: candidate[0])
+        path_i.append(i)
+        path_j.append(i + d - band)
+    return float(accumulated[n - 1, band]), (np.array(path_i[::-1]), np.array(path_j[::-1]))
+
+
+def joint_metrics(error):
+    """Per-joint RMSE, MAE and maximum absolute error of an (n, 6) error array"""
+    error = np.asarray(error)
+    absolute = np.abs(error)
+    return {
+        "rmse": np.sqrt((error * error).mean(axis=0)),
+        "mae": absolute.mean(axis=0),
+        "max_abs": absolute.max(axis=0),
+    }
+
+
+def move_segments(q, grid, operation_ids: Optional[np.ndarray] = None, threshold=MOVING_THRESHOLD):
+    """Start indices of the operations on the grid.
+    With operation ids, a segment starts where the id changes, otherwise where the PT starts or
+    stops moving (joint speed above threshold), so every move and every pause is a segment."""
+    if operation_ids is not None:
+        labels = np.asarray(operation_ids)
+    else:
+        speed = np.abs(np.gradient(q, grid, axis=0)).max(axis=1) if len(grid) > 1 else np.zeros(len(grid))
+        labels = speed > threshold
+    return np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+
+
+def segment_metrics(error, starts):
+    """Per-segment, per-joint RMSE and maximum absolute error, vectorized with reduceat.
+    :param starts: start indices of the segments, see `move_segments`
+    :return: dict of (segments, joints) arrays and the segment lengths"""
+    error = np.asarray(error)
+    lengths = np.diff(np.append(starts, len(error)))
+    squared = np.add.reduceat(error * error, starts, axis=0)
+    return {
+        "start": starts,
+        "length": lengths,
+        "rmse": np.sqrt(squared / lengths[:, None]),
+        "max_abs": np.maximum.reduceat(np.abs(error), starts, axis=0),
+    }
+
+
+def compare(pt_timestamps, pt_q, dt_timestamps, dt_q, dtw_band=None, **align_kwargs):
+    """Align a DT run with a PT run and compute the per-joint and per-operation errors
+    :param dtw_band: band in samples of the DTW applied after the global alignment, no DTW if None
+    :return: dict with the offset, correlation, joint metrics, segment metrics and the DTW cost"""
+    alignment = align(pt_timestamps, pt_q, dt_timestamps, dt_q, **align_kwargs)
+    result = {"offset": alignment.offset, "correlation": alignment.correlation}
+    dt_q_aligned = alignment.dt_q
+    if dtw_band is not None and len(alignment.grid):
+        cost, (path_i, path_j) = banded_dtw(alignment.pt_q, alignment.dt_q, dtw_band)
+        result["dtw_cost"] = cost
+        # Per PT sample, the last DT sample matched to it
+        matched = np.zeros(len(alignment.grid), dtype=np.int64)
+        matched[path_i] = path_j
+        dt_q_aligned = alignment.dt_q[matched]
+        result["dtw_warp"] = (matched - np.arange(len(matched))) * (alignment.grid[1] - alignment.grid[0]
+                                                                   if len(alignment.grid) > 1 else 0.0)
+    error = alignment.pt_q - dt_q_aligned
+    result["joints"] = joint_metrics(error) if len(error) else {}
+    result["segments"] = segment_metrics(error, move_segments(alignment.pt_q, alignment.grid)) if len(error) else {}
+    return result
+
+
+def compare_runs(run_pairs, dtw_band=None, **align_kwargs):
+    """Compare many recorded runs, e.g. for a regression over all logs
+    :param run_pairs: iterable of (PT log, DT log) paths, CSV logs or RobotLogs
+    :return: list of the `compare` results in the order of the pairs"""
+    results = []
+    for pt_log, dt_log in run_pairs:
+        pt_log = load_log(pt_log) if isinstance(pt_log, str) else pt_log
+        dt_log = load_log(dt_log) if isinstance(dt_log, str) else dt_log
+        results.append(compare(
+            pt_log[protocol.RobotArmStateKeys.TIMESTAMP], pt_log[protocol.RobotArmStateKeys.ACTUAL_Q],
+            dt_log[protocol.RobotArmStateKeys.TIMESTAMP], dt_log[protocol.RobotArmStateKeys.ACTUAL_Q],
+            dtw_band=dtw_band, **align_kwargs,
+        ))
+    return results
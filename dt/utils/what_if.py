@@ -0,0 +1,135 @@
+import concurrent.futures
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+import communication.protocol as protocol
+from models.timing_model.timing_model import TimingModel
+import models.kinematic_model.km_config as km_config
+
+# Default time in seconds the evaluation waits for the simulations
+DEFAULT_DEADLINE = 0.008
+DEFAULT_MAX_WORKERS = 2
+
+
+@dataclass
+class CandidateResult:
+    """Predicted outcome of a candidate task"""
+    name: str
+    makespan: float  # s, until the last operation has finished
+    gripped_blocks: int
+    failed_grips: int
+
+
+# Timing model of the simulations in a worker process, set when the worker starts
+_worker_timing_model = None
+
+
+def initialise_worker(timing_model: TimingModel) -> None:
+    global _worker_timing_model
+    _worker_timing_model = timing_model
+
+
+def simulate_task(task: list, start_q, missing_block_jps: list, speedup: float = 1.0,
+                  timing_model: Optional[TimingModel] = None) -> tuple:
+    """
+    Simulate a task with the semantics of RobotArmMockup.
+    Moves take the timing model duration rounded down to the trajectory time step, grips at
+    the joint positions of a missing block take twice the full gripper move time.
+    :param task: control messages in execution order, see `MissingBlockReplanner`.
+    :param start_q: joint positions at the start of the task.
+    :param missing_block_jps: joint positions of the grips that find no block.
+    :param timing_model: durations of the operations, the model of the worker process if None.
+    :return: (makespan, gripped blocks, failed grips)
+    """
+    timing_model = timing_model or _worker_timing_model or TimingModel()
+    q = np.asarray(start_q, dtype=float)
+    makespan = 0.0
+    gripped_blocks = failed_grips = 0
+    for ctrl_msg in task:
+        operation_type = ctrl_msg[protocol.CtrlMsgKeys.TYPE]
+        if operation_type == protocol.CtrlMsgFields.MOVEJ:
+            target_q = np.asarray(ctrl_msg[protocol.CtrlMsgKeys.JOINT_POSITIONS], dtype=float)
+            duration = timing_model.compute_duration_between_jps(q, target_q) / speedup
+            makespan += int(duration / km_config.dt) * km_config.dt
+            q = target_q
+        elif operation_type == protocol.CtrlMsgFields.GRIP:
+            if any(np.allclose(q, jps) for jps in missing_block_jps):
+                failed_grips += 1
+                makespan += 2 * timing_model.gripper_full_move_duration / speedup
+            else:
+                gripped_blocks += 1
+                makespan += timing_model.grip_duration / speedup
+        elif operation_type == protocol.CtrlMsgFields.MOVE_GRIPPER:
+            makespan += (timing_model.gripper_full_move_duration
+                         * ctrl_msg[protocol.CtrlMsgKeys.GRIPPER_POSITION] / speedup)
+    return makespan, gripped_blocks, failed_grips
+
+
+class WhatIfEvaluator:
+    """
+    Ranks candidate tasks by simulating them in a process pool.
+    Candidates delivering more blocks rank first, then the shorter makespan.
+    Simulations not finished at the deadline or failed are dropped from the ranking.
+    :param speedup: speedup factor of the robot (mockup), 1 for the real robot.
+    :param deadline: default time in seconds an evaluation waits for the simulations.
+    :param max_workers: number of worker processes, the pool is started on construction.
+    :param timing_model: timing model of the caller, whose limits and gripper durations are used by
+    the simulations. A learned correction is not applied in the workers. Defaults from tm_config if None.
+    """
+
+    def __init__(self, speedup: float = 1.0, deadline: float = DEFAULT_DEADLINE,
+                 max_workers: int = DEFAULT_MAX_WORKERS, timing_model: Optional[TimingModel] = None) -> None:
+        self.logger = logging.getLogger("WhatIfEvaluator")
+        self.speedup = speedup
+        self.deadline = deadline
+        timing_model = timing_model or TimingModel()
+        # The correction runs its own inference thread and is not sent to the workers
+        worker_timing_model = TimingModel(
+            maximum_velocity=timing_model.maximum_velocity,
+            acceleration=timing_model.acceleration,
+            grip_duration=timing_model.grip_duration,
+            gripper_full_move_duration=timing_model.gripper_full_move_duration,
+        )
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=initialise_worker, initargs=(worker_timing_model,)
+        )
+        # Start the workers now, so an evaluation does not pay the process startup
+        concurrent.futures.wait([self.executor.submit(simulate_task, [], [0.0] * 6, [])
+                                 for _ in range(max_workers)])
+
+    def evaluate(self, candidates: dict, start_q, missing_block_jps: list,
+                 deadline: Optional[float] = None) -> list:
+        """
+        Simulate the candidates in parallel.
+        :param candidates: name -> task as control messages in execution order.
+        :param start_q: joint positions of the robot when the task starts.
+        :param missing_block_jps: joint positions of the known missing blocks.
+        :param deadline: time in seconds to wait for the simulations, the default deadline if None.
+        :return: CandidateResults of the finished simulations, best first.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        futures = {
+            self.executor.submit(simulate_task, task, start_q, missing_block_jps, self.speedup): name
+            for name, task in candidates.items()
+        }
+        done, not_done = concurrent.futures.wait(futures, timeout=deadline)
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            self.logger.warning("%d of %d candidates not evaluated before the deadline",
+                                len(not_done), len(futures))
+
+        results = []
+        for future in done:
+            try:
+                results.append(CandidateResult(futures[future], *future.result()))
+            except Exception:
+                self.logger.exception("Simulation of candidate %s failed", futures[future])
+        results.sort(key=lambda result: (-result.gripped_blocks, result.makespan))
+        return results
+
+    def close(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
@@ -1,2 +1,20 @@
 port = 5556
 application_path = "Application/DigitalShadowsUR.exe"
+
+# Maximum number of joint position updates sent per second. Newer positions replace the pending one,
+# which is sent when the frame interval expires
+display_fps = 60
+# ZMQ send high-water mark, messages beyond it are dropped instead of queued for a slow renderer
+send_hwm = 10
+# Send all joints and the timestamp in one binary frame on frame_topic instead of one text message per joint.
+# Requires a renderer that decodes the frame: topic, space, 7 float64 (timestamp, q0..q5) in native byte order
+frame_mode = False
+frame_topic = "actual_q"
+
+# Maximum number of points plotted per joint and trajectory, longer trajectories are downsampled
+# to a min/max envelope. Around two points per horizontal pixel keep the shape of the curve
+plot_max_points = 4000
+# Live plots: shown time window in seconds, redraw rate and y limits in radians
+live_plot_window = 10.0
+live_plot_fps = 20
+live_plot_ylim = (-6.5, 6.5)
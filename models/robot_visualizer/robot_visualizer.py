@@ -1,5 +1,6 @@
 import time
 import subprocess
+import threading
 import zmq
 import matplotlib.pyplot as plt
 import itertools
@@ -8,10 +9,133 @@ import numpy as np
 import models.robot_visualizer.rm_config as rm_config
 
 
+def downsample_min_max(time_steps, values, max_points=rm_config.plot_max_points):
+    """Shape preserving downsampling of long trajectories for plotting.
+    The samples are split into equal buckets and the minimum and maximum of every bucket are kept
+    in chronological order, so peaks stay visible. The last bucket holds the remaining samples
+    and may be shorter. Vectorized over all columns at once.
+    :param time_steps: The time of each sample, shape (n,)
+    :type np.array
+    :param values: The samples, one column per joint, shape (n, m)
+    :type np.array
+    :param max_points: Maximum number of points kept per column, at least 2, no downsampling if None
+    :type int
+    :return: time steps and values of the kept points, both of shape (k, m) with k <= max_points
+    :rtype: tuple"""
+    n, m = values.shape
+    if max_points is None or n <= max_points:
+        return np.broadcast_to(time_steps[:, None], values.shape), values
+    if max_points < 2:
+        raise ValueError(f"max_points must be at least 2 to keep the minimum and maximum, got {max_points}")
+
+    bucket_size = -(-n // (max_points // 2))
+    buckets = n // bucket_size
+    bucketed = values[:buckets * bucket_size].reshape(buckets, bucket_size, m)
+    argmin = bucketed.argmin(axis=1)
+    argmax = bucketed.argmax(axis=1)
+    offsets = (np.arange(buckets) * bucket_size)[:, None]
+    if buckets * bucket_size < n:
+        # Remainder bucket with the end of the trajectory
+        remainder = values[buckets * bucket_size:]
+        argmin = np.vstack([argmin, remainder.argmin(axis=0)])
+        argmax = np.vstack([argmax, remainder.argmax(axis=0)])
+        offsets = np.vstack([offsets, [[buckets * bucket_size]]])
+    indices = np.stack(
+        [np.minimum(argmin, argmax) + offsets, np.maximum(argmin, argmax) + offsets], axis=1
+    ).reshape(2 * len(offsets), m)
+    return time_steps[indices], np.take_along_axis(values, indices, axis=0)
+
+
+class LiveTrajectoryPlot:
+    """Live plot of the joint positions fed from the state stream.
+    Lines are redrawn with blitting at a fixed rate, the axes are only redrawn when the figure changes.
+    The time axis is relative to the newest sample, so the axis limits stay fixed.
+    :param joints: List of joint indices to plot, all joints if None
+    :type joints: list, optional
+    :param window: Shown time window in seconds
+    :type window: float
+    :param fps: Maximum number of redraws per second
+    :type fps: float
+    :param max_samples: Number of samples kept, must cover the window at the input rate
+    :type max_samples: int"""
+
+    def __init__(self, joints=None, window=rm_config.live_plot_window, fps=rm_config.live_plot_fps,
+                 max_samples=10000):
+        self.joints = list(range(6)) if joints is None else joints
+        self.window = window
+        self.redraw_interval = 1.0 / fps
+        self.last_redraw_time = -np.inf
+
+        # Ring buffer, every sample is written twice so the newest samples are contiguous
+        self.max_samples = max_samples
+        self.timestamps = np.zeros(2 * max_samples)
+        self.values = np.zeros((2 * max_samples, len(self.joints)))
+        self.head = 0
+        self.count = 0
+
+        self.fig, axs = plt.subplots(len(self.joints), 1, sharex=True, squeeze=False)
+        self.axs = axs[:, 0]
+        self.lines = []
+        for ax, joint in zip(self.axs, self.joints):
+            (line,) = ax.plot([], [], animated=True)
+            ax.set_xlim(-window, 0)
+            ax.set_ylim(*rm_config.live_plot_ylim)
+            ax.set_ylabel(f"q{joint} [rad]")
+            ax.grid(c="lightgray")
+            self.lines.append(line)
+        self.axs[-1].set_xlabel("Time [s]")
+
+        self.background = None
+        self.fig.canvas.mpl_connect("draw_event", self.__on_draw)
+        plt.show(block=False)
+        plt.pause(0.001)
+
+    def update(self, timestamp, joint_positions):
+        """Add a sample, the plot is redrawn at most fps times per second
+        :param timestamp: Timestamp of the joint positions in seconds
+        :type float
+        :param joint_positions: The joint positions of the robot arm (q1, q2, q3, q4, q5, q6)
+        :type np.array"""
+        sample = np.asarray(joint_positions)[self.joints]
+        self.timestamps[self.head] = self.timestamps[self.head + self.max_samples] = timestamp
+        self.values[self.head] = self.values[self.head + self.max_samples] = sample
+        self.head = (self.head + 1) % self.max_samples
+        self.count = min(self.count + 1, self.max_samples)
+
+        now = time.monotonic()
+        if now - self.last_redraw_time >= self.redraw_interval:
+            self.last_redraw_time = now
+            self.redraw()
+
+    def redraw(self):
+        """Blit the lines onto the saved background of the axes"""
+        end = self.head + self.max_samples
+        timestamps = self.timestamps[end - self.count:end]
+        start = np.searchsorted(timestamps, timestamps[-1] - self.window) if self.count else 0
+        times = timestamps[start:] - (timestamps[-1] if self.count else 0.0)
+        values = self.values[end - self.count:end][start:]
+
+        if self.background is None:
+            self.fig.canvas.draw()
+        self.fig.canvas.restore_region(self.background)
+        for i, (ax, line) in enumerate(zip(self.axs, self.lines)):
+            line.set_data(times, values[:, i])
+            ax.draw_artist(line)
+        self.fig.canvas.blit(self.fig.bbox)
+        self.fig.canvas.flush_events()
+
+    def __on_draw(self, event):
+        """Save the background after a full redraw, e.g. on resize"""
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for ax, line in zip(self.axs, self.lines):
+            ax.draw_artist(line)
+
+
 class RobotVisualizer:
     """Class to manage the visualisation application"""
 
-    def __init__(self, port = rm_config.port) -> None:
+    def __init__(self, port = rm_config.port, display_fps = rm_config.display_fps,
+                 frame_mode = rm_config.frame_mode) -> None:
 
         # Path to the visualisation application
         self.application_path = str(pathlib.Path(__file__).parent.resolve()) + "\\" + rm_config.application_path
@@ -22,6 +146,16 @@ class RobotVisualizer:
         self.socket = None
         self.port = port
 
+        # Rate limiting and framing of the published joint positions
+        self.frame_interval = 1.0 / display_fps if display_fps else 0.0
+        self.last_publish_time = -np.inf
+        self.pending = None  # (joint positions, timestamp) sent when the frame interval expires
+        self.flush_timer = None
+        self.publish_lock = threading.Lock()
+        self.frame_mode = frame_mode
+        self.frame_prefix = rm_config.frame_topic.encode() + b" "
+        self.frame = np.zeros(7, dtype=np.float64)  # timestamp, q0..q5
+
         # Initialize the topic names
         self.topic_names = [
             "actual_q_0",
@@ -36,15 +170,54 @@ class RobotVisualizer:
         """Initializes the zmq socket"""
         context = zmq.Context()
         self.socket = context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, rm_config.send_hwm)
+        if self.frame_mode:
+            # Only the newest frame is kept for a slow renderer
+            self.socket.setsockopt(zmq.CONFLATE, 1)
         self.socket.bind(f"tcp://*:{self.port}")
 
-    def publish_joint_positions(self, joint_positions):
-        """Publishes the joint positions on the visualisation application
+    def publish_joint_positions(self, joint_positions, timestamp=0.0):
+        """Publishes the joint positions on the visualisation application.
+        Positions are sent at most once per frame interval. Positions arriving within the interval
+        replace the pending position, which is sent when the interval expires, so the last
+        position always reaches the application.
         :param joint_positions: The joint positions of the robot arm (q1, q2, q3, q4, q5, q6)
-        :type np.array"""
+        :type np.array
+        :param timestamp: Timestamp of the joint positions, only sent in frame mode
+        :type float"""
+
+        with self.publish_lock:
+            wait = self.last_publish_time + self.frame_interval - time.monotonic()
+            if wait > 0:
+                self.pending = (joint_positions, timestamp)
+                if self.flush_timer is None:
+                    self.flush_timer = threading.Timer(wait, self.__publish_pending)
+                    self.flush_timer.daemon = True
+                    self.flush_timer.start()
+                return
+            self.__send(joint_positions, timestamp)
+
+    def __publish_pending(self):
+        """Sends the pending position at the end of the frame interval"""
+        with self.publish_lock:
+            self.flush_timer = None
+            if self.pending is not None and self.socket is not None:
+                self.__send(*self.pending)
 
-        for i in range(6):
-            self.__publish_on_topic(self.topic_names[i], joint_positions[i])
+    def __send(self, joint_positions, timestamp):
+        self.last_publish_time = time.monotonic()
+        self.pending = None
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        if self.frame_mode:
+            self.frame[0] = timestamp
+            self.frame[1:] = joint_positions
+            self.socket.send(self.frame_prefix + self.frame.tobytes(), zmq.NOBLOCK)
+        else:
+            for i in range(6):
+                self.__publish_on_topic(self.topic_names[i], joint_positions[i])
 
     def visualize_trajectory(self, trajectory, time_step=0.05):
         """Visualizes the trajectory on the visualisation application
@@ -69,10 +242,16 @@ class RobotVisualizer:
         """Stops the visualization application and the zmq socket"""
         if self.process_running:
             print("Stopping Visualization")
-            self.socket.send_string("stop stop")
-            if self.app_process is not None:
-                self.app_process.kill()
-            self.socket.close()
+            with self.publish_lock:
+                if self.flush_timer is not None:
+                    self.flush_timer.cancel()
+                    self.flush_timer = None
+                self.pending = None
+                self.socket.send_string("stop stop")
+                if self.app_process is not None:
+                    self.app_process.kill()
+                self.socket.close()
+                self.socket = None
             self.process_running = False
         else:
             print("Application not running")
@@ -87,7 +266,8 @@ class RobotVisualizer:
         else:
             print("Application already running")
 
-    def plot_trajectory_2d(self, trajectory, labels=None, joints=None, time_step=0.05):
+    def plot_trajectory_2d(self, trajectory, labels=None, joints=None, time_step=0.05,
+                           max_points=rm_config.plot_max_points):
         """Plot the trajectory of the robot arm
         :param trajectory: The trajectory or trajectories to plot
         :type rtb.Trajectory or np.array (or list of either)
@@ -97,6 +277,9 @@ class RobotVisualizer:
         :type joints: list, optional
         :param time_step: Time step between points, optional
         :type time_step: float
+        :param max_points: Maximum number of points plotted per joint, longer trajectories are
+            downsampled to their min/max envelope. Plots every sample if None
+        :type max_points: int, optional
         """
         # Ensure trajectory is a list for uniform processing
         if not isinstance(trajectory, list):
@@ -135,12 +318,12 @@ class RobotVisualizer:
         for traj, label, color, style in zip(
             trajectory, labels, color_cycle, line_styles
         ):
-            self.__plot_trajectory_2d(traj, time_step, subfigs, label, color, style, joints)
+            self.__plot_trajectory_2d(traj, time_step, subfigs, label, color, style, joints, max_points)
 
         plt.tight_layout()
         plt.show()
 
-    def __plot_trajectory_2d(self, trajectory, time_step, subfigs, label, color, style, joints):
+    def __plot_trajectory_2d(self, trajectory, time_step, subfigs, label, color, style, joints, max_points):
         """Helper function to plot a single trajectory"""
         # If trajectory is a trajectory object, extract q and t values
         if hasattr(trajectory, "q"):
@@ -150,15 +333,18 @@ class RobotVisualizer:
         else:
             time_steps = np.linspace(0, time_step * len(trajectory), len(trajectory))
 
+        # Downsample all selected joints at once, the envelope keeps the minimum and maximum
+        time_steps, values = downsample_min_max(np.asarray(time_steps), np.asarray(trajectory)[:, joints], max_points)
+
         # ymin and ymax chosen for joints parameter
-        ymin = trajectory[:, joints].min()
-        ymax = trajectory[:, joints].max()
+        ymin = values.min()
+        ymax = values.max()
 
         # Loop through each joint (assuming 6 DOF)
         for plot_idx, joint in enumerate(joints):
 
             axs = subfigs[plot_idx]
-            axs.plot(time_steps, trajectory[:, joint], label=label, color=color, linestyle=style)
+            axs.plot(time_steps[:, plot_idx], values[:, plot_idx], label=label, color=color, linestyle=style)
             axs.set_title(f"q{joint}")
             axs.set_ylim([ymin - 0.1, ymax + 0.1])
 
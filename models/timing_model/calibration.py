@@ -0,0 +1,225 @@
+"""Calibration of the timing model from recorded PT logs.
+
+The logs are segmented into moves from `actual_qd`: a move starts when the arm starts moving or
+the direction of the joint velocities turns (consecutive movej commands are blended without a
+stop), and ends when the arm stops or turns again. For every joint, the maximum velocity and
+acceleration are fitted by least squares on the moves the joint leads, with the duration model of
+`TimingModel`: d/v + v/a for trapezoidal moves and 2 sqrt(d/a) for triangular ones.
+The sums of the normal equations are computed for all joints at once.
+Grip durations are measured between the stop of the arm and the rising edge of register 66
+(block gripped), gripper moves between the stop of the arm and the next move after the falling
+edge of register 66 (release). Releases are assumed to open the gripper fully.
+
+A share of the moves and grips is held out of the fit and used to report the prediction error
+of the calibrated and of the current configuration, e.g.
+    config, report = calibrate(["data/pt_data/E2_pt.csv"])
+    write_calibration("data/timing_calibration.json", config, report)
+    timing_model = TimingModel.from_calibration("data/timing_calibration.json")
+"""
+import json
+
+import numpy as np
+
+import communication.protocol as protocol
+from dt.utils.log_loader import load_log
+from models.timing_model.timing_model import joint_durations
+import models.timing_model.tm_config as tm_config
+
+# Joint speed in rad/s above which the arm is considered moving
+MOVING_THRESHOLD = 1e-3
+# Cosine between consecutive joint velocity vectors below which a new move starts
+TURN_COSINE = 0.9
+# Moves with fewer moving samples or a shorter leading distance in rad are noise
+MIN_MOVE_SAMPLES = 3
+MIN_MOVE_DISTANCE = 0.01
+# Fit iterations, the leading joints and time scalings are reassigned with the new limits
+FIT_ITERATIONS = 5
+# A joint is fitted with at least this many moves it leads, and fitted limits more than
+# LIMIT_RANGE times off the initial limits are rejected as ill-conditioned
+MIN_FIT_MOVES = 3
+LIMIT_RANGE = 3.0
+
+HELD_OUT_FRACTION = 0.25
+
+
+def segment_moves(timestamps, q, qd, threshold=MOVING_THRESHOLD, turn_cosine=TURN_COSINE):
+    """Moves of a PT log
+    :return: (start times, durations in s, (moves, 6) distances in rad)"""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    qd = np.asarray(qd, dtype=np.float64)
+    if len(timestamps) < 2:
+        return np.zeros(0), np.zeros(0), np.zeros((0, q.shape[1] if q.ndim == 2 else 6))
+    moving = np.abs(qd).max(axis=1) > threshold
+    speed = np.linalg.norm(qd, axis=1)
+    cosine = (qd[1:] * qd[:-1]).sum(axis=1) / np.maximum(speed[1:] * speed[:-1], 1e-12)
+    turn = moving[1:] & moving[:-1] & (cosine < turn_cosine)
+    starts = np.flatnonzero(np.concatenate([[moving[0]], (moving[1:] & ~moving[:-1]) | turn]))
+    ends = np.flatnonzero(np.concatenate([(moving[:-1] & ~moving[1:]) | turn, [moving[-1]]]))
+    step = float(np.median(np.diff(timestamps)))
+    # A move runs from the last sample before it to the first sample after it
+    before = np.maximum(starts - 1, 0)
+    after = np.minimum(ends + 1, len(timestamps) - 1)
+    durations = timestamps[ends] - timestamps[starts] + step
+    distances = np.abs(q[after] - q[before])
+    keep = (ends - starts + 1 >= MIN_MOVE_SAMPLES) & (distances.max(axis=1) >= MIN_MOVE_DISTANCE)
+    return timestamps[before][keep], durations[keep], distances[keep]
+
+
+def gripper_durations(timestamps, move_starts, move_durations, register_66):
+    """Durations of the grips and the releases of a PT log, see the module docstring
+    :return: (grip durations, release durations) in s"""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    register_66 = np.asarray(register_66, dtype=np.int8)
+    edges = np.diff(register_66)
+    rising = timestamps[np.flatnonzero(edges == 1) + 1]
+    falling = timestamps[np.flatnonzero(edges == -1) + 1]
+    move_ends = move_starts + move_durations
+
+    def stop_before(times):
+        # End of the last move that ended before each time, NaN without one
+        index = np.searchsorted(move_ends, times, side="right") - 1
+        return np.where(index >= 0, move_ends[np.maximum(index, 0)], np.nan)
+
+    grips = rising - stop_before(rising)
+    next_move = np.searchsorted(move_starts, falling, side="left")
+    release_end = np.where(next_move < len(move_starts), move_starts[np.minimum(next_move, len(move_starts) - 1)], np.nan)
+    releases = release_end - stop_before(falling)
+    return grips[np.isfinite(grips)], releases[np.isfinite(releases)]
+
+
+def fit_limits(distances, durations, maximum_velocity=tm_config.MAXIMUM_VELOCITY,
+               acceleration=tm_config.ACCELERATION, iterations=FIT_ITERATIONS):
+    """Least-squares fit of the per-joint limits to the durations of the moves.
+    Joints without enough moves they lead, or with implausible fits, keep the initial limits.
+    :param distances: (moves, 6) distances in rad
+    :param durations: (moves,) durations in s
+    :param maximum_velocity: initial limits in deg/s, scalar or per joint
+    :param acceleration: initial limits in deg/s^2, scalar or per joint
+    :return: (maximum velocities, accelerations), per joint in deg/s and deg/s^2"""
+    joints = distances.shape[1]
+    v = v_initial = np.broadcast_to(np.deg2rad(maximum_velocity), joints).astype(np.float64)
+    a = a_initial = np.broadcast_to(np.deg2rad(acceleration), joints).astype(np.float64)
+
+    def plausible(value, initial):
+        return (value > initial / LIMIT_RANGE) & (value < initial * LIMIT_RANGE)
+
+    durations = durations[:, None]
+    for _ in range(iterations):
+        # The leading joint of a move is the slowest one with the current limits
+        leading = np.argmax(joint_durations(distances, v, a), axis=1)
+        lead = np.zeros(distances.shape, dtype=bool)
+        lead[np.arange(len(distances)), leading] = True
+        trapezoidal = lead & (distances >= v**2 / a)
+        triangular = lead & ~trapezoidal
+
+        # Trapezoid: T = x d + y with x = 1 / v and y = v / a, normal equations per joint
+        w = trapezoidal.astype(np.float64)
+        n = w.sum(axis=0)
+        sum_d = (w * distances).sum(axis=0)
+        sum_t = (w * durations).sum(axis=0)
+        sum_dd = (w * distances**2).sum(axis=0)
+        sum_dt = (w * distances * durations).sum(axis=0)
+        determinant = n * sum_dd - sum_d**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = (n * sum_dt - sum_d * sum_t) / determinant
+            y = (sum_t - x * sum_d) / n
+            fitted = ((n >= MIN_FIT_MOVES) & (np.abs(determinant) > 1e-12)
+                      & plausible(1 / x, v_initial) & plausible(1 / (x * y), a_initial))
+            v = np.where(fitted, 1 / x, v)
+            a = np.where(fitted, 1 / (x * y), a)
+
+            # Triangle: T^2 = 4 d / a, only used for joints without a trapezoid fit
+            w = triangular.astype(np.float64)
+            sum_dd = (w * distances**2).sum(axis=0)
+            inverse_a = (w * distances * durations**2).sum(axis=0) / (4 * sum_dd)
+            a = np.where(~fitted & (w.sum(axis=0) >= MIN_FIT_MOVES) & plausible(1 / inverse_a, a_initial),
+                         1 / inverse_a, a)
+    return np.rad2deg(v), np.rad2deg(a)
+
+
+def duration_errors(predicted, measured):
+    if not len(measured):
+        return {"count": 0, "mae": None, "rmse": None, "bias": None}
+    error = np.asarray(predicted) - np.asarray(measured)
+    return {
+        "count": int(len(error)),
+        "mae": float(np.abs(error).mean()),
+        "rmse": float(np.sqrt((error * error).mean())),
+        "bias": float(error.mean()),
+    }
+
+
+def calibrate(log_paths, held_out_fraction=HELD_OUT_FRACTION, seed=0):
+    """Calibrate the timing model on PT logs
+    :param log_paths: CSV logs (see dt.utils.log_loader) or RobotLogs
+    :param held_out_fraction: share of the moves and grips used for the error report only
+    :param seed: seed of the random held-out split
+    :return: (configuration with the keys of tm_config, report with the held-out errors)"""
+    starts, durations, distances, grips, releases = [], [], [], [], []
+    for log in log_paths:
+        log = load_log(log) if isinstance(log, str) else log
+        timestamps = log[protocol.RobotArmStateKeys.TIMESTAMP]
+        move_starts, move_durations, move_distances = segment_moves(
+            timestamps, log[protocol.RobotArmStateKeys.ACTUAL_Q], log[protocol.RobotArmStateKeys.ACTUAL_QD])
+        durations.append(move_durations)
+        distances.append(move_distances)
+        if protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66 in log:
+            log_grips, log_releases = gripper_durations(
+                timestamps, move_starts, move_durations, log[protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66])
+            grips.append(log_grips)
+            releases.append(log_releases)
+    durations = np.concatenate(durations) if durations else np.zeros(0)
+    distances = np.concatenate(distances) if distances else np.zeros((0, 6))
+    grips = np.concatenate(grips) if grips else np.zeros(0)
+    releases = np.concatenate(releases) if releases else np.zeros(0)
+
+    rng = np.random.default_rng(seed)
+
+    def split(count):
+        held_out = np.zeros(count, dtype=bool)
+        held_out[rng.permutation(count)[:int(round(count * held_out_fraction))]] = True
+        return ~held_out, held_out
+
+    train, test = split(len(durations))
+    maximum_velocity, acceleration = fit_limits(distances[train], durations[train])
+    grip_train, grip_test = split(len(grips))
+    release_train, release_test = split(len(releases))
+    # The least-squares estimate of a constant duration is the mean
+    grip_duration = float(grips[grip_train].mean()) if grip_train.any() else tm_config.GRIP_DURATION
+    full_move_duration = (float(releases[release_train].mean()) if release_train.any()
+                          else tm_config.GRIPPER_FULL_MOVE_DURATION)
+
+    config = {
+        "MAXIMUM_VELOCITY": maximum_velocity.tolist(),
+        "ACCELERATION": acceleration.tolist(),
+        "GRIP_DURATION": grip_duration,
+        "GRIPPER_FULL_MOVE_DURATION": full_move_duration,
+    }
+
+    def predict(v, a):
+        return joint_durations(distances[test], np.deg2rad(v), np.deg2rad(a)).max(axis=1)
+
+    report = {
+        "moves": int(len(durations)),
+        "grips": int(len(grips)),
+        "releases": int(len(releases)),
+        "held_out": {
+            "moves": duration_errors(predict(maximum_velocity, acceleration), durations[test]),
+            "grips": duration_errors(np.full(grip_test.sum(), grip_duration), grips[grip_test]),
+            "releases": duration_errors(np.full(release_test.sum(), full_move_duration), releases[release_test]),
+        },
+        "held_out_current_config": {
+            "moves": duration_errors(predict(tm_config.MAXIMUM_VELOCITY, tm_config.ACCELERATION), durations[test]),
+            "grips": duration_errors(np.full(grip_test.sum(), tm_config.GRIP_DURATION), grips[grip_test]),
+            "releases": duration_errors(np.full(release_test.sum(), tm_config.GRIPPER_FULL_MOVE_DURATION),
+                                        releases[release_test]),
+        },
+    }
+    return config, report
+
+
+def write_calibration(path, config, report=None):
+    """Write a configuration readable by TimingModel.from_calibration"""
+    with open(path, "w") as calibration_file:
+        json.dump({**config, "report": report}, calibration_file, indent=2)
@@ -3,35 +3,69 @@ from models.timing_model.tm_custom_types import *
 from models.timing_model.tm_config import *
 
 # External packages
+import json
+
 import numpy as np
 
 
 class TimingModel:
     """This model models the duration between two joint positions, 
-    assuming a trapezoidal or triangular timescaling of the movement."""
+    assuming a trapezoidal or triangular timescaling of the movement.
+    The limits are either shared by all joints or given per joint, in which case the
+    duration is the one of the slowest joint. Defaults are taken from tm_config.
+    :param maximum_velocity: deg/s, scalar or one value per joint
+    :param acceleration: deg/s^2, scalar or one value per joint
+    :param grip_duration: s, grip of a present block
+    :param gripper_full_move_duration: s, gripper move over its full range
+    :param correction: optional learned correction of the move durations, called as
+    correction.correct_duration(start_jp, end_jp, duration), see dt.utils.timing_correction"""
+
+    def __init__(
+        self,
+        maximum_velocity=MAXIMUM_VELOCITY,
+        acceleration=ACCELERATION,
+        grip_duration=GRIP_DURATION,
+        gripper_full_move_duration=GRIPPER_FULL_MOVE_DURATION,
+        correction=None,
+    ) -> None:
+        self.maximum_velocity = maximum_velocity
+        self.acceleration = acceleration
+        self.grip_duration = grip_duration
+        self.gripper_full_move_duration = gripper_full_move_duration
+        self.correction = correction
 
-    def __init__(self) -> None:
-        pass
+    @classmethod
+    def from_calibration(cls, path) -> "TimingModel":
+        """Timing model with the configuration written by models.timing_model.calibration"""
+        with open(path) as calibration_file:
+            config = json.load(calibration_file)
+        return cls(
+            maximum_velocity=config["MAXIMUM_VELOCITY"],
+            acceleration=config["ACCELERATION"],
+            grip_duration=config["GRIP_DURATION"],
+            gripper_full_move_duration=config["GRIPPER_FULL_MOVE_DURATION"],
+        )
 
     def compute_duration_between_jps(self, start_jp, end_jp) -> float:
         """Models durations between joint positions"""
-        MAXIMUM_VELOCITY_RAD = np.deg2rad(MAXIMUM_VELOCITY)
-        ACCELERATION_RAD = np.deg2rad(ACCELERATION)
+        dist = np.abs(np.subtract(np.array(start_jp), np.array(end_jp)))
+        duration = float(np.max(joint_durations(
+            dist, np.deg2rad(self.maximum_velocity), np.deg2rad(self.acceleration))))
+        if self.correction is not None:
+            return self.correction.correct_duration(start_jp, end_jp, duration)
+        return duration
 
-        # Compute time scaling: Trapezoid or Triangular
-        leading_axis_dist: float = max(
-            np.abs(np.subtract(np.array(start_jp), np.array(end_jp)))
-        )
-        ts: time_scaling = (
-            trapezoidal
-            if leading_axis_dist >= MAXIMUM_VELOCITY_RAD**2 / ACCELERATION_RAD
-            else triangular
-        )
 
-        # compute value depending on timescaling
-        if ts == trapezoidal:
-            return (
-                ACCELERATION_RAD * leading_axis_dist + MAXIMUM_VELOCITY_RAD**2
-            ) / (ACCELERATION_RAD * MAXIMUM_VELOCITY_RAD)
-        else:
-            return 2 * np.sqrt(leading_axis_dist / abs(ACCELERATION_RAD))
+def joint_durations(dist, maximum_velocity_rad, acceleration_rad):
+    """Durations of the joints moving dist rad with their limits, vectorized over (..., 6) arrays.
+    With shared limits the slowest joint is the leading axis, the one with the longest distance"""
+    # Compute time scaling per joint: Trapezoid or Triangular
+    trapezoidal_durations = (acceleration_rad * dist + maximum_velocity_rad**2) / (
+        acceleration_rad * maximum_velocity_rad
+    )
+    triangular_durations = 2 * np.sqrt(dist / np.abs(acceleration_rad))
+    return np.where(
+        dist >= maximum_velocity_rad**2 / acceleration_rad,
+        trapezoidal_durations,
+        triangular_durations,
+    )
@@ -1,4 +1,5 @@
 MAXIMUM_VELOCITY = 60 # deg/s
 ACCELERATION = 80 # deg/s^2
 
-
+GRIP_DURATION = 0.7 # s, grip of a present block
+GRIPPER_FULL_MOVE_DURATION = 1.5 # s, gripper move over its full range (position 1.0)
@@ -0,0 +1,128 @@
+"""Datasets of (trajectory, trajectory with timing offsets) pairs and their batching.
+
+`pad_collate` pads the variable-length pairs of a batch to a common length: inputs repeat their
+last value, like the single-trajectory padding of the model, and targets are zero padded and
+masked, so `masked_loss` only counts the steps of the real targets.
+Large datasets are written as shards with `write_shards` and read with `ShardedTrajectoryDataset`,
+which spreads the shards over the DataLoader workers.
+"""
+import os
+import random
+from dataclasses import dataclass
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from torch.nn.utils.rnn import pad_sequence
+
+import models.timing_offset_model.tom_config as tom_config
+
+SHARD_PATTERN = "shard-{:05d}.pt"
+
+
+@dataclass
+class PaddedBatch:
+    inputs: torch.Tensor  # (batch, seq_len, 6), padded with the last value of each input
+    targets: torch.Tensor  # (batch, seq_len, 6), zero padded
+    mask: torch.Tensor  # (batch, seq_len), True for the steps of the targets
+    lengths: torch.Tensor  # (batch,), steps fed to the model, max(input length, target length)
+
+
+def pad_collate(batch):
+    """Collate (input, target) trajectory pairs of different lengths into a PaddedBatch"""
+    inputs, targets = zip(*batch)
+    input_lengths = torch.tensor([len(x) for x in inputs])
+    target_lengths = torch.tensor([len(y) for y in targets])
+    lengths = torch.maximum(input_lengths, target_lengths)
+    seq_len = int(lengths.max())
+
+    padded_inputs = pad_sequence(inputs, batch_first=True)
+    # Repeat the last value of every input up to seq_len with one gather
+    index = torch.clamp(torch.arange(seq_len).unsqueeze(0), max=(input_lengths - 1).unsqueeze(1))
+    padded_inputs = torch.gather(padded_inputs, 1, index.unsqueeze(2).expand(-1, -1, padded_inputs.size(2)))
+
+    padded_targets = pad_sequence(targets, batch_first=True)
+    padded_targets = F.pad(padded_targets, (0, 0, 0, seq_len - padded_targets.size(1)))
+    mask = torch.arange(seq_len).unsqueeze(0) < target_lengths.unsqueeze(1)
+    return PaddedBatch(padded_inputs, padded_targets, mask, lengths)
+
+
+def masked_loss(output, target, mask, criterion="mse"):
+    """Mean loss over the masked steps of a padded batch
+    :param criterion: "mse" or "huber" """
+    if criterion == "mse":
+        loss = F.mse_loss(output, target, reduction="none")
+    elif criterion == "huber":
+        loss = F.huber_loss(output, target, reduction="none")
+    else:
+        raise ValueError(f"Unknown criterion {criterion}")
+    mask = mask.unsqueeze(2).to(loss.dtype)
+    return (loss * mask).sum() / (mask.sum() * loss.size(2)).clamp(min=1)
+
+
+def sort_by_length(pairs, window):
+    """Sort windows of pairs by length, so consecutive batches hold trajectories of similar length"""
+    for start in range(0, len(pairs), window):
+        yield from sorted(pairs[start:start + window], key=lambda pair: len(pair[1]))
+
+
+class TrajectoryPairDataset(Dataset):
+    """In-memory dataset, e.g. TrajectoryPairDataset(trajectories, noisy_trajectories)"""
+
+    def __init__(self, inputs, targets):
+        if len(inputs) != len(targets):
+            raise ValueError("inputs and targets must have the same number of trajectories")
+        self.inputs = inputs
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __getitem__(self, index):
+        return self.inputs[index], self.targets[index]
+
+
+def write_shards(inputs, targets, directory, shard_size=tom_config.shard_size):
+    """Write trajectory pairs as shards of shard_size pairs
+    :return: paths of the shards"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for shard, start in enumerate(range(0, len(inputs), shard_size)):
+        path = os.path.join(directory, SHARD_PATTERN.format(shard))
+        torch.save({"inputs": list(inputs[start:start + shard_size]),
+                    "targets": list(targets[start:start + shard_size])}, path)
+        paths.append(path)
+    return paths
+
+
+class ShardedTrajectoryDataset(IterableDataset):
+    """Streams the pairs of shards written by `write_shards`.
+    Every DataLoader worker reads its own subset of the shards, so only the shards in use are in memory.
+    Shards and pairs are shuffled on every pass, and windows of pairs are sorted by length
+    (see tom_config.sort_window) to reduce padding.
+    :param paths: shard files, or a directory of shards"""
+
+    def __init__(self, paths, shuffle=True, seed=0, batch_size=tom_config.batch_size,
+                 sort_window=tom_config.sort_window):
+        if isinstance(paths, str):
+            paths = sorted(os.path.join(paths, name) for name in os.listdir(paths) if name.endswith(".pt"))
+        self.paths = list(paths)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.window = batch_size * sort_window
+        self.passes = 0
+
+    def __iter__(self):
+        worker = get_worker_info()
+        paths = self.paths if worker is None else self.paths[worker.id::worker.num_workers]
+        # Workers are persistent, so every worker counts its own passes
+        rng = random.Random(self.seed + self.passes * 7919 + (0 if worker is None else worker.id))
+        self.passes += 1
+        if self.shuffle:
+            paths = rng.sample(paths, len(paths))
+        for path in paths:
+            shard = torch.load(path, weights_only=True)
+            pairs = list(zip(shard["inputs"], shard["targets"]))
+            if self.shuffle:
+                rng.shuffle(pairs)
+            yield from sort_by_length(pairs, self.window)
@@ -0,0 +1,78 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+import models.timing_offset_model.tom_config as tom_config
+
+
+def pad_with_last(x, length):
+    """Pad a (seq_len, features) trajectory to length by repeating its last value"""
+    index = torch.clamp(torch.arange(length, device=x.device), max=x.size(0) - 1)
+    return x[index]
+
+
+class TimingOffsetModel(nn.Module):
+    """Maps a predicted joint trajectory to the trajectory with the timing offsets of the robot.
+    The parameter names match the pretrained models in examples/.
+    forward takes a single (seq_len, 6) trajectory, which is padded with pad_size copies of its
+    last value, or a padded (batch, seq_len, 6) batch with the lengths of the trajectories
+    (see models.timing_offset_model.dataset.pad_collate)."""
+
+    def __init__(
+        self,
+        input_size=tom_config.input_size,
+        hidden_size=tom_config.hidden_size,
+        num_layers=tom_config.num_layers,
+        dropout=tom_config.dropout,
+        bidirectional=False,
+        pad_size=tom_config.pad_size,
+    ):
+        super(TimingOffsetModel, self).__init__()
+        self.pad_size = pad_size
+
+        # LSTM layer for sequence processing
+        self.lstm = nn.LSTM(
+            input_size,
+            hidden_size,
+            num_layers,
+            batch_first=True,
+            bidirectional=bidirectional,
+            dropout=dropout,
+        )
+
+        # Fully connected layers after the LSTM for the final output
+        lstm_output_size = hidden_size * 2 if bidirectional else hidden_size
+        self.fc1 = nn.Linear(lstm_output_size, hidden_size * 2)
+        self.fc2 = nn.Linear(hidden_size * 2, hidden_size * 4)
+        self.fc3 = nn.Linear(hidden_size * 4, input_size)  # Output is the same size as input (trajectory point)
+
+        self.relu = nn.ReLU()
+
+    def forward(self, x, lengths=None):
+        if x.dim() == 2:
+            x = pad_with_last(x, x.size(0) + self.pad_size).unsqueeze(0)
+            return self.forward(x)[0]
+
+        if lengths is None:
+            lstm_out, _ = self.lstm(x)
+        else:
+            # Padded steps are skipped, so they do not leak into the reverse direction
+            packed = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            lstm_out, _ = self.lstm(packed)
+            lstm_out, _ = pad_packed_sequence(lstm_out, batch_first=True, total_length=x.size(1))
+
+        # Pass through fully connected layers for each time step
+        x = self.fc1(lstm_out)
+        x = self.relu(x)
+        x = self.fc2(x)
+        x = self.relu(x)
+        x = self.fc3(x)
+
+        return x
+
+    @classmethod
+    def load(cls, path, bidirectional=False, **kwargs):
+        """Load a state dict, e.g. examples/timing_offset_model_unidirectional.pth"""
+        model = cls(bidirectional=bidirectional, **kwargs)
+        model.load_state_dict(torch.load(path, map_location=torch.device("cpu"), weights_only=True))
+        return model
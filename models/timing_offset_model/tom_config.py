@@ -0,0 +1,16 @@
+# Architecture of the pretrained models (examples/timing_offset_model*.pth)
+input_size = 6
+hidden_size = 128
+num_layers = 2
+dropout = 0.5
+
+# Steps appended to a single trajectory, a corrected trajectory is longer than its input
+pad_size = 30
+
+# Training
+batch_size = 32
+learning_rate = 0.001
+shard_size = 500  # trajectory pairs per dataset shard
+sort_window = 16  # batches sorted by length at once, to batch trajectories of similar length
+num_workers = 4  # DataLoader worker processes
+num_threads = 4  # intra-op threads of the training process, the workers use 1
@@ -0,0 +1,95 @@
+"""Mini-batch training of the timing-offset model on CPU.
+
+The training process uses tom_config.num_threads intra-op threads and the DataLoader workers one
+thread each, so collating in the workers does not oversubscribe the cores used by the model, e.g.
+    dataset = ShardedTrajectoryDataset(write_shards(trajectories, noisy_trajectories, "dataset/shards"))
+    model = TimingOffsetModel()
+    losses = train_model(model, dataset, num_epochs=100)
+"""
+import logging
+import time
+
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+
+import models.timing_offset_model.tom_config as tom_config
+from models.timing_offset_model.dataset import pad_collate, masked_loss
+
+logger = logging.getLogger("TimingOffsetTraining")
+
+
+def init_worker(worker_id):
+    torch.set_num_threads(1)
+
+
+def make_data_loader(dataset, batch_size=tom_config.batch_size, num_workers=tom_config.num_workers, shuffle=True):
+    """DataLoader of padded batches, sharded datasets shuffle themselves"""
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle and not isinstance(dataset, IterableDataset),
+        num_workers=num_workers,
+        collate_fn=pad_collate,
+        worker_init_fn=init_worker if num_workers else None,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers else None,
+    )
+
+
+def train_model(
+    model,
+    dataset,
+    num_epochs,
+    batch_size=tom_config.batch_size,
+    learning_rate=tom_config.learning_rate,
+    criterion="mse",
+    num_workers=tom_config.num_workers,
+    num_threads=tom_config.num_threads,
+    optimizer=None,
+    log_interval=10,
+):
+    """Train the model with the masked loss of padded mini-batches
+    :param dataset: TrajectoryPairDataset or ShardedTrajectoryDataset of (input, target) pairs
+    :param criterion: "mse" or "huber", see masked_loss
+    :param optimizer: Adam with learning_rate if None
+    :return: mean loss of every epoch"""
+    torch.set_num_threads(num_threads)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate) if optimizer is None else optimizer
+    data_loader = make_data_loader(dataset, batch_size, num_workers)
+
+    epoch_losses = []
+    for epoch in range(num_epochs):
+        model.train()
+        start_time = time.perf_counter()
+        epoch_loss = 0.0
+        batches = 0
+        for batch in data_loader:
+            output = model(batch.inputs, batch.lengths)
+            loss = masked_loss(output, batch.targets, batch.mask, criterion)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            epoch_loss += loss.item()
+            batches += 1
+        epoch_losses.append(epoch_loss / max(batches, 1))
+
+        if (epoch + 1) % log_interval == 0:
+            logger.info("Epoch %d/%d, loss: %f, %.1f s", epoch + 1, num_epochs, epoch_losses[-1],
+                        time.perf_counter() - start_time)
+    return epoch_losses
+
+
+@torch.no_grad()
+def evaluate_model(model, dataset, batch_size=tom_config.batch_size, num_workers=0):
+    """Mean squared error of the model over the masked steps of a dataset"""
+    model.eval()
+    total = 0.0
+    steps = 0
+    for batch in make_data_loader(dataset, batch_size, num_workers, shuffle=False):
+        output = model(batch.inputs, batch.lengths)
+        error = ((output - batch.targets) ** 2).sum(dim=2)
+        total += float(error[batch.mask].sum())
+        steps += int(batch.mask.sum()) * output.size(2)
+    return total / max(steps, 1)
@@ -2,7 +2,7 @@ import logging
 from typing import Any, Dict
 import time
 
-from communication.rabbitmq import Rabbitmq
+from communication.rabbitmq import create_rabbitmq
 import communication.protocol as protocol
 from models.spatial_model.spatial_model import SpatialModel
 from models.kinematic_model.kinematic_model import KinematicModel
@@ -52,7 +52,7 @@ class Controller:
     def __init__(self, rmq_config, task_spec_name):
         self.logger = logging.getLogger("Controller")
 
-        self.rmq = Rabbitmq(**rmq_config)
+        self.rmq = create_rabbitmq(rmq_config, origin="controller")
         self.task_stack: list = getattr(tasks, task_spec_name)
         self.operation_id = 0
 
@@ -69,6 +69,7 @@ class Controller:
         self.rmq.subscribe(
             routing_key=protocol.ROUTING_KEY_STATE,  # For pt messages
             on_message_callback=self.__execute_task,
+            conflate=True,  # Only react to the latest robot state
         )
 
     def start_controller(self):
@@ -119,7 +120,11 @@ class Controller:
         next_operation = self.task_stack.pop()
         self.operation_id += 1
         ctrl_message = None
-        if isinstance(next_operation, operation_types.Move):
+        if isinstance(next_operation, dict):
+            # Control message resolved by the DT, e.g. in a Replace message
+            ctrl_message = dict(next_operation)
+
+        elif isinstance(next_operation, operation_types.Move):
             # convert using spatial model
             spatial_position = self.spatial_model.compute_spatial_pose(
                 next_operation.x, next_operation.y, next_operation.table_distance
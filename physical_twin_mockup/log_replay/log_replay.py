@@ -0,0 +1,155 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from communication.rabbitmq import create_rabbitmq
+import communication.protocol as protocol
+from dt.utils.log_loader import load_log
+from dt.services.recorder import load_recording
+
+# Number of most recent lags kept for the statistics, bounds the memory of endless replays
+LAG_HISTORY = 100_000
+
+
+def namespaced_routing_key(routing_key, arm_id):
+    """Routing key of one arm, consumers of all arms subscribe to "<routing_key>.#" """
+    return routing_key if arm_id is None else f"{routing_key}.{arm_id}"
+
+
+def load_states(log_path):
+    """State messages of a PT log, a CSV file or a recorder directory
+    :return: (timestamps, list of state messages)"""
+    if os.path.isdir(log_path):
+        log = load_recording(log_path, protocol.ROUTING_KEY_STATE)
+    else:
+        log = load_log(log_path)
+    rows = len(log)
+    timestamps = np.asarray(log[protocol.RobotArmStateKeys.TIMESTAMP], dtype=np.float64)
+
+    def column(name, default):
+        return log[name].tolist() if name in log else [default] * rows
+
+    # Converted once, so publishing does not touch numpy
+    columns = {
+        protocol.RobotArmStateKeys.TIMESTAMP: timestamps.tolist(),
+        protocol.RobotArmStateKeys.ACTUAL_Q: column(protocol.RobotArmStateKeys.ACTUAL_Q, [0.0] * 6),
+        protocol.RobotArmStateKeys.ACTUAL_QD: column(protocol.RobotArmStateKeys.ACTUAL_QD, [0.0] * 6),
+        protocol.RobotArmStateKeys.OPERATION_ID: column(protocol.RobotArmStateKeys.OPERATION_ID, 0),
+        protocol.RobotArmStateKeys.READY: column(protocol.RobotArmStateKeys.READY, True),
+        protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_65: column(protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_65, False),
+        protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66: column(protocol.RobotArmStateKeys.OUTPUT_BIT_REGISTER_66, False),
+    }
+    states = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    return timestamps, states
+
+
+class ReplayStatistics:
+    """Achieved rate and lag behind the schedule of a replay"""
+
+    def __init__(self):
+        self.messages = 0
+        self.start_time = None
+        self.end_time = None
+        self.lags = collections.deque(maxlen=LAG_HISTORY)
+
+    def summary(self):
+        elapsed = (self.end_time or time.monotonic()) - self.start_time if self.start_time else 0.0
+        # No lag without a schedule (maximum speed)
+        lags = np.asarray(self.lags)
+        return {
+            "messages": self.messages,
+            "elapsed": elapsed,
+            "rate": self.messages / elapsed if elapsed > 0 else None,
+            "lag_p50": float(np.percentile(lags, 50)) if len(lags) else None,
+            "lag_p99": float(np.percentile(lags, 99)) if len(lags) else None,
+            "lag_max": float(lags.max()) if len(lags) else None,
+        }
+
+
+class LogReplay:
+    """Publishes a recorded PT state stream on the broker as if it were live.
+    Messages are scheduled from the recorded timestamps relative to a fixed start time,
+    so sleeping late never accumulates drift. The recorded timestamps are shifted on every
+    loop so they keep increasing.
+    :param rmq_config: Rabbitmq configuration
+    :param log_path: CSV log or recorder directory
+    :param speed: replay speed factor, 0 publishes as fast as possible
+    :param loops: number of times the log is replayed, 0 for endless
+    :param arm_id: namespace of the routing key, None for ROUTING_KEY_STATE"""
+
+    def __init__(self, rmq_config, log_path, speed=1.0, loops=1, arm_id=None):
+        self.logger = logging.getLogger("LogReplay")
+        self.rmq = create_rabbitmq(rmq_config, origin="log_replay")
+        self.timestamps, self.states = load_states(log_path)
+        self.speed = speed
+        self.loops = loops
+        self.routing_key = namespaced_routing_key(protocol.ROUTING_KEY_STATE, arm_id)
+        self.statistics = ReplayStatistics()
+        self.stop_event = threading.Event()
+
+    def setup(self):
+        self.rmq.connect_to_server()
+
+    def start(self):
+        """Replay the log in the calling thread"""
+        if not self.states:
+            return
+        intervals = np.diff(self.timestamps)
+        # A loop lasts the log duration plus one typical sample interval
+        loop_duration = self.timestamps[-1] - self.timestamps[0] + (float(np.median(intervals)) if len(intervals) else 0.0)
+        offsets = (self.timestamps - self.timestamps[0]).tolist()
+
+        self.statistics.start_time = start = time.monotonic()
+        loop = 0
+        while not self.stop_event.is_set() and (self.loops == 0 or loop < self.loops):
+            shift = loop * loop_duration
+            for offset, state in zip(offsets, self.states):
+                if self.stop_event.is_set():
+                    break
+                if self.speed > 0:
+                    scheduled = start + (shift + offset) / self.speed
+                    delay = scheduled - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.statistics.lags.append(time.monotonic() - scheduled)
+                if shift:
+                    state = dict(state)
+                    state[protocol.RobotArmStateKeys.TIMESTAMP] += shift
+                self.rmq.send_message(self.routing_key, state)
+                self.statistics.messages += 1
+            loop += 1
+        self.statistics.end_time = time.monotonic()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def cleanup(self):
+        self.rmq.close()
+
+
+def replay_arms(rmq_config, log_paths, arms=1, speed=1.0, loops=1):
+    """Replay logs for several arms concurrently, arm i replays log_paths[i % len(log_paths)]
+    on the routing key namespaced with "arm<i>" (no namespace for a single arm).
+    :return: statistics summary of every arm"""
+    replays = {}
+    for arm in range(arms):
+        arm_id = None if arms == 1 else f"arm{arm}"
+        replays[arm_id or "arm0"] = LogReplay(rmq_config, log_paths[arm % len(log_paths)], speed, loops, arm_id)
+    threads = []
+    for replay in replays.values():
+        replay.setup()
+        threads.append(threading.Thread(target=replay.start, daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        for replay in replays.values():
+            replay.stop()
+            replay.cleanup()
+    return {arm_id: replay.statistics.summary() for arm_id, replay in replays.items()}
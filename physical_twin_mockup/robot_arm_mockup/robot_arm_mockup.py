@@ -3,7 +3,7 @@ import time
 from queue import Queue, Empty
 import numpy as np
 
-from communication.rabbitmq import Rabbitmq
+from communication.rabbitmq import create_rabbitmq
 import communication.protocol as protocol
 from models.timing_model.timing_model import TimingModel
 from models.kinematic_model.kinematic_model import KinematicModel
@@ -26,8 +26,8 @@ class RobotArmMockup:
         publish_freq=20,
     ):
         # need two rmqs as pika is not thread safe
-        self.rmq_out = Rabbitmq(**rmq_config)
-        self.rmq_in = Rabbitmq(**rmq_config)
+        self.rmq_out = create_rabbitmq(rmq_config, origin="robot_arm_mockup")
+        self.rmq_in = create_rabbitmq(rmq_config, origin="robot_arm_mockup")
 
         self.timing_model = TimingModel()
         self.kinematic_model = KinematicModel()
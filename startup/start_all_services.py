@@ -1,14 +1,26 @@
 from startup.utils.start_as_daemon import start_as_daemon
 from startup.start_docker_rabbitmq import start_docker_rabbitmq
+from startup.start_local_broker import start_local_broker
 from startup.start_controller import start_controller
 from startup.start_pt_visualization import start_pt_visualization
 from startup.start_pt_mockup import start_robot_arm_mockup
 from startup.start_self_adaptation import start_self_adaptation_manager
+from startup.start_digital_shadow import start_digital_shadow
+from startup.start_recorder import start_recorder
+from startup.utils.config import load_config_w_setuptools
+from communication.rabbitmq import BACKEND_AMQP
+from communication.local_broker import BACKEND_LOCAL_SOCKET
 
 if __name__ == '__main__':
-    start_docker_rabbitmq()
+    config = load_config_w_setuptools("startup.conf")
+    if config["rabbitmq"].get("backend", BACKEND_AMQP) == BACKEND_LOCAL_SOCKET:
+        start_as_daemon(start_local_broker)
+    else:
+        start_docker_rabbitmq()
     start_as_daemon(start_pt_visualization)
     start_as_daemon(start_controller)
     start_as_daemon(start_robot_arm_mockup)
     start_as_daemon(start_self_adaptation_manager)
+    start_as_daemon(start_digital_shadow)
+    start_as_daemon(start_recorder)
     
\ No newline at end of file
@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+
+from startup.utils.config import load_config_w_setuptools
+import benchmarks.suites  # registers the benchmarks
+from benchmarks.benchmark import run, to_report, load_report, compare
+
+
+def start_benchmarks():
+    """Run the benchmarks, write the results and compare them with the baseline.
+    Exits with status 1 if a benchmark regressed by more than the configured tolerance."""
+    config = load_config_w_setuptools("startup.conf")
+    benchmark_config = config["benchmarks"]
+
+    results = run(
+        names=benchmark_config["names"],
+        measure_time=benchmark_config["measure_time"],
+        repeats=benchmark_config["repeats"],
+    )
+    report = to_report(results)
+    baseline_path = benchmark_config["baseline"]
+    if os.path.exists(baseline_path):
+        report["baseline"] = load_report(baseline_path)["environment"]
+        report["comparison"] = compare(report, load_report(baseline_path), benchmark_config["tolerance"])
+
+    paths = [benchmark_config["output"]]
+    if benchmark_config["save_baseline"]:
+        paths.append(baseline_path)
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    for result in results:
+        entry = report.get("comparison", {}).get(result.name, {})
+        if result.status == "ok":
+            ratio = f"{entry['ratio']:.2f}x" if entry.get("ratio") else ""
+            print(f"{result.name:<50} {result.minimum * 1e6:12.2f} us/op {ratio:>8} {entry.get('status', '')}")
+        else:
+            print(f"{result.name:<50} {result.status}: {result.reason}")
+
+    regressions = [name for name, entry in report.get("comparison", {}).items() if entry["status"] == "regression"]
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    start_benchmarks()
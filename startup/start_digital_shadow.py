@@ -0,0 +1,32 @@
+import time
+
+from startup.utils.config import load_config_w_setuptools
+from dt.services.digital_shadow import DigitalShadow
+
+
+def start_digital_shadow(ok_queue=None):
+    config = load_config_w_setuptools("startup.conf")
+
+    while True:
+        try:
+            digital_shadow = DigitalShadow(
+                rmq_config=config["rabbitmq"],
+                initial_q=config["physical_twin"]["robot"]["initial_q"],
+                speedup=config["physical_twin"]["robot"]["speedup"],
+                publish_freq=config["physical_twin"]["robot"]["publish_frequency"],
+                timing_correction_config=config["digital_twin"]["timing_correction"],
+            )
+            digital_shadow.setup()
+            if ok_queue is not None:
+                ok_queue.put("OK")
+            digital_shadow.start()
+        except KeyboardInterrupt:
+            exit(0)
+        except Exception as exc:
+            # l.error("The following exception occurred. Attempting to reconnect.")
+            # l.error(exc)
+            time.sleep(1.0)
+
+
+if __name__ == "__main__":
+    start_digital_shadow()
@@ -0,0 +1,17 @@
+from startup.utils.config import load_config_w_setuptools
+from communication.local_broker import serve_local_broker
+
+
+def start_local_broker(ok_queue=None):
+    """Serve the in-memory broker for the local_socket backend on the configured ip and port"""
+    config = load_config_w_setuptools("startup.conf")
+    rmq_config = config["rabbitmq"]
+
+    if ok_queue is not None:
+        ok_queue.put("OK")
+
+    serve_local_broker(rmq_config["ip"], rmq_config["port"], rmq_config["password"])
+
+
+if __name__ == '__main__':
+    start_local_broker()
@@ -0,0 +1,26 @@
+import json
+
+from startup.utils.config import load_config_w_setuptools
+from physical_twin_mockup.log_replay.log_replay import replay_arms
+
+
+def start_log_replay(ok_queue=None):
+    """Replay the configured PT logs on the broker and print the achieved rate and lag of every arm"""
+    config = load_config_w_setuptools("startup.conf")
+    replay_config = config["log_replay"]
+
+    if ok_queue is not None:
+        ok_queue.put("OK")
+
+    statistics = replay_arms(
+        rmq_config=config["rabbitmq"],
+        log_paths=replay_config["logs"],
+        arms=replay_config["arms"],
+        speed=replay_config["speed"],
+        loops=replay_config["loops"],
+    )
+    print(json.dumps(statistics, indent=2))
+
+
+if __name__ == '__main__':
+    start_log_replay()
@@ -1,4 +1,4 @@
-from communication.rabbitmq import Rabbitmq
+from communication.rabbitmq import create_rabbitmq
 from startup.utils.config import load_config_w_setuptools
 from time import sleep
 
@@ -8,7 +8,7 @@ class Publisher:
     def __init__(self) -> None:
         self.config = load_config_w_setuptools("startup.conf")
         self.rabbitmq_config = self.config["rabbitmq"]
-        self.rabbitmq = Rabbitmq(**self.rabbitmq_config)
+        self.rabbitmq = create_rabbitmq(self.rabbitmq_config)
         self.rabbitmq.connect_to_server()
     
     def publish_4ever(self) -> None:
@@ -0,0 +1,38 @@
+import time
+
+from startup.utils.config import load_config_w_setuptools
+from dt.services.recorder import Recorder
+
+
+def start_recorder(ok_queue=None):
+    config = load_config_w_setuptools("startup.conf")
+    recorder_config = config["recorder"]
+
+    while True:
+        recorder = None
+        try:
+            recorder = Recorder(
+                rmq_config=config["rabbitmq"],
+                directory=recorder_config["directory"],
+                routing_keys=recorder_config["routing_keys"],
+                flush_size=recorder_config["flush_size"],
+                flush_interval=recorder_config["flush_interval"],
+                rotation_interval=recorder_config["rotation_interval"],
+            )
+            recorder.setup()
+            if ok_queue is not None:
+                ok_queue.put("OK")
+            recorder.start()
+        except KeyboardInterrupt:
+            if recorder is not None:
+                # Write the buffered and queued messages
+                recorder.cleanup()
+            exit(0)
+        except Exception as exc:
+            # l.error("The following exception occurred. Attempting to reconnect.")
+            # l.error(exc)
+            time.sleep(1.0)
+
+
+if __name__ == "__main__":
+    start_recorder()
@@ -11,6 +11,10 @@ def start_self_adaptation_manager(ok_queue=None):
         try:
             self_adaptation_manager = SelfAdaptationManager(
                 rmq_config=config["rabbitmq"],
+                task_spec_name=config["physical_twin"]["controller"]["task_specification"],
+                speedup=config["physical_twin"]["robot"]["speedup"],
+                what_if_config=config["digital_twin"]["self_adaptation"]["what_if"],
+                timing_correction_config=config["digital_twin"]["timing_correction"],
             )
             self_adaptation_manager.setup()
             if ok_queue is not None:
@@ -1,11 +1,11 @@
-from communication.rabbitmq import Rabbitmq
+from communication.rabbitmq import create_rabbitmq
 from startup.utils.config import load_config_w_setuptools
 
 class Subscriber:
     def __init__(self) -> None:
         self.config = load_config_w_setuptools("startup.conf")
         self.rabbitmq_config = self.config["rabbitmq"]
-        self.rabbitmq = Rabbitmq(**self.rabbitmq_config)
+        self.rabbitmq = create_rabbitmq(self.rabbitmq_config)
         self.rabbitmq.connect_to_server()
     
     def subscribe(self) -> None:
@@ -0,0 +1,21 @@
+import json
+
+from startup.utils.config import load_config_w_setuptools
+from models.timing_model.calibration import calibrate, write_calibration
+
+
+def start_timing_calibration():
+    """Calibrate the timing model on the configured PT logs, write the configuration and print the held-out errors"""
+    config = load_config_w_setuptools("startup.conf")
+    calibration_config = config["timing_calibration"]
+
+    timing_config, report = calibrate(
+        log_paths=calibration_config["logs"],
+        held_out_fraction=calibration_config["held_out_fraction"],
+    )
+    write_calibration(calibration_config["output"], timing_config, report)
+    print(json.dumps({**timing_config, "report": report}, indent=2))
+
+
+if __name__ == '__main__':
+    start_timing_calibration()
@@ -0,0 +1,38 @@
+import json
+import threading
+import time
+
+from startup.utils.config import load_config_w_setuptools
+from communication.rabbitmq import create_rabbitmq
+from communication.tracing import TraceCollector
+import communication.protocol as protocol
+
+# Interval between two latency reports in seconds
+REPORT_INTERVAL = 10.0
+
+
+def start_trace_collector(ok_queue=None):
+    """Collect the trace records of the services and periodically print the per-hop latencies"""
+    config = load_config_w_setuptools("startup.conf")
+
+    collector = TraceCollector()
+    rmq = create_rabbitmq(config["rabbitmq"])
+    rmq.connect_to_server()
+    rmq.subscribe(routing_key=protocol.ROUTING_KEY_TRACE,
+                  on_message_callback=collector.on_trace_records)
+
+    def report_loop():
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            print(json.dumps(collector.report(), indent=2))
+
+    threading.Thread(target=report_loop, daemon=True).start()
+
+    if ok_queue is not None:
+        ok_queue.put("OK")
+
+    rmq.start_consuming()
+
+
+if __name__ == '__main__':
+    start_trace_collector()
@@ -0,0 +1,189 @@
+"""Opt-in metrics and profiling of the services started with start_as_daemon.
+
+Configured in the instrumentation section of startup.conf. In every service process:
+- the broker clients are metered (see communication.metrics), and the metrics are served in the
+  Prometheus text format on http://127.0.0.1:<port>/metrics and/or written to <output_dir>/<service>.prom,
+  e.g. for the textfile collector of the node exporter,
+- a sampling profiler records the stacks of all threads and periodically writes them as folded
+  stacks to <output_dir>/<service>.folded, the input of flamegraph.pl or speedscope.
+"""
+import collections
+import http.server
+import logging
+import os
+import sys
+import threading
+import time
+
+from communication.metrics import enable_metrics
+from startup.utils.config import load_config_w_setuptools
+
+THREAD_NAME_PREFIX = "instrumentation"
+
+
+def write_atomically(path, text):
+    """Write a file so readers never see a partial file"""
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as output_file:
+        output_file.write(text)
+    os.replace(temporary_path, path)
+
+
+def service_name(component_starter_function):
+    """start_controller -> controller"""
+    name = component_starter_function.__name__
+    return name[len("start_"):] if name.startswith("start_") else name
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads of the process at a fixed interval.
+    The counts of the folded stacks, rooted at the thread name, are written every dump_interval seconds.
+    :param path: output file of the folded stacks
+    :param interval: sampling interval in seconds
+    :param dump_interval: interval of the dumps in seconds"""
+
+    def __init__(self, path, interval, dump_interval):
+        self.path = path
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name=f"{THREAD_NAME_PREFIX}-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.dump()
+
+    def sample(self):
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            thread_name = thread_names.get(ident, str(ident))
+            if thread_name.startswith(THREAD_NAME_PREFIX):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(thread_name)
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def dump(self):
+        write_atomically(self.path, "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+
+    def __run(self):
+        next_dump = time.monotonic() + self.dump_interval
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= next_dump:
+                next_dump += self.dump_interval
+                self.dump()
+
+
+class MetricsFileWriter:
+    """Writes the metrics of a registry to a file every interval seconds"""
+
+    def __init__(self, registry, path, interval):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name=f"{THREAD_NAME_PREFIX}-metrics-file", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.write()
+
+    def write(self):
+        write_atomically(self.path, self.registry.render())
+
+    def __run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+
+class MetricsHttpServer:
+    """Serves the metrics of a registry on http://127.0.0.1:<port>/metrics"""
+
+    def __init__(self, registry, port):
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes are not logged
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name=f"{THREAD_NAME_PREFIX}-metrics-http",
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def instrument(service, instrumentation_config):
+    """Enable the configured metrics and profiling in this process
+    :param service: name of the service, e.g. "controller"
+    :param instrumentation_config: the instrumentation section of startup.conf
+    :return: the started components, to be stopped when the service ends"""
+    output_dir = instrumentation_config["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+    registry = enable_metrics(service)
+    components = []
+
+    metrics_config = instrumentation_config["metrics"]
+    if metrics_config["file_interval"]:
+        components.append(MetricsFileWriter(registry, os.path.join(output_dir, f"{service}.prom"),
+                                            metrics_config["file_interval"]))
+    port = metrics_config["http_ports"].get(service, None)
+    if port:
+        components.append(MetricsHttpServer(registry, port))
+
+    profiler_config = instrumentation_config["profiler"]
+    if profiler_config["enabled"]:
+        components.append(SamplingProfiler(os.path.join(output_dir, f"{service}.folded"),
+                                           profiler_config["interval"], profiler_config["dump_interval"]))
+    for component in components:
+        component.start()
+    return components
+
+
+def run_instrumented(component_starter_function, kwargs):
+    """Run a service starter, instrumented if enabled in the instrumentation section of startup.conf"""
+    instrumentation_config = load_config_w_setuptools("startup.conf").get("instrumentation", None)
+    if not instrumentation_config or not instrumentation_config["enabled"]:
+        return component_starter_function(**kwargs)
+
+    components = instrument(service_name(component_starter_function), instrumentation_config)
+    try:
+        return component_starter_function(**kwargs)
+    finally:
+        # Final dumps of the metrics and the profile
+        for component in components:
+            try:
+                component.stop()
+            except Exception:
+                logging.getLogger("instrumentation").exception("Stopping %s failed", type(component).__name__)
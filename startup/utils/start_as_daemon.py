@@ -3,14 +3,18 @@
 from multiprocessing import Process, get_context
 from multiprocessing.queues import Queue
 
+from startup.utils.instrumentation import run_instrumented
+
 
 def start_as_daemon(component_starter_function, kwargs=None) -> Process:
+    """Start a service in a new process, instrumented if enabled in the instrumentation
+    section of startup.conf (see startup.utils.instrumentation)"""
     if kwargs is None:
         kwargs = {}
     ok_queue = Queue(ctx=get_context())
     pname = component_starter_function.__name__
     kwargs["ok_queue"] = ok_queue
-    p = Process(target=component_starter_function, kwargs=kwargs, name=pname)
+    p = Process(target=run_instrumented, args=(component_starter_function, kwargs), name=pname)
     p.start()
     print(f"{pname}... ", end="")
     print(ok_queue.get())